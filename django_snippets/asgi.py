@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'django_snippets.settings')
 
-application = get_asgi_application()
\ No newline at end of file
+application = get_asgi_application()
+
+# Pushes the views counted by the process in the background, see snippets/popularity.py
+from snippets.popularity import buffer  # noqa: E402
+
+buffer.start_pusher()
@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/1.10/ref/settings/
 
 import os
 import dj_database_url
-from decouple import config
+from decouple import Csv, config
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -41,8 +41,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "snippets.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
-    "whitenoise.middleware.WhiteNoiseMiddleware",
+    "snippets.middleware.AsyncWhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -55,7 +56,7 @@ ROOT_URLCONF = "django_snippets.urls"
 
 TEMPLATES = [
     {
-        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        "BACKEND": "snippets.metrics.TimedDjangoTemplates",
         "DIRS": [os.path.join(BASE_DIR, "templates")],
         "APP_DIRS": True,
         "OPTIONS": {
@@ -70,6 +71,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "django_snippets.wsgi.application"
+ASGI_APPLICATION = "django_snippets.asgi.application"
 
 # Database
 # https://docs.djangoproject.com/en/1.10/ref/settings/#databases
@@ -134,13 +136,28 @@ LOGIN_URL = "/login/"
 
 STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 
-EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+EMAIL_BACKEND = config("EMAIL_BACKEND", default="django.core.mail.backends.smtp.EmailBackend")
 EMAIL_HOST = config("EMAIL_HOST", default="")
 EMAIL_HOST_USER = config("EMAIL_HOST_USER", default="")
 EMAIL_HOST_PASSWORD = config("EMAIL_HOST_PASSWORD", default="")
 EMAIL_PORT = config("EMAIL_PORT", default="")
 EMAIL_USE_TLS = config("EMAIL_USE_TLS", default="")
 
+# Batched delivery of the notifications, see snippets/mail.py
+EMAIL_BATCH_SIZE = config("EMAIL_BATCH_SIZE", default=50, cast=int)
+EMAIL_MAX_ATTEMPTS = config("EMAIL_MAX_ATTEMPTS", default=5, cast=int)
+EMAIL_RETRY_BACKOFF = config("EMAIL_RETRY_BACKOFF", default=60, cast=int)
+EMAIL_FLUSH_INTERVAL = config("EMAIL_FLUSH_INTERVAL", default=30, cast=int)
+# Sends the queue as soon as an email is added instead of waiting for a full batch. On by
+# default with CELERY_EAGER, which has no beat to send the batches
+EMAIL_SEND_ON_QUEUE = config("EMAIL_SEND_ON_QUEUE", default=config("CELERY_EAGER", default=True, cast=bool), cast=bool)
+
+# Code and highlights shared by identical snippets, the unused ones are deleted periodically
+HIGHLIGHT_BLOB_COLLECT_INTERVAL = config("HIGHLIGHT_BLOB_COLLECT_INTERVAL", default=60 * 60, cast=int)
+# Store the code of the new blobs compressed with zlib and the latest trained dictionary,
+# see snippets/codec.py. `recompress_snippets` compresses the existing ones
+SNIPPET_CODE_COMPRESSION = config("SNIPPET_CODE_COMPRESSION", default=False, cast=bool)
+
 CELERY_BROKER_URL = config("REDIS_URL", default="")
 CELERY_RESULT_BACKEND = config("REDIS_URL", default="")
 CELERY_ACCEPT_CONTENT = ["application/json"]
@@ -149,6 +166,96 @@ CELERY_TASK_SERIALIZER = "json"
 CELERY_TASK_ALWAYS_EAGER = config("CELERY_EAGER", default=True, cast=bool)
 CELERY_TASK_EAGER_PROPAGATES = config("CELERY_EAGER", default=True, cast=bool)
 
+# Task calls saved with the changes of the views and relayed to the broker, see snippets/outbox.py
+OUTBOX_BATCH_SIZE = config("OUTBOX_BATCH_SIZE", default=500, cast=int)
+OUTBOX_MAX_ATTEMPTS = config("OUTBOX_MAX_ATTEMPTS", default=10, cast=int)
+OUTBOX_RETRY_BACKOFF = config("OUTBOX_RETRY_BACKOFF", default=5, cast=int)
+OUTBOX_RELAY_INTERVAL = config("OUTBOX_RELAY_INTERVAL", default=2, cast=float)
+# Sends the events of a request right after its commit. On by default with CELERY_EAGER,
+# which has no beat to run the relay, off otherwise: the relay runs from beat
+OUTBOX_RELAY_ON_COMMIT = config("OUTBOX_RELAY_ON_COMMIT", default=CELERY_TASK_ALWAYS_EAGER, cast=bool)
+# Views of the snippets, buffered in each process and pushed by a thread of the process every
+# VIEW_BUFFER_INTERVAL seconds to Redis, then written in batches, see snippets/popularity.py
+VIEW_COUNTS_REDIS_URL = config("REDIS_URL", default="")
+VIEW_BUFFER_INTERVAL = config("VIEW_BUFFER_INTERVAL", default=5, cast=float)
+VIEW_BUFFER_SIZE = config("VIEW_BUFFER_SIZE", default=1000, cast=int)
+VIEW_FLUSH_INTERVAL = config("VIEW_FLUSH_INTERVAL", default=60, cast=int)
+VIEW_FLUSH_BATCH_SIZE = config("VIEW_FLUSH_BATCH_SIZE", default=500, cast=int)
+# The trends are stored in this unit, changing it reorders the listing until the new views dominate
+TRENDING_HALF_LIFE = config("TRENDING_HALF_LIFE", default=6 * 60 * 60, cast=int)
+TRENDING_SIZE = config("TRENDING_SIZE", default=20, cast=int)
+
+CELERY_BEAT_SCHEDULE = {
+    "relay-outbox": {
+        "task": "snippets.tasks.relayOutbox",
+        "schedule": OUTBOX_RELAY_INTERVAL,
+    },
+    "send-pending-emails": {
+        "task": "snippets.tasks.sendPendingEmails",
+        "schedule": EMAIL_FLUSH_INTERVAL,
+    },
+    "flush-snippet-views": {
+        "task": "snippets.tasks.flushSnippetViews",
+        "schedule": VIEW_FLUSH_INTERVAL,
+    },
+    "collect-highlight-blobs": {
+        "task": "snippets.tasks.collectHighlightBlobs",
+        "schedule": HIGHLIGHT_BLOB_COLLECT_INTERVAL,
+    },
+}
+
+# Cache
+# Redis is shared by every gunicorn and celery worker, fall back to local memory otherwise.
+if config("REDIS_URL", default=""):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": config("REDIS_URL"),
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+# Snippets per page in the listings
+SNIPPETS_PAGE_SIZE = config("SNIPPETS_PAGE_SIZE", default=20, cast=int)
+
+# Anonymous pages cache, fresh for PAGE_CACHE_TIMEOUT seconds and served stale while
+# they are rendered again for PAGE_CACHE_STALE more seconds
+PAGE_CACHE_TIMEOUT = config("PAGE_CACHE_TIMEOUT", default=300, cast=int)
+PAGE_CACHE_STALE = config("PAGE_CACHE_STALE", default=3600, cast=int)
+
+# Highlighted snippets cache
+HIGHLIGHT_CACHE_SIZE = config("HIGHLIGHT_CACHE_SIZE", default=256, cast=int)
+HIGHLIGHT_CACHE_TIMEOUT = config("HIGHLIGHT_CACHE_TIMEOUT", default=60 * 60 * 24, cast=int)
+
+# Size tiers of the snippets, in characters. Up to HIGHLIGHT_MAX_SIZE the whole snippet is
+# highlighted, up to SNIPPET_RAW_SIZE it is highlighted a page of HIGHLIGHT_PAGE_LINES lines at a time
+# and past that it is only served raw, SNIPPET_RAW_CHUNK_SIZE characters at a time
+HIGHLIGHT_MAX_SIZE = config("HIGHLIGHT_MAX_SIZE", default=200000, cast=int)
+HIGHLIGHT_PAGE_LINES = config("HIGHLIGHT_PAGE_LINES", default=500, cast=int)
+# A page of lines is also cut at this many characters, a long line goes on in the next page
+HIGHLIGHT_PAGE_SIZE = config("HIGHLIGHT_PAGE_SIZE", default=50000, cast=int)
+SNIPPET_RAW_SIZE = config("SNIPPET_RAW_SIZE", default=2000000, cast=int)
+SNIPPET_RAW_CHUNK_SIZE = config("SNIPPET_RAW_CHUNK_SIZE", default=256 * 1024, cast=int)
+
+# Processes the async views render highlights in, see highlighting.highlight_pool
+HIGHLIGHT_WORKERS = config("HIGHLIGHT_WORKERS", default=2, cast=int)
+
+# Request metrics, see snippets/metrics.py. Every request is counted and timed, a
+# METRICS_SAMPLE_RATE fraction of them is also broken down in queries, highlight,
+# template and cache lookups, sent back in a Server-Timing header. The totals are
+# served in the Prometheus format at /metrics/ to the requests with the METRICS_TOKEN as
+# a bearer token or, without a token, to the METRICS_ALLOWED_IPS.
+METRICS_ENABLED = config("METRICS_ENABLED", default=True, cast=bool)
+METRICS_SAMPLE_RATE = config("METRICS_SAMPLE_RATE", default=0.05, cast=float)
+METRICS_SERVER_TIMING = config("METRICS_SERVER_TIMING", default=True, cast=bool)
+METRICS_TOKEN = config("METRICS_TOKEN", default="")
+METRICS_ALLOWED_IPS = config("METRICS_ALLOWED_IPS", default="127.0.0.1,::1", cast=Csv())
+
 ALLOWED_HOSTS = ['localhost','0.0.0.0','127.0.0.1','web-production-51c1f.up.railway.app']
 
 CSRF_TRUSTED_ORIGINS = ['http://*','https://web-production-51c1f.up.railway.app']
\ No newline at end of file
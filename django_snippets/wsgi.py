@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "django_snippets.settings")
 
 application = get_wsgi_application()
+
+# Pushes the views counted by the process in the background, see snippets/popularity.py
+from snippets.popularity import buffer  # noqa: E402
+
+buffer.start_pusher()
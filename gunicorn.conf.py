@@ -0,0 +1,13 @@
+# gunicorn settings, read from the working directory by `gunicorn` without arguments.
+# SERVER_MODE picks the interface: "wsgi" runs the sync workers, one request at a time
+# each, and "asgi" runs uvicorn workers, where the async views wait on the database
+# and the highlight pool without holding a worker.
+import decouple
+
+SERVER_MODE = decouple.config("SERVER_MODE", default="wsgi")
+
+if SERVER_MODE == "asgi":
+    wsgi_app = "django_snippets.asgi:application"
+    worker_class = "uvicorn_worker.UvicornWorker"
+else:
+    wsgi_app = "django_snippets.wsgi:application"
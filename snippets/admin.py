@@ -1,5 +1,6 @@
 from django.contrib import admin
 
+from .highlighting import registry
 from .models import Language
 
 
@@ -9,3 +10,19 @@ class LanguageAdmin(admin.ModelAdmin):
         "name",
         "slug",
     )
+
+    # Lexers are keyed by the language name, so other workers never use a stale one,
+    # this only frees the entries of the process that edits the language.
+    def save_model(self, request, obj, form, change):
+        if change and "name" in form.changed_data:
+            registry.invalidate(form.initial.get("name"))
+        super().save_model(request, obj, form, change)
+
+    def delete_model(self, request, obj):
+        registry.invalidate(obj.name)
+        super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        for name in queryset.values_list("name", flat=True):
+            registry.invalidate(name)
+        super().delete_queryset(request, queryset)
@@ -0,0 +1,195 @@
+from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.views import View
+
+from .models import CodeBlob, CodeDictionary, Language, Snippet
+from .queries import aiterate, index_snippets, language_snippets, paginate, user_snippets
+from .utils import is_snippet_owner, is_the_owner, streaming_content
+
+# Public name of every field and the attributes it's read from, the lookup too except for `COLUMNS`
+FIELDS = {
+    "id": "id",
+    "name": "name",
+    "description": "description",
+    "snippet": "code_blob__text",
+    "language": "language__slug",
+    "user": "user__username",
+    "public": "public",
+    "created": "created",
+    "updated": "updated",
+}
+# Columns of the fields that aren't one, the code may be compressed in its blob
+COLUMNS = {"snippet": ("code_blob__code", "code_blob__compressed", "code_blob__dictionary")}
+MAX_PAGE_SIZE = 100
+# Rows the export reads from the database cursor at a time
+EXPORT_CHUNK_SIZE = 2000
+
+
+class BadRequest(Exception):
+    pass
+
+
+def selected_fields(request):
+    """ Fields asked in the `fields` parameter, all of them when it's missing """
+    fields = [field for field in request.GET.get("fields", "").split(",") if field]
+    unknown = [field for field in fields if field not in FIELDS]
+    if unknown:
+        raise BadRequest("Unknown fields: %s" % ", ".join(unknown))
+    return fields or list(FIELDS)
+
+
+def page_size(request):
+    try:
+        size = int(request.GET.get("limit", 0))
+    except ValueError:
+        raise BadRequest("limit must be a number")
+    return min(max(size, 0), MAX_PAGE_SIZE) or None
+
+
+def only_fields(queryset, fields):
+    """ Loads the selected fields, plus the ones the cursor needs, and nothing else """
+    lookups = {"id", "created"} | {column for field in fields for column in columns(field)}
+    related = [lookup.split("__")[0] for lookup in lookups if "__" in lookup]
+    return queryset.select_related(None).select_related(*related).only(*lookups)
+
+
+def columns(field):
+    return COLUMNS.get(field, (FIELDS[field],))
+
+
+def serialize(snippet, fields):
+    data = {}
+    for field in fields:
+        value = snippet
+        for attribute in FIELDS[field].split("__"):
+            value = getattr(value, attribute)
+        data[field] = value
+    return data
+
+
+def export_row(row, fields):
+    """ The fields of a row of the export, read from their `columns` """
+    values = iter(row)
+    data = {}
+    for field in fields:
+        if field == "snippet":
+            data[field] = CodeBlob.decode(next(values), next(values), next(values))
+        else:
+            data[field] = next(values)
+    return data
+
+
+def export_lines(rows, fields):
+    """ The lines of the export of a `values_list` of the `columns` of the fields """
+    encoder = DjangoJSONEncoder()
+    for row in rows.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        yield encoder.encode(export_row(row, fields)) + "\n"
+
+
+async def aexport_lines(rows, fields):
+    """ `export_lines` for ASGI, the dictionary of a compressed code is read before decoding it """
+    encoder = DjangoJSONEncoder()
+    row_columns = [column for field in fields for column in columns(field)]
+    dictionary = row_columns.index("code_blob__dictionary") if "snippet" in fields else None
+    async for row in aiterate(rows, EXPORT_CHUNK_SIZE):
+        if dictionary is not None:
+            await CodeDictionary.aload(row[dictionary])
+        yield encoder.encode(export_row(row, fields)) + "\n"
+
+
+def error_response(error, status=400):
+    return JsonResponse({"error": str(error)}, status=status)
+
+
+class SnippetListApi(View):
+    """
+    Lists the snippets as JSON, paginated by cursor.
+
+    GET: Public snippets and the ones of the authenticated user, or only the ones of
+         a `user` or a `language`. `fields` picks the fields of each snippet, leaving
+         out `snippet` avoids loading the code. `limit` sets the size of the page and
+         `next` and `previous` are the URLs of the surrounding pages.
+    """
+    def get(self, request, *args, **kwargs):
+        try:
+            fields = selected_fields(request)
+            size = page_size(request)
+        except BadRequest as error:
+            return error_response(error)
+
+        if request.GET.get("user"):
+            owner = get_object_or_404(User, username=request.GET["user"])
+            snippets = user_snippets(owner, include_private=is_the_owner(request, owner.username))
+        elif request.GET.get("language"):
+            snippets = language_snippets(get_object_or_404(Language, slug=request.GET["language"]))
+        else:
+            snippets = index_snippets(request.user)
+        if isinstance(snippets, list):
+            snippets = [only_fields(queryset, fields) for queryset in snippets]
+        else:
+            snippets = only_fields(snippets, fields)
+
+        page = paginate(snippets, request.GET.get("after"), request.GET.get("before"), size)
+        return JsonResponse({
+            "results": [serialize(snippet, fields) for snippet in page.items],
+            "next": self.page_url(request, "after", page.next_cursor),
+            "previous": self.page_url(request, "before", page.previous_cursor),
+        })
+
+    def page_url(self, request, direction, cursor):
+        if not cursor:
+            return None
+        params = request.GET.copy()
+        params.pop("after", None)
+        params.pop("before", None)
+        params[direction] = cursor
+        return request.build_absolute_uri("%s?%s" % (request.path, params.urlencode()))
+
+
+class SnippetDetailApi(View):
+    """
+    GET: A snippet as JSON, with the fields asked in `fields`. Private snippets are
+         only found by their owner.
+    """
+    def get(self, request, *args, **kwargs):
+        try:
+            fields = selected_fields(request)
+        except BadRequest as error:
+            return error_response(error)
+        snippets = only_fields(Snippet.objects.all(), fields + ["public", "user"])
+        snippet = get_object_or_404(snippets, id=self.kwargs["id"])
+        if not snippet.public and not is_snippet_owner(request, snippet):
+            raise Http404("No Snippet matches the given query.")
+        return JsonResponse(serialize(snippet, fields))
+
+
+class SnippetExportApi(View):
+    """
+    Streams every snippet visible to the user as newline delimited JSON, one per line.
+
+    GET: The rows are read with a server side cursor, where the database has one, in
+         chunks of EXPORT_CHUNK_SIZE and written as they come, so the memory used
+         doesn't grow with the number of snippets. Accepts `fields` like the list.
+         Under ASGI the rows are read by an async iterator, see `streaming_content`.
+    """
+    def get(self, request, *args, **kwargs):
+        try:
+            fields = selected_fields(request)
+        except BadRequest as error:
+            return error_response(error)
+
+        visible = Q(public=True)
+        if request.user.is_authenticated:
+            visible |= Q(user=request.user)
+        rows = (
+            Snippet.objects.filter(visible)
+            .order_by("id")
+            .values_list(*[column for field in fields for column in columns(field)])
+        )
+        lines = streaming_content(request, export_lines, aexport_lines, rows, fields)
+        response = StreamingHttpResponse(lines, content_type="application/x-ndjson")
+        response["Content-Disposition"] = 'attachment; filename="snippets.ndjson"'
+        return response
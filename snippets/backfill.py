@@ -0,0 +1,173 @@
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .caching import invalidate
+from .highlighting import setup_worker
+from .models import HighlightBlob, Snippet
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH_SIZE = 500
+
+
+def id_ranges(snippets, batch_size, after=0):
+    """ Splits the snippets in (first_id, last_id) ranges of `batch_size` rows, in id order """
+    while True:
+        ids = list(snippets.filter(id__gt=after).order_by("id").values_list("id", flat=True)[:batch_size])
+        if not ids:
+            return
+        yield ids[0], ids[-1]
+        after = ids[-1]
+
+
+def render_range(first_id, last_id, only_pending=False):
+    """
+    Renders the snippets of an id range with `Snippet.highlight`, once per distinct code.
+    The HTML in the highlight cache is rendered again and replaced, it may come from
+    the formatter or style the backfill is there to replace.
+    Returns (id, updated, digest, html) of each one, the process that started the
+    backfill writes them.
+    """
+    snippets = (
+        Snippet.objects.select_related("language", "code_blob")
+        .only("id", "updated", "language__name", "code_blob__code", "code_blob__compressed", "code_blob__dictionary")
+        .filter(id__gte=first_id, id__lte=last_id)
+        # Snippets past SNIPPET_RAW_SIZE are never highlighted
+        .filter(code_blob__size__lte=settings.SNIPPET_RAW_SIZE)
+    )
+    if only_pending:
+        snippets = snippets.filter(highlight_blob__isnull=True)
+    rendered = {}
+    results = []
+    for snippet in snippets:
+        digest = snippet.highlight_digest()
+        if digest not in rendered:
+            rendered[digest] = snippet.highlight(refresh=True)
+        results.append((snippet.id, snippet.updated, digest, rendered[digest]))
+    return results
+
+
+def _render_range(args):
+    return render_range(*args)
+
+
+def write_highlights(results):
+    """
+    Stores a batch of renders in one transaction. A snippet edited while it was being
+    rendered is skipped, its edit already queued a render of the new code.
+    """
+    written = 0
+    with transaction.atomic():
+        for snippet_id, updated, digest, html in results:
+            written += HighlightBlob.attach(snippet_id, updated, digest, html)
+    invalidate(*["snippet:%s" % result[0] for result in results])
+    return written
+
+
+class Checkpoint:
+    """
+    Progress of a backfill saved in a JSON file: the id below which every range is
+    done. Ranges finish out of order, so the ones past the first pending range are
+    kept in memory and the checkpoint only moves over a contiguous run of them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.last_id = 0
+        self.rendered = 0
+        if path and os.path.exists(path):
+            with open(path) as checkpoint:
+                data = json.load(checkpoint)
+            self.last_id = data["last_id"]
+            self.rendered = data["rendered"]
+        self._pending = []
+        self._done = {}
+
+    def started(self, first_id, last_id):
+        self._pending.append((first_id, last_id))
+
+    def finished(self, first_id, last_id, rendered):
+        self._done[(first_id, last_id)] = rendered
+        while self._pending and self._pending[0] in self._done:
+            self.rendered += self._done.pop(self._pending[0])
+            self.last_id = self._pending.pop(0)[1]
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as checkpoint:
+            json.dump({"last_id": self.last_id, "rendered": self.rendered}, checkpoint)
+        os.replace(temporary, self.path)
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def backfill_highlights(
+    batch_size=BACKFILL_BATCH_SIZE, workers=1, checkpoint_path=None, only_pending=False, progress=None
+):
+    """
+    Renders again the highlight of every snippet, for instance after a formatter or
+    style change.
+
+    The table is split in id ranges of `batch_size` snippets that `workers` processes
+    render while this one writes the results, a transaction per range. After each
+    range the checkpoint file is updated, running it again with the same file
+    continues after the last range written. `progress` is called with the rendered
+    rows, the total and the rows per second. The checkpoint is removed at the end.
+    """
+    checkpoint = Checkpoint(checkpoint_path)
+    snippets = Snippet.objects.all()
+    if only_pending:
+        snippets = snippets.filter(highlight_blob__isnull=True)
+    total = checkpoint.rendered + snippets.filter(id__gt=checkpoint.last_id).count()
+    started = time.perf_counter()
+    rendered = 0
+
+    def finished(first_id, last_id, results):
+        nonlocal rendered
+        written = write_highlights(results)
+        rendered += written
+        checkpoint.finished(first_id, last_id, written)
+        seconds = time.perf_counter() - started
+        rate = rendered / seconds if seconds else 0
+        logger.info("Rendered %s of %s highlights, %.1f rows/s", checkpoint.rendered, total, rate)
+        if progress:
+            progress(checkpoint.rendered, total, rate)
+
+    ranges = id_ranges(snippets, batch_size, checkpoint.last_id)
+    if workers <= 1:
+        for first_id, last_id in ranges:
+            checkpoint.started(first_id, last_id)
+            finished(first_id, last_id, render_range(first_id, last_id, only_pending))
+    else:
+        # Spawned rather than forked, a forked worker would share the database connection of this process
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            workers, mp_context=context, initializer=setup_worker, initargs=(dict(connection.settings_dict),)
+        ) as executor:
+            running = {}
+            for first_id, last_id in ranges:
+                checkpoint.started(first_id, last_id)
+                running[executor.submit(_render_range, (first_id, last_id, only_pending))] = (first_id, last_id)
+                # A few ranges queued per worker, without reading every id range ahead
+                if len(running) >= workers * 2:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finished(*running.pop(future), future.result())
+            for future in list(running):
+                finished(*running.pop(future), future.result())
+
+    checkpoint.clear()
+    seconds = time.perf_counter() - started
+    return {"rendered": rendered, "seconds": seconds, "rows_per_second": rendered / seconds if seconds else 0}
@@ -0,0 +1,314 @@
+import math
+import platform
+import random
+import time
+
+import django
+import pygments
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .forms import SnippetForm
+from .highlighting import highlight_cache, render
+from .lexers import lexer_choices
+from .models import Language, Snippet, count_snippets
+from .popularity import buffer, record_view
+from .tasks import indexSnippetTokens, renderSnippetHighlight, sendEmailInSnippetCreation
+
+# Characters of code of each size of snippet and its share of the dataset
+SIZES = (("small", 500, 0.7), ("medium", 5000, 0.25), ("large", 50000, 0.05))
+# Languages of the dataset, in this order, among the ones pygments knows
+LANGUAGES = (
+    "python", "javascript", "java", "c", "cpp", "go", "rust", "ruby", "php", "sql",
+    "html", "css", "bash", "typescript", "kotlin", "scala", "haskell", "lua", "perl", "yaml",
+)
+# Lines the code is made of, close enough to source code for every lexer to find some tokens
+CODE_LINES = (
+    "def function_{n}(value, *args):",
+    '    """ Returns the value number {n} """',
+    "    total = value * {n} + len(args)  # running total",
+    "    if total > {n}:",
+    '        return "string {n}"',
+    "    return total",
+    "",
+)
+# Below this relative change a timing is considered noise, see `compare`
+DEFAULT_TOLERANCE = 0.2
+
+
+def generate_code(rng, size):
+    lines = []
+    length = 0
+    while length < size:
+        line = CODE_LINES[len(lines) % len(CODE_LINES)].format(n=rng.randrange(10000))
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+
+def dataset_languages(count):
+    known = {alias for alias, name in lexer_choices()}
+    return [name for name in LANGUAGES if name in known][:count]
+
+
+def generate_dataset(snippets=5000, languages=12, users=50, seed=0):
+    """
+    Fills the database with a synthetic dataset, the same one for the same arguments:
+    `users` users and `snippets` snippets of the SIZES spread over `languages` languages,
+    80% of them public. The highlights and the token index are left pending.
+    """
+    rng = random.Random(seed)
+    language_rows = Language.objects.bulk_create(
+        [Language(name=name, slug=name) for name in dataset_languages(languages)]
+    )
+    User.objects.bulk_create([User(username="benchmark%s" % number) for number in range(users)])
+    user_rows = list(User.objects.filter(username__startswith="benchmark").order_by("id"))
+    sizes = [size for name, size, share in SIZES]
+    weights = [share for name, size, share in SIZES]
+    batch = []
+    for number in range(snippets):
+        batch.append(Snippet(
+            user=rng.choice(user_rows),
+            language=rng.choice(language_rows),
+            name="Snippet %s" % number,
+            description="Benchmark snippet number %s" % number,
+            snippet=generate_code(rng, rng.choices(sizes, weights)[0]),
+            public=rng.random() < 0.8,
+        ))
+        if len(batch) >= 1000:
+            insert_snippets(batch)
+            batch = []
+    insert_snippets(batch)
+    return {"snippets": snippets, "languages": len(language_rows), "users": users, "seed": seed}
+
+
+def insert_snippets(batch):
+    Snippet.objects.bulk_create(batch)
+    count_snippets([(snippet.user_id, snippet.language_id, snippet.public) for snippet in batch])
+
+
+def percentile(values, fraction):
+    """ Nearest rank percentile """
+    ordered = sorted(values)
+    return ordered[max(math.ceil(len(ordered) * fraction) - 1, 0)]
+
+
+def summarize(seconds, queries=None):
+    summary = {
+        "samples": len(seconds),
+        "p50_ms": percentile(seconds, 0.5) * 1000,
+        "p99_ms": percentile(seconds, 0.99) * 1000,
+        "mean_ms": sum(seconds) / len(seconds) * 1000,
+    }
+    if queries is not None:
+        summary["queries"] = max(queries)
+    return summary
+
+
+def measure(func, repeats):
+    """ Runs `func` `repeats` times and summarizes its time and its database queries """
+    seconds = []
+    queries = []
+    for _ in range(repeats):
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            func()
+            seconds.append(time.perf_counter() - started)
+        queries.append(len(captured))
+    return summarize(seconds, queries)
+
+
+def sample_snippets(rng, size_name, count=1):
+    """ Public snippets of one of the SIZES, the same ones for the same seed """
+    bounds = dict((name, size) for name, size, share in SIZES)
+    lower = max([size for size in bounds.values() if size < bounds[size_name]], default=0)
+    ids = list(
+        Snippet.objects.filter(public=True)
+        .annotate(code_size=F("code_blob__size"))
+        .filter(code_size__gt=lower, code_size__lte=bounds[size_name] + len(max(CODE_LINES, key=len)) + 10)
+        .order_by("id")
+        .values_list("id", flat=True)
+    )
+    return rng.sample(ids, min(count, len(ids)))
+
+
+def benchmark_views(rng, repeats):
+    """ Latency and queries of the main pages, with a logged in user so the page cache is skipped """
+    client = Client()
+    user = User.objects.filter(username__startswith="benchmark").order_by("id").first()
+    client.force_login(user)
+    language = Language.objects.order_by("id").first()
+    urls = {
+        "view:index": reverse("index"),
+        "view:language": reverse("language", args=[language.slug]),
+        "view:user_snippets": reverse("user_snippets", args=[user.username]),
+        "view:search": reverse("search") + "?q=function",
+        "view:trending": reverse("trending"),
+        "view:api_snippets": reverse("api_snippets") + "?fields=id,name,language",
+    }
+    for size_name, size, share in SIZES:
+        for snippet_id in sample_snippets(rng, size_name):
+            renderSnippetHighlight(snippet_id)
+            urls["view:snippet:%s" % size_name] = reverse("snippet", args=[snippet_id])
+
+    results = {}
+    for name, url in urls.items():
+        cache.clear()
+        # The first request loads templates and lexers, it isn't part of the measure
+        client.get(url)
+        results[name] = measure(lambda: client.get(url), repeats)
+
+    anonymous = Client()
+    anonymous.get(reverse("index"))
+    results["view:index:anonymous_cached"] = measure(lambda: anonymous.get(reverse("index")), repeats)
+    return results
+
+
+def benchmark_view_counts(rng, repeats):
+    """ What counting a view adds to the detail page, per hit, while the buffer isn't due """
+    snippet_ids = sample_snippets(rng, "small", 100)
+    if not snippet_ids:
+        return {}
+    hits = 1000
+    seconds = []
+    for _ in range(repeats):
+        buffer.take()
+        started = time.perf_counter()
+        for number in range(hits):
+            record_view(snippet_ids[number % len(snippet_ids)])
+        seconds.append((time.perf_counter() - started) / hits)
+    buffer.take()
+    return {"view_counts:record": summarize(seconds)}
+
+
+def benchmark_highlight(rng, repeats):
+    """
+    Time of the pygments pipeline, what `Snippet.highlight` costs on a cache miss, by size
+    and by language. Every language renders the same code of each size.
+    """
+    codes = {name: generate_code(rng, size) for name, size, share in SIZES}
+    by_size = {name: [] for name in codes}
+    by_language = {}
+    for language in Language.objects.order_by("id"):
+        lexer = language.get_lexer()
+        for size_name, code in codes.items():
+            render(code, lexer)
+            for _ in range(repeats):
+                started = time.perf_counter()
+                render(code, lexer)
+                seconds = time.perf_counter() - started
+                by_size[size_name].append((len(code), seconds))
+                by_language.setdefault(language.name, []).append((len(code), seconds))
+
+    results = {}
+    for prefix, groups in (("size", by_size), ("language", by_language)):
+        for name, timings in groups.items():
+            summary = summarize([seconds for characters, seconds in timings])
+            summary["characters_per_second"] = (
+                sum(characters for characters, seconds in timings) / sum(seconds for characters, seconds in timings)
+            )
+            results["highlight:%s:%s" % (prefix, name)] = summary
+    return results
+
+
+def benchmark_forms(rng, repeats):
+    """ Validation of the snippet form, with the query of the language choice """
+    language = Language.objects.order_by("id").first()
+    results = {}
+    for size_name, size, share in SIZES:
+        data = {
+            "name": "Benchmark",
+            "description": "Form validation",
+            "language": language.id,
+            "public": True,
+            "snippet": generate_code(rng, size),
+        }
+        results["form:%s" % size_name] = measure(lambda: SnippetForm(data).is_valid(), repeats)
+    return results
+
+
+def benchmark_tasks(rng, repeats):
+    """
+    Cost of the tasks as they run in eager mode, each time on a snippet that hasn't
+    been rendered yet and with an empty highlight cache, so every run does the work.
+    """
+    results = {}
+    for size_name, size, share in SIZES:
+        seconds = []
+        for snippet_id in sample_snippets(rng, size_name, repeats):
+            cache.clear()
+            highlight_cache.clear()
+            started = time.perf_counter()
+            renderSnippetHighlight.delay(snippet_id)
+            seconds.append(time.perf_counter() - started)
+        if seconds:
+            results["task:renderSnippetHighlight:%s" % size_name] = summarize(seconds)
+
+    snippet_ids = iter(sample_snippets(rng, "small", repeats))
+    results["task:indexSnippetTokens"] = measure(lambda: indexSnippetTokens.delay(next(snippet_ids)), repeats)
+    results["task:sendEmailInSnippetCreation"] = measure(
+        lambda: sendEmailInSnippetCreation.delay("Benchmark", "Email task", "benchmark@example.com"), repeats
+    )
+    return results
+
+
+def run_benchmarks(repeats=20, seed=0, dataset=None):
+    """
+    Runs every benchmark over the current database, which should hold the dataset of
+    `generate_dataset`. Returns the results, keyed by benchmark, with the metadata
+    needed to tell whether two runs are comparable.
+    """
+    rng = random.Random(seed)
+    benchmarks = {}
+    benchmarks.update(benchmark_tasks(rng, repeats))
+    benchmarks.update(benchmark_views(rng, repeats))
+    benchmarks.update(benchmark_view_counts(rng, repeats))
+    benchmarks.update(benchmark_highlight(rng, repeats))
+    benchmarks.update(benchmark_forms(rng, repeats))
+    return {
+        "metadata": {
+            "created": timezone.now().isoformat(),
+            "dataset": dataset,
+            "repeats": repeats,
+            "seed": seed,
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "pygments": pygments.__version__,
+            "database": connection.vendor,
+        },
+        "benchmarks": benchmarks,
+    }
+
+
+def compare(baseline, current, tolerance=DEFAULT_TOLERANCE):
+    """
+    Regressions of `current` against `baseline`: timings more than `tolerance` slower,
+    throughputs more than `tolerance` lower and any additional query. Returns a list
+    of (benchmark, metric, baseline value, current value).
+    """
+    regressions = []
+    for name, metrics in sorted(current["benchmarks"].items()):
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            continue
+        for metric, value in sorted(metrics.items()):
+            previous = base.get(metric)
+            if previous is None:
+                continue
+            if metric == "queries":
+                regressed = value > previous
+            elif metric.endswith("_ms"):
+                regressed = value > previous * (1 + tolerance)
+            elif metric.endswith("_per_second"):
+                regressed = value < previous * (1 - tolerance)
+            else:
+                regressed = False
+            if regressed:
+                regressions.append((name, metric, previous, value))
+    return regressions
@@ -0,0 +1,195 @@
+import hashlib
+import time
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+from .metrics import cache_lookup
+
+PAGE_PREFIX = "page"
+VERSION_PREFIX = "page-version"
+REVALIDATE_PREFIX = "page-revalidate"
+# Every cached page shows language names, so they all depend on this scope
+LANGUAGES_SCOPE = "languages"
+# Scope of the trending listing, every flush of the view counts invalidates it
+TRENDING_SCOPE = "trending"
+# Scope of the pages with the language sidebar, invalidated when its public counts change
+SIDEBAR_SCOPE = "sidebar"
+
+
+def scope_versions(scopes):
+    """
+    Current version of each scope. A missing version starts from the current time, so
+    a version evicted from the cache never brings back pages cached before it.
+    """
+    keys = ["%s:%s" % (VERSION_PREFIX, scope) for scope in scopes]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, time.time_ns(), None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def invalidate(*scopes):
+    """ Bumps the version of the scopes, the pages cached under the previous one are never read again """
+    for scope in set(scopes):
+        key = "%s:%s" % (VERSION_PREFIX, scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, time.time_ns(), None)
+
+
+def page_key(request, scopes):
+    versions = scope_versions(scopes)
+    url = hashlib.md5(request.get_full_path().encode("utf-8")).hexdigest()
+    return "%s:%s:%s" % (PAGE_PREFIX, url, ":".join(str(version) for version in versions))
+
+
+def listing_etag(request, snippets, *extra):
+    """
+    ETag of a page that shows the given snippets. It changes with the `updated` of
+    every snippet, the names shown next to it, the authenticated user and whatever
+    `extra` the view passes, such as the cursors of the page.
+
+    Listings have no Last-Modified: a snippet that is deleted or made private leaves
+    the page with older snippets only, a date can't tell that it changed.
+    """
+    parts = [str(request.user.pk)]
+    parts.extend(str(value) for value in extra)
+    for snippet in snippets:
+        parts.append("%s:%s:%s:%s" % (
+            snippet.pk, snippet.updated.isoformat(), snippet.user.username, snippet.language.name
+        ))
+    return quote_etag(hashlib.md5("|".join(parts).encode("utf-8")).hexdigest())
+
+
+def snippet_validators(request, snippet, *extra):
+    """ ETag and Last-Modified, the `updated` of the snippet as a timestamp, of its page """
+    return listing_etag(request, [snippet], *extra), int(snippet.updated.timestamp())
+
+
+def conditional_page(request, etag, last_modified, render_page):
+    """
+    Answers with a 304 when the client already has the page, `render_page` is only
+    called when it doesn't. The validators are added to the rendered response.
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = render_page()
+    return add_validators(response, etag, last_modified)
+
+
+async def aconditional_page(request, etag, last_modified, render_page):
+    """ `conditional_page` with a coroutine function as `render_page` """
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = await render_page()
+    return add_validators(response, etag, last_modified)
+
+
+def add_validators(response, etag, last_modified):
+    response["ETag"] = etag
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified)
+    return response
+
+
+def cached_response(request, entry):
+    last_modified = entry.get("last_modified")
+    response = get_conditional_response(request, etag=entry["etag"], last_modified=last_modified)
+    if response is None:
+        response = HttpResponse(entry["content"], content_type=entry["content_type"])
+    response["ETag"] = entry["etag"]
+    if last_modified is not None:
+        response["Last-Modified"] = http_date(last_modified)
+    patch_cache_control(
+        response,
+        public=True,
+        max_age=settings.PAGE_CACHE_TIMEOUT,
+        stale_while_revalidate=settings.PAGE_CACHE_STALE,
+    )
+    return response
+
+
+def last_modified_timestamp(response):
+    if response.has_header("Last-Modified"):
+        return parse_http_date_safe(response["Last-Modified"])
+    return None
+
+
+def cached_page(request, scopes):
+    """
+    The cache key of the page and the cached response, None when the page has to be
+    rendered: it isn't cached, or it's stale and this request renders it again.
+    """
+    key = page_key(request, [LANGUAGES_SCOPE] + scopes)
+    entry = cache.get(key)
+    if entry is not None:
+        is_fresh = time.time() - entry["created"] < settings.PAGE_CACHE_TIMEOUT
+        if is_fresh or not cache.add("%s:%s" % (REVALIDATE_PREFIX, key), True, 30):
+            cache_lookup("page", True)
+            return key, cached_response(request, entry)
+    cache_lookup("page", False)
+    return key, None
+
+
+def store_page(request, key, response):
+    """ Caches a rendered page and returns the response to send """
+    if response.status_code != 200 or not getattr(response, "cacheable", True):
+        return response
+    entry = {
+        "content": response.content,
+        "content_type": response["Content-Type"],
+        "etag": response.get("ETag") or quote_etag(hashlib.md5(response.content).hexdigest()),
+        "last_modified": last_modified_timestamp(response),
+        "created": time.time(),
+    }
+    cache.set(key, entry, settings.PAGE_CACHE_TIMEOUT + settings.PAGE_CACHE_STALE)
+    cache.delete("%s:%s" % (REVALIDATE_PREFIX, key))
+    return cached_response(request, entry)
+
+
+def cache_anonymous_page(scopes):
+    """
+    Caches the whole page for anonymous visitors.
+
+    `scopes` receives the URL kwargs and returns the scopes the page depends on, the
+    signals in `signals.py` invalidate them when a snippet or a language changes.
+    A page is fresh for PAGE_CACHE_TIMEOUT seconds. After that, and for PAGE_CACHE_STALE
+    more seconds, one request renders it again while the others keep getting the stale
+    copy. Responses carry the ETag and Last-Modified set by the view, or an ETag from
+    the content, so revalidations get a 304 without a body.
+    Views can set `response.cacheable = False` to skip the cache for a response.
+    Async views are wrapped by an async function, see `decorators.async_method_decorator`.
+    """
+    def decorator(view_func):
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def _wrapped_async_view(request, *args, **kwargs):
+                user = await request.auser()
+                if request.method not in ("GET", "HEAD") or user.is_authenticated:
+                    return await view_func(request, *args, **kwargs)
+                key, response = await sync_to_async(cached_page)(request, scopes(**kwargs))
+                if response is None:
+                    response = await view_func(request, *args, **kwargs)
+                    response = await sync_to_async(store_page)(request, key, response)
+                return response
+            return _wrapped_async_view
+
+        @wraps(view_func)
+        def _wrapped_view(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD") or request.user.is_authenticated:
+                return view_func(request, *args, **kwargs)
+            key, response = cached_page(request, scopes(**kwargs))
+            if response is None:
+                response = store_page(request, key, view_func(request, *args, **kwargs))
+            return response
+        return _wrapped_view
+    return decorator
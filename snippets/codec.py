@@ -0,0 +1,74 @@
+import codecs
+import zlib
+
+# zlib only uses the last 32KB of a preset dictionary
+DICTIONARY_SIZE = 32 * 1024
+LEVEL = 6
+# Compressed bytes decoded at a time when only a part of the code is read
+READ_SIZE = 64 * 1024
+
+
+def train_dictionary(samples, size=DICTIONARY_SIZE):
+    """
+    Preset dictionary for zlib from a sample of snippets: the most common lines,
+    the most frequent last since zlib finds the closest matches cheaper.
+    """
+    counts = {}
+    for sample in samples:
+        for line in set(sample.splitlines()):
+            line = line.strip()
+            if len(line) > 3:
+                counts[line] = counts.get(line, 0) + 1
+    dictionary = b""
+    for line in sorted(counts, key=lambda line: (counts[line], len(line)), reverse=True):
+        if counts[line] < 2:
+            break
+        encoded = line.encode("utf-8") + b"\n"
+        if len(dictionary) + len(encoded) > size:
+            break
+        dictionary = encoded + dictionary
+    return dictionary
+
+
+def compress(code, dictionary=b""):
+    """ The code compressed with zlib and the preset dictionary, if any """
+    stream = zlib.compressobj(LEVEL, zdict=dictionary) if dictionary else zlib.compressobj(LEVEL)
+    return stream.compress(code.encode("utf-8")) + stream.flush()
+
+
+def decompress_chunks(data, dictionary=b""):
+    """ The code of `compress` back, decoded a piece at a time """
+    stream = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    data = bytes(data)
+    while data:
+        text = decoder.decode(stream.decompress(data, READ_SIZE))
+        data = stream.unconsumed_tail
+        if text:
+            yield text
+    text = decoder.decode(stream.flush(), final=True)
+    if text:
+        yield text
+
+
+def decompress(data, dictionary=b""):
+    return "".join(decompress_chunks(data, dictionary))
+
+
+def decompress_range(data, dictionary, start, length):
+    """
+    `length` characters of the code from the character `start`, like a SUBSTR of the
+    plain text. Stops decompressing once it has them.
+    """
+    pieces, skipped, read = [], 0, 0
+    for text in decompress_chunks(data, dictionary):
+        if skipped + len(text) <= start:
+            skipped += len(text)
+            continue
+        text = text[max(start - skipped, 0):]
+        skipped = start
+        pieces.append(text[:length - read])
+        read += len(pieces[-1])
+        if read >= length:
+            break
+    return "".join(pieces)
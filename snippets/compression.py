@@ -0,0 +1,112 @@
+import time
+
+from django.db import connection
+
+from .codec import compress, decompress, train_dictionary
+from .models import CodeBlob, CodeDictionary, HighlightBlob
+from .search import reindex_code
+
+# Columns that hold the bulk of the data, the code, plain or compressed, and its highlighted HTML
+COMPRESSED_COLUMNS = ((CodeBlob, "code"), (CodeBlob, "compressed"), (HighlightBlob, "html"))
+
+# Bytes of the values and bytes actually stored, after the compression of the database if any
+COLUMN_SIZE_SQL = {
+    "postgresql": "SELECT coalesce(sum(octet_length({column})), 0), coalesce(sum(pg_column_size({column})), 0) FROM {table}",
+    "sqlite": "SELECT coalesce(sum(length(CAST({column} AS BLOB))), 0), coalesce(sum(length(CAST({column} AS BLOB))), 0) FROM {table}",
+}
+
+
+def column_sizes():
+    """ {"table.column": (value bytes, stored bytes)} of the big columns """
+    sizes = {}
+    with connection.cursor() as cursor:
+        for model, column in COMPRESSED_COLUMNS:
+            table = model._meta.db_table
+            cursor.execute(COLUMN_SIZE_SQL[connection.vendor].format(table=table, column=column))
+            sizes["%s.%s" % (table, column)] = tuple(cursor.fetchone())
+    return sizes
+
+
+def sample_codes(size):
+    """ The code of `size` blobs picked at random """
+    blobs = CodeBlob.objects.order_by("?").only("code", "compressed", "dictionary")[:size]
+    return [blob.text for blob in blobs]
+
+
+def create_dictionary(sample_size=1000):
+    """ A new `CodeDictionary` trained on a sample of the code blobs """
+    return CodeDictionary.objects.create(data=train_dictionary(sample_codes(sample_size)))
+
+
+def compress_blobs(first_id, last_id, dictionary_id):
+    """
+    Compresses the code blobs of an id range with a dictionary, the ones compressed
+    with another one again. Returns how many are stored compressed with it.
+    SQLite indexes their words again in `search.rebuild_search_index`.
+    """
+    blobs = list(
+        CodeBlob.objects.filter(id__gte=first_id, id__lte=last_id)
+        .exclude(dictionary_id=dictionary_id)
+        .only("code", "compressed", "dictionary")
+    )
+    compressed = [blob for blob in blobs if blob.compress(dictionary_id)]
+    CodeBlob.objects.bulk_update(blobs, ["code", "compressed", "dictionary", "search_words"])
+    reindex_code(first_id, last_id)
+    return len(compressed)
+
+
+def decompress_blobs(first_id, last_id):
+    """ Stores the code blobs of an id range plain again, returns how many """
+    blobs = list(
+        CodeBlob.objects.filter(id__gte=first_id, id__lte=last_id, compressed__isnull=False)
+        .only("code", "compressed", "dictionary")
+    )
+    for blob in blobs:
+        blob.decompress()
+    CodeBlob.objects.bulk_update(blobs, ["code", "compressed", "dictionary", "search_words"])
+    reindex_code(first_id, last_id)
+    return len(blobs)
+
+
+def benchmark(sample_size=1000):
+    """
+    Compares the size and the decode time of the code of a sample of blobs with the
+    codec of SNIPPET_CODE_COMPRESSION, with and without a dictionary trained on another
+    sample, and reads the blobs already stored compressed like the views do.
+    """
+    codes = sample_codes(sample_size * 2)
+    training, sample = codes[::2], codes[1::2]
+    dictionary = train_dictionary(training)
+    raw_bytes = sum(len(code.encode("utf-8")) for code in sample)
+    results = {"snippets": len(sample), "raw_bytes": raw_bytes, "dictionary_bytes": len(dictionary)}
+
+    for name, preset in (("zlib", b""), ("zlib_dictionary", dictionary)):
+        compressed = [compress(code, preset) for code in sample]
+        started = time.perf_counter()
+        for data in compressed:
+            decompress(data, preset)
+        seconds = time.perf_counter() - started
+        results[name] = {
+            "bytes": sum(len(data) for data in compressed),
+            "decode_microseconds": seconds / len(compressed) * 1e6 if compressed else 0,
+        }
+
+    stored = list(
+        CodeBlob.objects.filter(compressed__isnull=False)
+        .order_by("?")
+        .values_list("size", "compressed", "dictionary")[:sample_size]
+    )
+    for size, data, dictionary_id in stored:
+        # Read once by each process, out of the timing
+        CodeDictionary.load(dictionary_id)
+    started = time.perf_counter()
+    for size, data, dictionary_id in stored:
+        CodeBlob.read(data, dictionary_id)
+    seconds = time.perf_counter() - started
+    results["stored"] = {
+        "snippets": len(stored),
+        "characters": sum(size for size, data, dictionary_id in stored),
+        "bytes": sum(len(data) for size, data, dictionary_id in stored),
+        "decode_microseconds": seconds / len(stored) * 1e6 if stored else 0,
+    }
+    return results
@@ -0,0 +1,43 @@
+from django.db import connection, transaction
+from django.db.models import Count, Q
+
+from .caching import SIDEBAR_SCOPE, invalidate
+from .models import LanguageCounter, Snippet, UserCounter
+
+# Counter model and the snippet column it counts by
+COUNTERS = ((LanguageCounter, "language_id"), (UserCounter, "user_id"))
+
+
+def table_counts(snippets, field):
+    """ {value of `field`: (total, public)} counted from the snippets table """
+    rows = (
+        snippets.order_by()
+        .values(field)
+        .annotate(total=Count("id"), public_total=Count("id", filter=Q(public=True)))
+    )
+    return {row[field]: (row["total"], row["public_total"]) for row in rows}
+
+
+def reconcile_counters(repair=False):
+    """
+    Compares every counter with a count of the snippets table and returns the ones
+    that drifted as (counter, pk, stored, actual). With `repair` they are rewritten,
+    on Postgres while the writes of snippets wait so no change lands in between.
+    """
+    drift = []
+    with transaction.atomic():
+        if repair and connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("LOCK TABLE %s IN SHARE MODE" % Snippet._meta.db_table)
+        for counter, field in COUNTERS:
+            actual = table_counts(Snippet.objects.all(), field)
+            stored = {pk: (total, public) for pk, total, public in counter.objects.values_list("pk", "total", "public")}
+            for pk in sorted(set(actual) | set(stored)):
+                if stored.get(pk, (0, 0)) != actual.get(pk, (0, 0)):
+                    drift.append((counter.__name__, pk, stored.get(pk), actual.get(pk, (0, 0))))
+                    if repair:
+                        total, public = actual.get(pk, (0, 0))
+                        counter.objects.update_or_create(pk=pk, defaults={"total": total, "public": public})
+    if repair and drift:
+        invalidate(SIDEBAR_SCOPE)
+    return drift
@@ -1,19 +1,43 @@
-from functools import wraps
-from django.shortcuts import redirect, get_object_or_404
-from .models import Snippet
-from .utils import is_the_owner
+from functools import partial, wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.shortcuts import redirect
+from django.utils.decorators import method_decorator
+
+from .utils import get_snippet_or_404, is_snippet_owner
 
 def owner_required(view_func):
     """
     Decorador para verificar si el usuario autenticado es el dueño del snippet.
     Si no es el dueño, lo redirige a la página de inicio.
+    Si lo es, le pasa a la vista el snippet ya cargado en `kwargs["snippet"]`.
     """
     @wraps(view_func)
     def _wrapped_view(request, *args, **kwargs):
-        snippet = get_object_or_404(Snippet, id=kwargs["id"])
-        is_owner = is_the_owner(request, snippet.user.username)
-        if not is_owner:
+        snippet = get_snippet_or_404(kwargs["id"])
+        if not is_snippet_owner(request, snippet):
             return redirect("index")
+        kwargs["snippet"] = snippet
         return view_func(request, *args, **kwargs)
     
-    return _wrapped_view
\ No newline at end of file
+    return _wrapped_view
+
+
+def async_method_decorator(decorator, name):
+    """
+    Como `method_decorator`, pero el método `name` sigue siendo async.
+    El de Django 5.1 lo envuelve en una función sync y la vista entera pasa a ser sync.
+    """
+    def class_decorator(cls):
+        method = getattr(cls, name)
+        if not iscoroutinefunction(method):
+            return method_decorator(decorator, name=name)(cls)
+
+        @wraps(method)
+        async def _wrapper(self, *args, **kwargs):
+            bound_method = wraps(method)(partial(method.__get__(self, type(self))))
+            return await decorator(bound_method)(*args, **kwargs)
+
+        setattr(cls, name, _wrapper)
+        return cls
+    return class_decorator
@@ -1,9 +1,20 @@
-from django.forms import ModelForm, Select, Textarea, TextInput
+from django.forms import CharField, ModelForm, Select, Textarea, TextInput
 
 from .models import Snippet
 
 
 class SnippetForm(ModelForm):
+    # The code is kept in a CodeBlob, see Snippet.snippet
+    snippet = CharField(
+        label="Snippet",
+        widget=Textarea(
+            attrs={
+                "class": "form-control",
+                "placeholder": "/* Código del snippet */",
+            }
+        ),
+    )
+
     class Meta:
         model = Snippet
         fields = ["name", "description", "language", "public", "snippet"]
@@ -12,7 +23,6 @@ class SnippetForm(ModelForm):
             "description": "Descripción",
             "language": "Lenguaje",
             "public": "Público",
-            "snippet": "Snippet",
         }
         widgets = {
             "name": TextInput(
@@ -25,10 +35,13 @@ class SnippetForm(ModelForm):
                 }
             ),
             "language": Select(attrs={"class": "form-control"}),
-            "snippet": Textarea(
-                attrs={
-                    "class": "form-control",
-                    "placeholder": "/* Código del snippet */",
-                }
-            ),
         }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk is not None:
+            self.initial.setdefault("snippet", self.instance.snippet)
+
+    def save(self, commit=True):
+        self.instance.snippet = self.cleaned_data["snippet"]
+        return super().save(commit)
@@ -0,0 +1,270 @@
+import asyncio
+import hashlib
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+import pygments
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.html import escape
+
+from pygments import formatters, highlight, lexers
+from pygments.util import ClassNotFound
+
+from .metrics import cache_lookup
+
+# Options used to render a snippet in the detail page
+HIGHLIGHT_OPTIONS = {"linenos": True}
+
+# Size tiers, see size_tier
+FULL = "full"
+PAGED = "paged"
+RAW = "raw"
+
+
+class PygmentsRegistry:
+    """
+    Process wide registry of ready to use lexers and formatters.
+
+    Lexers are resolved once per language name, including the fallback to "text" when
+    pygments doesn't know the name, and formatters once per set of options. Both are
+    only read while rendering so the same instances are shared by every thread.
+    Celery prefork children fill their own copy after the fork.
+    """
+
+    def __init__(self):
+        self._lexers = {}
+        self._formatters = {}
+        self._lock = threading.Lock()
+
+    def lexer(self, name):
+        lexer = self._lexers.get(name)
+        if lexer is None:
+            try:
+                lexer = lexers.get_lexer_by_name(name)
+            except ClassNotFound:
+                # Return "text" if not found the lexer
+                lexer = lexers.get_lexer_by_name("text")
+            with self._lock:
+                lexer = self._lexers.setdefault(name, lexer)
+        return lexer
+
+    def formatter(self, options=HIGHLIGHT_OPTIONS):
+        key = tuple(sorted(options.items()))
+        formatter = self._formatters.get(key)
+        if formatter is None:
+            with self._lock:
+                formatter = self._formatters.setdefault(key, formatters.HtmlFormatter(**options))
+        return formatter
+
+    def invalidate(self, name=None):
+        """ Forgets the lexer of a language name, or every lexer and formatter """
+        with self._lock:
+            if name is None:
+                self._lexers.clear()
+                self._formatters.clear()
+            else:
+                self._lexers.pop(name, None)
+
+
+registry = PygmentsRegistry()
+
+
+def render(code, lexer, options=HIGHLIGHT_OPTIONS):
+    """ Runs the pygments pipeline for the given code """
+    return highlight(code, lexer, registry.formatter(options))
+
+
+def _render_in_pool(code, language_name, options):
+    return render(code, registry.lexer(language_name), options)
+
+
+def setup_worker(database):
+    """
+    Initializer of the processes that render from the database. `database` is the
+    `settings_dict` of the connection of the process that started them, used when it
+    isn't the configured one. It lives here because unpickling it can't import the
+    models before Django is set up.
+    """
+    if database["NAME"] != settings.DATABASES["default"]["NAME"]:
+        settings.DATABASES["default"] = database
+    django.setup()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def highlight_pool():
+    """
+    Bounded pool of HIGHLIGHT_WORKERS processes where the async views render, so a
+    big snippet neither blocks the event loop nor holds the GIL of the server.
+    Started on first use, spawned since forking a running event loop isn't safe.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                settings.HIGHLIGHT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=django.setup,
+            )
+    return _pool
+
+
+async def arender(code, language_name, options=HIGHLIGHT_OPTIONS):
+    """ `render` in the highlight pool """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(highlight_pool(), _render_in_pool, code, language_name, options)
+
+
+def size_tier(size):
+    """
+    How a snippet of `size` characters is shown: FULL highlights all of it, PAGED
+    highlights HIGHLIGHT_PAGE_LINES lines at a time and RAW doesn't highlight it.
+    """
+    if size <= settings.HIGHLIGHT_MAX_SIZE:
+        return FULL
+    if size <= settings.SNIPPET_RAW_SIZE:
+        return PAGED
+    return RAW
+
+
+def page_size():
+    """ Most characters in a page of lines, never more than the detail page loads """
+    return min(settings.HIGHLIGHT_PAGE_SIZE, settings.HIGHLIGHT_MAX_SIZE)
+
+
+def line_page(code, complete=True):
+    """
+    The page of lines `code` starts with: up to HIGHLIGHT_PAGE_LINES lines and no more
+    than `page_size()` characters. It ends at the end of a line unless a single line is
+    longer than a page, then the next page goes on with the rest of that line.
+    `complete` says whether `code` runs until the end of the snippet, otherwise it's a
+    piece read from the database and a last line without its end is left for the next
+    page. Returns the page and the number of line ends in it.
+    """
+    size = page_size()
+    chunk = code[:size]
+    end = lines = 0
+    while lines < settings.HIGHLIGHT_PAGE_LINES:
+        newline = chunk.find("\n", end)
+        if newline == -1:
+            break
+        end = newline + 1
+        lines += 1
+    if lines < settings.HIGHLIGHT_PAGE_LINES and complete and len(code) <= size:
+        # The last line of the snippet, which has no line end
+        end = len(chunk)
+    elif not end:
+        end = len(chunk)
+    return chunk[:end], lines
+
+
+def render_plain(code):
+    """ Cheap fallback shown while the highlight of a snippet is pending """
+    return '<div class="highlight"><pre>%s</pre></div>' % escape(code)
+
+
+class HighlightCache:
+    """
+    Two tier cache for the highlighted HTML of the snippets.
+
+    The first tier is a bounded LRU that lives in the process, the second one is the
+    shared django cache (redis in production) so every worker reuses the same render.
+    Keys are built from the hash of the code, the language, the formatter options and
+    the pygments version, so an edited snippet never gets the HTML of its previous
+    version, nor a snippet the HTML of another pygments.
+    """
+
+    def __init__(self, maxsize, timeout, prefix="highlight"):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.prefix = prefix
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def key(self, code, language_name, options=HIGHLIGHT_OPTIONS):
+        digest = hashlib.sha256(code.encode("utf-8")).hexdigest()
+        flags = ",".join("%s=%s" % item for item in sorted(options.items()))
+        return "%s:%s:%s:%s:%s" % (self.prefix, pygments.__version__, language_name, flags, digest)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._local:
+                self._local.move_to_end(key)
+                self.local_hits += 1
+                cache_lookup("highlight", True)
+                return self._local[key]
+        html = cache.get(key)
+        cache_lookup("highlight", html is not None)
+        if html is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.shared_hits += 1
+        self._remember(key, html)
+        return html
+
+    def set(self, key, html):
+        cache.set(key, html, self.timeout)
+        self._remember(key, html)
+
+    def delete(self, key):
+        cache.delete(key)
+        with self._lock:
+            self._local.pop(key, None)
+
+    def get_or_render(self, code, language, options=HIGHLIGHT_OPTIONS, refresh=False):
+        """ With `refresh` the code is rendered again and replaces the cached HTML """
+        key = self.key(code, language.name, options)
+        html = None if refresh else self.get(key)
+        if html is None:
+            html = render(code, language.get_lexer(), options)
+            self.set(key, html)
+        return html
+
+    async def aget_or_render(self, code, language, options=HIGHLIGHT_OPTIONS):
+        """ `get_or_render` for the async views, misses are rendered in the highlight pool """
+        key = self.key(code, language.name, options)
+        html = await sync_to_async(self.get)(key)
+        if html is None:
+            html = await arender(code, language.name, options)
+            await sync_to_async(self.set)(key, html)
+        return html
+
+    def stats(self):
+        with self._lock:
+            return {
+                "local_hits": self.local_hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "local_size": len(self._local),
+            }
+
+    def clear(self):
+        """ Empties the local tier and resets the counters """
+        with self._lock:
+            self._local.clear()
+            self.local_hits = self.shared_hits = self.misses = 0
+
+    def _remember(self, key, html):
+        with self._lock:
+            self._local[key] = html
+            self._local.move_to_end(key)
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+
+
+highlight_cache = HighlightCache(
+    maxsize=settings.HIGHLIGHT_CACHE_SIZE,
+    timeout=settings.HIGHLIGHT_CACHE_TIMEOUT,
+)
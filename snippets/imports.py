@@ -0,0 +1,260 @@
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+
+from pygments import format as format_tokens
+from pygments.lexers import find_lexer_class_for_filename
+
+from .caching import invalidate
+from .forms import SnippetForm
+from .highlighting import FULL, HIGHLIGHT_OPTIONS, registry, setup_worker, size_tier
+from .mail import queue_email
+from .models import HighlightBlob, Language, Snippet, SnippetToken, count_snippets
+from .tokens import tokens_from_stream
+
+logger = logging.getLogger(__name__)
+
+IMPORT_BATCH_SIZE = 1000
+# Names listed in the summary email, the rest are only counted
+SUMMARY_MAX_NAMES = 20
+
+
+def read_ndjson(path):
+    """ One snippet per line: name, description, language (slug), public, snippet and optionally user """
+    with open(path, encoding="utf-8") as lines:
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_directory(path):
+    """ One snippet per source file, the language is guessed from the file name """
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for filename in sorted(files):
+            file_path = os.path.join(root, filename)
+            lexer = find_lexer_class_for_filename(filename)
+            with open(file_path, encoding="utf-8", errors="replace") as source:
+                yield {
+                    "name": os.path.relpath(file_path, path),
+                    "snippet": source.read(),
+                    "language": list(lexer.aliases) if lexer else [],
+                }
+
+
+def read_source(path):
+    return read_directory(path) if os.path.isdir(path) else read_ndjson(path)
+
+
+def prerender(code, language_name):
+    """
+    Highlighted HTML and token set of a snippet, from a single pass of the lexer.
+    Runs in the worker processes of the import, so it only takes and returns plain values.
+    """
+    stream = list(registry.lexer(language_name).get_tokens(code))
+    html = format_tokens(stream, registry.formatter(HIGHLIGHT_OPTIONS))
+    return html, tokens_from_stream(stream)
+
+
+def _prerender(args):
+    return prerender(*args)
+
+
+class SnippetImporter:
+    """
+    Creates snippets in bulk from an iterable of dicts.
+
+    Rows are validated with the rules of the SnippetForm fields, without the query
+    the form does for the language: languages are resolved by slug, or by lexer name,
+    from a map loaded once. Valid rows are inserted with bulk_create, IMPORT_BATCH_SIZE
+    at a time, together with the highlight and the token index, which are rendered in
+    `workers` processes. With render=False both are left for later: the highlight is
+    rendered on the first view and the tokens by `rebuild_token_index`.
+    Each user gets one email with the summary of the snippets imported for them.
+    """
+
+    def __init__(self, user=None, public=False, batch_size=IMPORT_BATCH_SIZE, render=True, workers=1, notify=True):
+        self.user = user
+        # Values of the fields a row leaves out
+        self.defaults = {"public": public}
+        self.batch_size = batch_size
+        self.render = render
+        self.workers = workers
+        self.notify = notify
+        languages = list(Language.objects.all())
+        self.languages = {language.name: language for language in languages}
+        self.languages.update((language.slug, language) for language in languages)
+        self.users = {user.username: user} if user else {}
+        # Per user, the number of snippets imported and the first names for the summary
+        self.imported = {}
+        self.scopes = set()
+        self.errors = []
+        self.created = 0
+
+    def run(self, rows):
+        started = time.perf_counter()
+        executor = None
+        if self.render and self.workers > 1:
+            # Spawned like the ones of the backfill, a forked worker would share the database
+            # connection and the threads of this process
+            executor = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=setup_worker,
+                initargs=(dict(connection.settings_dict),),
+            )
+        try:
+            batch = []
+            for number, row in enumerate(rows, 1):
+                snippet = self.build(number, row)
+                if snippet is not None:
+                    batch.append(snippet)
+                if len(batch) >= self.batch_size:
+                    self.insert(batch, executor)
+                    batch = []
+            if batch:
+                self.insert(batch, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self.finish()
+
+        seconds = time.perf_counter() - started
+        rate = self.created / seconds if seconds else 0
+        logger.info("Imported %s snippets (%s failed) in %.2fs, %.1f snippets/s", self.created, len(self.errors), seconds, rate)
+        return {
+            "created": self.created,
+            "failed": len(self.errors),
+            "errors": self.errors,
+            "seconds": seconds,
+            "snippets_per_second": rate,
+        }
+
+    def build(self, number, row):
+        """ A valid unsaved Snippet for the row, or None after recording its errors """
+        errors = []
+        data = {}
+        for name in SnippetForm._meta.fields:
+            if name == "language":
+                continue
+            try:
+                data[name] = SnippetForm.base_fields[name].clean(row.get(name, self.defaults.get(name)))
+            except ValidationError as error:
+                errors.append("%s: %s" % (name, " ".join(error.messages)))
+        language = self.language(row.get("language"))
+        if language is None:
+            errors.append("language: unknown language %r" % (row.get("language"),))
+        user = self.owner(row.get("user"))
+        if user is None:
+            errors.append("user: unknown user %r" % (row.get("user"),))
+        if errors:
+            self.errors.append((number, errors))
+            return None
+        return Snippet(user=user, language=language, **data)
+
+    def language(self, value):
+        # Files from a directory carry every alias of the lexer that matched their name
+        for candidate in value if isinstance(value, list) else [value]:
+            if candidate in self.languages:
+                return self.languages[candidate]
+        return None
+
+    def owner(self, username):
+        if not username:
+            return self.user
+        if username not in self.users:
+            self.users[username] = User.objects.filter(username=username).first()
+        return self.users[username]
+
+    def insert(self, batch, executor):
+        tokens = []
+        renders = {}
+        if self.render:
+            # Bigger snippets are highlighted a page at a time when they are shown
+            rendered = [
+                (snippet, snippet.highlight_digest())
+                for snippet in batch
+                if size_tier(len(snippet.snippet)) == FULL
+            ]
+            # Identical snippets are lexed once
+            jobs = {}
+            for snippet, digest in rendered:
+                jobs.setdefault(digest, (snippet.snippet, snippet.language.name))
+            if executor is not None:
+                results = executor.map(_prerender, jobs.values(), chunksize=max(len(jobs) // (self.workers * 4), 1))
+            else:
+                results = map(_prerender, jobs.values())
+            renders = dict(zip(jobs, results))
+            for snippet, digest in rendered:
+                tokens.append((snippet, renders[digest][1]))
+
+        with transaction.atomic():
+            if renders:
+                self.attach_blobs(rendered, renders)
+            Snippet.objects.bulk_create(batch)
+            count_snippets([(snippet.user_id, snippet.language_id, snippet.public) for snippet in batch])
+            if renders:
+                self.count_references([snippet for snippet, digest in rendered])
+            if tokens:
+                SnippetToken.objects.bulk_create(
+                    [
+                        SnippetToken(snippet=snippet, token=token, kind=kind)
+                        for snippet, snippet_tokens in tokens
+                        for token, kind in snippet_tokens
+                    ],
+                    ignore_conflicts=True,
+                )
+
+        self.created += len(batch)
+        for snippet in batch:
+            summary = self.imported.setdefault(snippet.user, [0, []])
+            summary[0] += 1
+            if len(summary[1]) < SUMMARY_MAX_NAMES:
+                summary[1].append(snippet.name)
+            self.scopes.add("user:%s" % snippet.user.username)
+            if snippet.public:
+                self.scopes.update(("index", "language:%s" % snippet.language.slug))
+
+    def attach_blobs(self, snippets, renders):
+        """
+        Points the (snippet, digest) pairs to the blobs of their highlights, creating
+        the ones that don't exist yet.
+        """
+        HighlightBlob.objects.bulk_create(
+            [HighlightBlob(digest=digest, html=html) for digest, (html, tokens) in renders.items()],
+            ignore_conflicts=True,
+        )
+        blobs = dict(HighlightBlob.objects.filter(digest__in=renders).values_list("digest", "id"))
+        for snippet, digest in snippets:
+            snippet.highlight_blob_id = blobs[digest]
+
+    def count_references(self, snippets):
+        counts = {}
+        for snippet in snippets:
+            counts[snippet.highlight_blob_id] = counts.get(snippet.highlight_blob_id, 0) + 1
+        HighlightBlob.add_references(counts)
+
+    def finish(self):
+        """ Invalidates the cached pages that list the new snippets and sends the summaries """
+        invalidate(*self.scopes)
+        if not self.notify:
+            return
+        for user, (count, names) in self.imported.items():
+            if not user.email:
+                continue
+            body = "The following snippets were imported:\n" + "\n".join(names)
+            if count > len(names):
+                body += "\n... and %s more" % (count - len(names))
+            queue_email("%s snippets imported successfully" % count, body, user.email)
+
+
+def import_snippets(path, user=None, **options):
+    """ Imports the snippets of a NDJSON file or a directory of source files """
+    return SnippetImporter(user, **options).run(read_source(path))
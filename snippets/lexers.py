@@ -0,0 +1,38 @@
+import json
+import os
+from functools import cache
+
+import pygments
+from pygments.lexers import get_all_lexers
+
+# Table of (alias, name) of every lexer, generated at build time by `manage.py build_lexer_catalogue`
+CATALOGUE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lexer_catalogue.json")
+
+
+def build_catalogue():
+    """ Walks every lexer of pygments and its plugins, it takes a few hundred milliseconds """
+    return [[lexer[1][0], lexer[0]] for lexer in get_all_lexers() if lexer[1]]
+
+
+def write_catalogue(path=CATALOGUE_PATH):
+    with open(path, "w") as catalogue:
+        json.dump({"pygments": pygments.__version__, "lexers": build_catalogue()}, catalogue, separators=(",", ":"))
+
+
+@cache
+def lexer_choices():
+    """
+    Choices of `Language.name`, built the first time they are needed and shared by the
+    whole process. The precomputed table is used while it matches the installed pygments,
+    otherwise the lexers are walked again.
+    """
+    try:
+        with open(CATALOGUE_PATH) as catalogue:
+            data = json.load(catalogue)
+    except (OSError, ValueError):
+        data = {}
+    if data.get("pygments") == pygments.__version__:
+        lexers = data["lexers"]
+    else:
+        lexers = build_catalogue()
+    return tuple((alias, name) for alias, name in lexers)
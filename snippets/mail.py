@@ -0,0 +1,124 @@
+import logging
+import smtplib
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import EmailNotification
+
+logger = logging.getLogger(__name__)
+
+# Time a batch is reserved for the worker that took it, so another one doesn't send it again
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+
+def queue_email(subject, body, recipient):
+    """ Leaves an email to be sent with the next batch """
+    return EmailNotification.objects.create(subject=subject, body=body, recipient=recipient)
+
+
+def pending_emails():
+    return EmailNotification.objects.filter(
+        next_attempt__lte=timezone.now(),
+        attempts__lt=settings.EMAIL_MAX_ATTEMPTS,
+    )
+
+
+def claim_batch(batch_size):
+    """ Takes the next batch of pending emails, skipping the ones another worker has locked """
+    with transaction.atomic():
+        emails = pending_emails().order_by("next_attempt")
+        if connection.features.has_select_for_update_skip_locked:
+            emails = emails.select_for_update(skip_locked=True)
+        batch = list(emails[:batch_size])
+        EmailNotification.objects.filter(id__in=[email.id for email in batch]).update(
+            next_attempt=timezone.now() + CLAIM_TIMEOUT
+        )
+    return batch
+
+
+def retry_later(email, error):
+    """ Exponential backoff: EMAIL_RETRY_BACKOFF seconds, then twice that, and so on """
+    email.attempts += 1
+    email.error = str(error)
+    email.next_attempt = timezone.now() + timedelta(
+        seconds=settings.EMAIL_RETRY_BACKOFF * 2 ** (email.attempts - 1)
+    )
+    email.save(update_fields=["attempts", "error", "next_attempt"])
+    if email.attempts >= settings.EMAIL_MAX_ATTEMPTS:
+        logger.error("Giving up on email %s to %s: %s", email.id, email.recipient, error)
+
+
+def open_connection(mail_connection, emails):
+    """ Opens the SMTP connection, or schedules the retry of `emails` if it can't """
+    try:
+        mail_connection.open()
+    except (smtplib.SMTPException, OSError) as error:
+        logger.warning("Could not connect to the SMTP server: %s", error)
+        for email in emails:
+            retry_later(email, error)
+        return False
+    return True
+
+
+def send_pending_emails(batch_size=None):
+    """
+    Sends every pending email over a single SMTP connection, batch by batch.
+
+    Each message is retried on its own, a failure only delays that message. If the
+    server drops the connection it is opened again for the rest of the batch. If the
+    connection can't be opened the rest of the batch counts a failed attempt, so a
+    broken configuration ends up giving up instead of retrying forever.
+    Returns the number of sent and failed messages and the throughput.
+    """
+    batch_size = batch_size or settings.EMAIL_BATCH_SIZE
+    sent = failed = 0
+    started = time.perf_counter()
+    mail_connection = get_connection(fail_silently=False)
+    try:
+        while True:
+            batch = claim_batch(batch_size)
+            if not batch:
+                break
+            delivered = []
+            connected = open_connection(mail_connection, batch)
+            if not connected:
+                failed += len(batch)
+                break
+            for position, email in enumerate(batch):
+                message = EmailMessage(
+                    email.subject,
+                    email.body,
+                    settings.EMAIL_HOST_USER,
+                    [email.recipient],
+                    connection=mail_connection,
+                )
+                try:
+                    mail_connection.send_messages([message])
+                except (smtplib.SMTPException, OSError) as error:
+                    failed += 1
+                    retry_later(email, error)
+                    if isinstance(error, smtplib.SMTPServerDisconnected):
+                        mail_connection.close()
+                        connected = open_connection(mail_connection, batch[position + 1:])
+                        if not connected:
+                            failed += len(batch) - position - 1
+                            break
+                else:
+                    delivered.append(email.id)
+            EmailNotification.objects.filter(id__in=delivered).delete()
+            sent += len(delivered)
+            if not connected:
+                break
+    finally:
+        mail_connection.close()
+
+    seconds = time.perf_counter() - started
+    rate = sent / seconds if seconds else 0
+    if sent or failed:
+        logger.info("Sent %s emails (%s failed) in %.2fs, %.1f messages/s", sent, failed, seconds, rate)
+    return {"sent": sent, "failed": failed, "seconds": seconds, "messages_per_second": rate}
@@ -0,0 +1,36 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from snippets.backfill import BACKFILL_BATCH_SIZE, backfill_highlights
+
+
+class Command(BaseCommand):
+    help = (
+        "Renders again the highlight of every snippet in parallel processes. "
+        "Interrupted runs continue from the checkpoint file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+        parser.add_argument("--workers", type=int, default=os.cpu_count())
+        parser.add_argument("--checkpoint", default="highlight_backfill.json")
+        parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start over.")
+        parser.add_argument("--only-pending", action="store_true", help="Only the snippets without a highlight.")
+
+    def handle(self, *args, **options):
+        if options["restart"] and os.path.exists(options["checkpoint"]):
+            os.remove(options["checkpoint"])
+        result = backfill_highlights(
+            batch_size=options["batch_size"],
+            workers=options["workers"],
+            checkpoint_path=options["checkpoint"],
+            only_pending=options["only_pending"],
+            progress=self.progress,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            "Rendered %(rendered)s highlights in %(seconds).2fs, %(rows_per_second).1f rows/s" % result
+        ))
+
+    def progress(self, rendered, total, rate):
+        self.stdout.write("%s/%s highlights, %.1f rows/s" % (rendered, total, rate))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from snippets.compression import benchmark, column_sizes
+
+
+class Command(BaseCommand):
+    help = (
+        "Reports the stored size of the code and highlight columns, how a sample of the "
+        "code compresses with zlib, with and without a trained dictionary, and how long "
+        "the blobs already compressed take to read."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sample", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        for column, (value_bytes, stored_bytes) in column_sizes().items():
+            ratio = stored_bytes / value_bytes if value_bytes else 1
+            self.stdout.write("%s: %s bytes, %s stored (%.2f)" % (column, value_bytes, stored_bytes, ratio))
+
+        results = benchmark(options["sample"])
+        raw_bytes = results["raw_bytes"]
+        self.stdout.write(
+            "Sample of %s snippets, %s bytes, dictionary of %s bytes"
+            % (results["snippets"], raw_bytes, results["dictionary_bytes"])
+        )
+        for method in ("zlib", "zlib_dictionary"):
+            result = results[method]
+            ratio = result["bytes"] / raw_bytes if raw_bytes else 1
+            self.stdout.write(
+                "%s: %s bytes (%.2f), %.1f us to decode a snippet"
+                % (method, result["bytes"], ratio, result["decode_microseconds"])
+            )
+        stored = results["stored"]
+        self.stdout.write(
+            "stored: %s compressed blobs, %s characters in %s bytes, %.1f us to decode a snippet"
+            % (stored["snippets"], stored["characters"], stored["bytes"], stored["decode_microseconds"])
+        )
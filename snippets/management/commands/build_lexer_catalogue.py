@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from snippets.lexers import CATALOGUE_PATH, write_catalogue
+
+
+class Command(BaseCommand):
+    help = "Precomputes the table of pygments lexers used as choices of Language.name."
+
+    def handle(self, *args, **options):
+        write_catalogue()
+        self.stdout.write(self.style.SUCCESS("Lexer catalogue written to %s" % CATALOGUE_PATH))
@@ -0,0 +1,23 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from snippets.benchmarks import DEFAULT_TOLERANCE
+
+from .run_benchmarks import report_regressions
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares two results of run_benchmarks and fails if a timing got slower or a "
+        "throughput lower than the tolerance allows, or a page runs more queries."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("baseline")
+        parser.add_argument("current")
+        parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+
+    def handle(self, *args, **options):
+        with open(options["baseline"]) as baseline, open(options["current"]) as current:
+            report_regressions(self, json.load(baseline), json.load(current), options["tolerance"])
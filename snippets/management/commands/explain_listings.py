@@ -0,0 +1,85 @@
+import re
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from snippets.models import Language
+from snippets.queries import (
+    index_snippets,
+    keyset_condition,
+    keyset_querysets,
+    language_snippets,
+    user_snippets,
+)
+
+# Plan lines that mean the table is read entirely or the rows are sorted after reading them
+BAD_PLANS = {
+    "sqlite": [re.compile(r"\bSCAN \w+$"), re.compile(r"USE TEMP B-TREE")],
+    "postgresql": [re.compile(r"\bSeq Scan on snippets_snippet\b"), re.compile(r"\bSort\b")],
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs EXPLAIN over the query of every snippets listing and fails if a plan "
+        "shows a sequential scan of the snippets table or a sort outside an index."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default="default")
+
+    def handle(self, *args, **options):
+        connection = connections[options["database"]]
+        if connection.vendor not in BAD_PLANS:
+            raise CommandError("EXPLAIN checks are not supported for %s" % connection.vendor)
+
+        failures = []
+        for name, queryset in self.listing_queries():
+            plan = self.explain(connection, queryset.using(options["database"]))
+            bad_lines = [
+                line for line in plan.splitlines()
+                if any(pattern.search(line) for pattern in BAD_PLANS[connection.vendor])
+            ]
+            if bad_lines:
+                failures.append(name)
+                self.stdout.write(self.style.ERROR("%s\n%s" % (name, plan)))
+            else:
+                self.stdout.write(self.style.SUCCESS(name))
+                if options["verbosity"] > 1:
+                    self.stdout.write(plan)
+
+        if failures:
+            raise CommandError("Listings without an index plan: %s" % ", ".join(failures))
+
+    def explain(self, connection, queryset):
+        if connection.vendor != "postgresql":
+            return queryset.explain()
+        # Small or unanalyzed tables make postgres prefer a seq scan even when an index fits,
+        # so it is disabled to check the indexes can serve the query
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+            return queryset.explain()
+
+    def listing_queries(self):
+        user = User(pk=1)
+        language = Language(pk=1)
+        listings = [
+            ("index anonymous", index_snippets(AnonymousUser())),
+            ("index authenticated", index_snippets(user)),
+            ("user snippets", user_snippets(user)),
+            ("user snippets owner", user_snippets(user, include_private=True)),
+            ("snippets by language", language_snippets(language)),
+        ]
+        now = timezone.now()
+        pages = [
+            ("first page", None, ("-created", "-id")),
+            ("next page", keyset_condition(now, 1), ("-created", "-id")),
+            ("previous page", keyset_condition(now, 1, forward=False), ("created", "id")),
+        ]
+        for listing_name, querysets in listings:
+            for page_name, condition, ordering in pages:
+                for i, queryset in enumerate(keyset_querysets(querysets, condition, ordering, 21)):
+                    yield "%s, %s (%s)" % (listing_name, page_name, i + 1), queryset
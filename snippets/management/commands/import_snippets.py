@@ -0,0 +1,51 @@
+import os
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from snippets.imports import IMPORT_BATCH_SIZE, import_snippets
+
+
+class Command(BaseCommand):
+    help = (
+        "Imports snippets in bulk from a NDJSON file, one snippet per line, "
+        "or from a directory of source files."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--user", help="Owner of the rows that don't name their own user.")
+        parser.add_argument("--public", action="store_true", help="Rows that don't set it are public.")
+        parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count(), help="Processes that render the highlights."
+        )
+        parser.add_argument(
+            "--no-render",
+            action="store_false",
+            dest="render",
+            help="Leave the highlight for the first view and the tokens for rebuild_token_index.",
+        )
+        parser.add_argument("--no-email", action="store_false", dest="notify")
+
+    def handle(self, *args, **options):
+        user = None
+        if options["user"]:
+            user = User.objects.filter(username=options["user"]).first()
+            if user is None:
+                raise CommandError("User %s doesn't exist" % options["user"])
+        result = import_snippets(
+            options["path"],
+            user,
+            public=options["public"],
+            batch_size=options["batch_size"],
+            render=options["render"],
+            workers=options["workers"],
+            notify=options["notify"],
+        )
+        for number, errors in result["errors"]:
+            self.stderr.write("Row %s: %s" % (number, "; ".join(errors)))
+        self.stdout.write(self.style.SUCCESS(
+            "Imported %(created)s snippets (%(failed)s failed) in %(seconds).2fs, "
+            "%(snippets_per_second).1f snippets/s" % result
+        ))
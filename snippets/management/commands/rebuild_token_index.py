@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from snippets.models import Snippet, SnippetToken
+from snippets.tokens import extract_tokens
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the token index of every snippet, reading the table in batches by id."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        last_id = 0
+        total = 0
+        while True:
+            batch = list(
+                Snippet.objects.select_related("language", "code_blob")
+                .only("id", "language__name", "code_blob__code", "code_blob__compressed", "code_blob__dictionary")
+                .filter(id__gt=last_id)
+                .order_by("id")[:batch_size]
+            )
+            if not batch:
+                break
+            tokens = [
+                SnippetToken(snippet=snippet, token=token, kind=kind)
+                for snippet in batch
+                for token, kind in extract_tokens(snippet)
+            ]
+            with transaction.atomic():
+                SnippetToken.objects.filter(snippet__in=batch).delete()
+                SnippetToken.objects.bulk_create(tokens, batch_size=1000)
+            last_id = batch[-1].id
+            total += len(batch)
+            self.stdout.write("Indexed %s snippets" % total)
+        self.stdout.write(self.style.SUCCESS("Token index rebuilt for %s snippets" % total))
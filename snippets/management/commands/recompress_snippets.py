@@ -0,0 +1,54 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from snippets.backfill import id_ranges
+from snippets.compression import compress_blobs, create_dictionary, decompress_blobs
+from snippets.models import CodeBlob, CodeDictionary
+from snippets.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Compresses the code blobs in batches by id with a dictionary trained on a sample "
+        "of them, the one SNIPPET_CODE_COMPRESSION compresses the new blobs with. "
+        "--decompress stores them plain again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--after", type=int, default=0, help="Continue after this id.")
+        parser.add_argument("--sample", type=int, default=1000, help="Blobs the dictionary is trained on.")
+        parser.add_argument(
+            "--keep-dictionary",
+            action="store_true",
+            help="Compress with the latest dictionary instead of training a new one.",
+        )
+        parser.add_argument("--decompress", action="store_true")
+
+    def handle(self, *args, **options):
+        blobs = CodeBlob.objects.all()
+        if options["decompress"]:
+            total = 0
+            for first_id, last_id in id_ranges(blobs, options["batch_size"], options["after"]):
+                with transaction.atomic():
+                    total += decompress_blobs(first_id, last_id)
+                self.stdout.write("Decompressed %s blobs, up to id %s" % (total, last_id))
+            rebuild_search_index()
+            self.stdout.write(self.style.SUCCESS("Decompressed %s blobs" % total))
+            return
+        if not settings.SNIPPET_CODE_COMPRESSION:
+            self.stdout.write("SNIPPET_CODE_COMPRESSION is off, nothing to do")
+            return
+
+        dictionary_id = CodeDictionary.latest() if options["keep_dictionary"] else None
+        if dictionary_id is None:
+            dictionary_id = create_dictionary(options["sample"]).id
+            self.stdout.write("Trained the dictionary %s" % dictionary_id)
+        total = 0
+        for first_id, last_id in id_ranges(blobs, options["batch_size"], options["after"]):
+            with transaction.atomic():
+                total += compress_blobs(first_id, last_id, dictionary_id)
+            self.stdout.write("Compressed %s blobs, up to id %s" % (total, last_id))
+        rebuild_search_index()
+        self.stdout.write(self.style.SUCCESS("Compressed %s blobs with the dictionary %s" % (total, dictionary_id)))
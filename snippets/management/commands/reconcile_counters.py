@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from snippets.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = (
+        "Checks the language and user snippet counters against a count of the snippets "
+        "table. With --repair it rewrites the ones that drifted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repair", action="store_true")
+
+    def handle(self, *args, **options):
+        drift = reconcile_counters(repair=options["repair"])
+        for counter, pk, stored, actual in drift:
+            self.stdout.write("%s %s: stored %s, counted %s" % (counter, pk, stored, actual))
+        if not drift:
+            self.stdout.write(self.style.SUCCESS("The counters match the snippets"))
+        elif options["repair"]:
+            self.stdout.write(self.style.SUCCESS("Repaired %s counters" % len(drift)))
+        else:
+            raise CommandError("%s counters drifted, run again with --repair" % len(drift))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from snippets.outbox import relay_outbox
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends the pending outbox events to the broker, what the relayOutbox beat task "
+        "does. With CELERY_EAGER they run in this process."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int)
+
+    def handle(self, *args, **options):
+        result = relay_outbox(options["batch_size"])
+        self.stdout.write(
+            self.style.SUCCESS("Relayed %s outbox events, %s failed" % (result["relayed"], result["failed"]))
+        )
@@ -0,0 +1,69 @@
+import json
+
+from celery import current_app
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from snippets.benchmarks import DEFAULT_TOLERANCE, compare, generate_dataset, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates a synthetic dataset in a scratch test database, measures the views, "
+        "the highlighting, the form validation and the tasks over it and writes the "
+        "results as JSON. With --baseline it also fails on regressions against it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--snippets", type=int, default=5000)
+        parser.add_argument("--languages", type=int, default=12)
+        parser.add_argument("--users", type=int, default=50)
+        parser.add_argument("--repeats", type=int, default=20)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", default="benchmarks.json")
+        parser.add_argument("--baseline", help="Results of a previous run to compare with.")
+        parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+
+    def handle(self, *args, **options):
+        # The dataset goes to a database of its own and the cache to the local memory,
+        # so the benchmarks never touch the data, or the redis, of the configured ones
+        setup_test_environment()
+        database_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        eager = current_app.conf.task_always_eager
+        current_app.conf.task_always_eager = True
+        try:
+            with override_settings(
+                CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+                METRICS_ENABLED=False,
+            ):
+                self.stdout.write("Generating %(snippets)s snippets..." % options)
+                dataset = generate_dataset(options["snippets"], options["languages"], options["users"], options["seed"])
+                results = run_benchmarks(options["repeats"], options["seed"], dataset)
+        finally:
+            current_app.conf.task_always_eager = eager
+            connection.creation.destroy_test_db(database_name, verbosity=0)
+            teardown_test_environment()
+
+        with open(options["output"], "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+        for name, metrics in sorted(results["benchmarks"].items()):
+            self.stdout.write("%s: %s" % (name, ", ".join(
+                "%s=%.2f" % (metric, value) if isinstance(value, float) else "%s=%s" % (metric, value)
+                for metric, value in sorted(metrics.items())
+            )))
+        self.stdout.write(self.style.SUCCESS("Results written to %s" % options["output"]))
+
+        if options["baseline"]:
+            with open(options["baseline"]) as baseline:
+                report_regressions(self, json.load(baseline), results, options["tolerance"])
+
+
+def report_regressions(command, baseline, current, tolerance):
+    regressions = compare(baseline, current, tolerance)
+    for name, metric, previous, value in regressions:
+        command.stdout.write(command.style.ERROR("%s %s: %.2f -> %.2f" % (name, metric, previous, value)))
+    if regressions:
+        raise CommandError("%s regressions against the baseline" % len(regressions))
+    command.stdout.write(command.style.SUCCESS("No regressions against the baseline"))
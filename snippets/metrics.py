@@ -0,0 +1,317 @@
+import hmac
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import Http404, HttpResponse
+from django.template.backends.django import DjangoTemplates, Template
+from django.views import View
+
+# Phases timed inside a sampled request, in the order of the Server-Timing header
+PHASES = ("db", "highlight", "template")
+# Upper bounds, in seconds, of the buckets of the request duration histogram
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_current = ContextVar("request_metrics", default=None)
+
+
+class RequestMetrics:
+    """ Time, queries and cache lookups of a sampled request """
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+        # {(cache, "hit" or "miss"): lookups}
+        self.cache = {}
+        self._depth = {}
+
+    @contextmanager
+    def phase(self, name):
+        # Only the outermost call is timed, so a page of lines highlighted from
+        # `highlight` or a query run while rendering a template isn't counted twice
+        depth = self._depth.get(name, 0)
+        self._depth[name] = depth + 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._depth[name] = depth
+            if not depth:
+                self.seconds[name] += time.perf_counter() - started
+
+    def execute(self, execute, sql, params, many, context):
+        """ Counts and times a query, see `count_query` """
+        self.queries += 1
+        with self.phase("db"):
+            return execute(sql, params, many, context)
+
+    def server_timing(self, total):
+        entries = [
+            'db;dur=%.1f;desc="%s queries"' % (self.seconds["db"] * 1000, self.queries),
+            "highlight;dur=%.1f" % (self.seconds["highlight"] * 1000),
+            "template;dur=%.1f" % (self.seconds["template"] * 1000),
+        ]
+        for (name, result), count in sorted(self.cache.items()):
+            entries.append('cache-%s-%s;desc="%s"' % (name, result, count))
+        entries.append("total;dur=%.1f" % (total * 1000))
+        return ", ".join(entries)
+
+
+@contextmanager
+def timer(phase):
+    """ Adds the time of the block to the phase of the current request, if it's sampled """
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    with metrics.phase(phase):
+        yield
+
+
+def timed(phase):
+    def decorator(func):
+        @wraps(func)
+        def _wrapped(*args, **kwargs):
+            with timer(phase):
+                return func(*args, **kwargs)
+        return _wrapped
+    return decorator
+
+
+def count_query(execute, sql, params, many, context):
+    """ Database execute wrapper of every connection, times the queries of the sampled requests """
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics.execute(execute, sql, params, many, context)
+
+
+def install_query_counter(connection):
+    """
+    Adds `count_query` to a connection, see `signals.count_queries`. First in the list,
+    the `connection.execute_wrapper` blocks pop the last one.
+    """
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, count_query)
+
+
+def cache_lookup(name, hit):
+    metrics = _current.get()
+    if metrics is not None:
+        key = (name, "hit" if hit else "miss")
+        metrics.cache[key] = metrics.cache.get(key, 0) + 1
+
+
+class MetricsRegistry:
+    """
+    Totals per view since the process started. Every request counts towards the
+    number of requests and their duration, the breakdown in phases, queries and cache
+    lookups only comes from the sampled ones, `sampled` says how many they were.
+    Each gunicorn worker keeps its own totals.
+    """
+
+    def __init__(self):
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def record(self, view, seconds, metrics=None):
+        with self._lock:
+            stats = self._views.get(view)
+            if stats is None:
+                stats = self._views[view] = {
+                    "buckets": [0] * len(DURATION_BUCKETS),
+                    "count": 0,
+                    "seconds": 0.0,
+                    "sampled": 0,
+                    "queries": 0,
+                    "phases": dict.fromkeys(PHASES, 0.0),
+                    "cache": {},
+                }
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            for index, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    stats["buckets"][index] += 1
+                    break
+            if metrics is None:
+                return
+            stats["sampled"] += 1
+            stats["queries"] += metrics.queries
+            for phase, phase_seconds in metrics.seconds.items():
+                stats["phases"][phase] += phase_seconds
+            for key, count in metrics.cache.items():
+                stats["cache"][key] = stats["cache"].get(key, 0) + count
+
+    def clear(self):
+        with self._lock:
+            self._views.clear()
+
+    def render(self):
+        """ The totals in the Prometheus text format """
+        with self._lock:
+            views = {view: dict(stats, cache=dict(stats["cache"])) for view, stats in sorted(self._views.items())}
+        lines = [
+            "# HELP snippets_request_duration_seconds Wall time of the requests until the view returns.",
+            "# TYPE snippets_request_duration_seconds histogram",
+        ]
+        for view, stats in views.items():
+            cumulative = 0
+            for bound, count in zip(DURATION_BUCKETS, stats["buckets"]):
+                cumulative += count
+                lines.append('snippets_request_duration_seconds_bucket{view="%s",le="%s"} %s' % (view, bound, cumulative))
+            lines.append('snippets_request_duration_seconds_bucket{view="%s",le="+Inf"} %s' % (view, stats["count"]))
+            lines.append('snippets_request_duration_seconds_sum{view="%s"} %.6f' % (view, stats["seconds"]))
+            lines.append('snippets_request_duration_seconds_count{view="%s"} %s' % (view, stats["count"]))
+
+        counters = [
+            ("snippets_sampled_requests_total", "Requests measured in detail.", lambda stats: stats["sampled"]),
+            ("snippets_db_queries_total", "Database queries of the sampled requests.", lambda stats: stats["queries"]),
+        ]
+        counters.extend(
+            (
+                "snippets_%s_seconds_total" % phase,
+                "Time of the sampled requests spent in the %s phase." % phase,
+                lambda stats, phase=phase: "%.6f" % stats["phases"][phase],
+            )
+            for phase in PHASES
+        )
+        for name, help_text, value in counters:
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s counter" % name)
+            for view, stats in views.items():
+                lines.append('%s{view="%s"} %s' % (name, view, value(stats)))
+
+        lines.append("# HELP snippets_cache_lookups_total Cache lookups of the sampled requests.")
+        lines.append("# TYPE snippets_cache_lookups_total counter")
+        for view, stats in views.items():
+            for (cache_name, result), count in sorted(stats["cache"].items()):
+                lines.append(
+                    'snippets_cache_lookups_total{view="%s",cache="%s",result="%s"} %s'
+                    % (view, cache_name, result, count)
+                )
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def view_name(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unresolved"
+    return match.url_name or match.view_name
+
+
+class MetricsMiddleware:
+    """
+    Times every request and, for a METRICS_SAMPLE_RATE fraction of them, the database
+    queries, the highlights, the template rendering and the cache lookups.
+    Sampled responses carry the breakdown in a Server-Timing header.
+    Streamed bodies, such as the export, are sent after the time is taken.
+    Works in both modes, so it doesn't turn the async views sync under ASGI.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = time.perf_counter()
+        metrics = sampled_metrics()
+        with measure(metrics):
+            response = self.get_response(request)
+        return record(request, response, started, metrics)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        metrics = sampled_metrics()
+        with measure(metrics):
+            response = await self.get_response(request)
+        return record(request, response, started, metrics)
+
+
+def sampled_metrics():
+    if random.random() < settings.METRICS_SAMPLE_RATE:
+        return RequestMetrics()
+    return None
+
+
+@contextmanager
+def measure(metrics):
+    """
+    Makes `metrics` the ones of the current request. Its queries are counted in any
+    thread the context reaches, see `install_query_counter`.
+    """
+    if metrics is None:
+        yield
+        return
+    token = _current.set(metrics)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def record(request, response, started, metrics):
+    seconds = time.perf_counter() - started
+    registry.record(view_name(request), seconds, metrics)
+    if metrics is not None and settings.METRICS_SERVER_TIMING:
+        response["Server-Timing"] = metrics.server_timing(seconds)
+    return response
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        with timer("template"):
+            return super().render(context, request)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """
+    Django templates backend that adds the time of each render to the template phase.
+    Only the templates a view renders are timed, included ones are part of them.
+    """
+
+    def from_string(self, template_code):
+        template = super().from_string(template_code)
+        return TimedTemplate(template.template, self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return TimedTemplate(template.template, self)
+
+
+def metrics_allowed(request):
+    """
+    With a METRICS_TOKEN, whether the request sends it as `Authorization: Bearer <token>`.
+    Without one, whether it comes from METRICS_ALLOWED_IPS. Behind a proxy every request
+    comes from the address of the proxy, so it needs the token.
+    """
+    if settings.METRICS_TOKEN:
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(token.strip(), settings.METRICS_TOKEN)
+    return request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS
+
+
+class Metrics(View):
+    """
+    GET: The totals of this process in the Prometheus text format. Only answers to
+         the scraper, see `metrics_allowed`, everyone else gets a 404.
+    """
+    def get(self, request, *args, **kwargs):
+        if not metrics_allowed(request):
+            raise Http404
+        return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-17 23:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0003_alter_language_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='snippet',
+            name='highlighted',
+            field=models.TextField(blank=True, editable=False),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.2 on 2026-10-17 23:18
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0004_snippet_highlighted'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='snippet',
+            index=models.Index(condition=models.Q(('public', True)), fields=['-created', '-id'], name='snippet_public_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='snippet',
+            index=models.Index(fields=['user', '-created', '-id'], name='snippet_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='snippet',
+            index=models.Index(condition=models.Q(('public', True)), fields=['language', '-created', '-id'], name='snippet_lang_public_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='snippet',
+            index=models.Index(fields=['user', 'public'], name='snippet_user_public_idx'),
+        ),
+    ]
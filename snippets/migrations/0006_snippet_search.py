@@ -0,0 +1,84 @@
+# Generated by Django 5.1.2 on 2026-10-17 23:40
+
+from django.db import migrations
+
+# The search index as it was created here, later migrations change it. Postgres keeps a
+# generated tsvector column with a GIN index, SQLite an external content FTS5 table
+# synced by triggers.
+INSTALL_SQL = {
+    "postgresql": [
+        """
+        ALTER TABLE snippets_snippet ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(description, '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(snippet, '')), 'C')
+        ) STORED
+        """,
+        "CREATE INDEX IF NOT EXISTS snippet_search_vector_idx ON snippets_snippet USING GIN (search_vector)",
+    ],
+    "sqlite": [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS snippets_snippet_fts USING fts5(
+            name, description, snippet,
+            content='snippets_snippet', content_rowid='id',
+            tokenize="unicode61 tokenchars '_'"
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_insert AFTER INSERT ON snippets_snippet BEGIN
+            INSERT INTO snippets_snippet_fts(rowid, name, description, snippet)
+            VALUES (new.id, new.name, new.description, new.snippet);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_delete AFTER DELETE ON snippets_snippet BEGIN
+            INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, name, description, snippet)
+            VALUES ('delete', old.id, old.name, old.description, old.snippet);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_update
+        AFTER UPDATE OF name, description, snippet ON snippets_snippet BEGIN
+            INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, name, description, snippet)
+            VALUES ('delete', old.id, old.name, old.description, old.snippet);
+            INSERT INTO snippets_snippet_fts(rowid, name, description, snippet)
+            VALUES (new.id, new.name, new.description, new.snippet);
+        END
+        """,
+        "INSERT INTO snippets_snippet_fts(snippets_snippet_fts) VALUES ('rebuild')",
+    ],
+}
+
+UNINSTALL_SQL = {
+    "postgresql": [
+        "DROP INDEX IF EXISTS snippet_search_vector_idx",
+        "ALTER TABLE snippets_snippet DROP COLUMN IF EXISTS search_vector",
+    ],
+    "sqlite": [
+        "DROP TRIGGER IF EXISTS snippets_snippet_fts_insert",
+        "DROP TRIGGER IF EXISTS snippets_snippet_fts_delete",
+        "DROP TRIGGER IF EXISTS snippets_snippet_fts_update",
+        "DROP TABLE IF EXISTS snippets_snippet_fts",
+    ],
+}
+
+
+def install(apps, schema_editor):
+    for statement in INSTALL_SQL.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def uninstall(apps, schema_editor):
+    for statement in UNINSTALL_SQL.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0005_snippet_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.2 on 2026-10-17 23:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0006_snippet_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SnippetToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=100)),
+                ('kind', models.CharField(choices=[('name', 'Name'), ('keyword', 'Keyword'), ('string', 'String')], max_length=10)),
+                ('snippet', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tokens', to='snippets.snippet')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('token', 'kind', 'snippet'), name='snippet_token_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.2 on 2026-10-17 23:24
+
+import snippets.lexers
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0007_snippettoken'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='language',
+            name='name',
+            field=models.CharField(choices=snippets.lexers.lexer_choices, max_length=50),
+        ),
+    ]
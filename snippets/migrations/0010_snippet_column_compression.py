@@ -0,0 +1,43 @@
+# Generated by Django 5.1.2 on 2026-10-17 23:58
+
+from django.db import migrations
+
+# The columns as they were compressed here, later migrations move them
+COMPRESSED_COLUMNS = ("snippet", "highlighted")
+
+LZ4_AVAILABLE_SQL = "SELECT 'lz4' = ANY(enumvals) FROM pg_settings WHERE name = 'default_toast_compression'"
+
+SET_COMPRESSION_SQL = "ALTER TABLE snippets_snippet ALTER COLUMN {column} SET COMPRESSION {method}"
+
+
+def set_column_compression(schema_editor, method):
+    """ Only Postgres 14+ builds with lz4 compress a column with it, elsewhere it does nothing """
+    connection = schema_editor.connection
+    if connection.vendor != "postgresql" or connection.pg_version < 140000:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(LZ4_AVAILABLE_SQL)
+        row = cursor.fetchone()
+    if not (row and row[0]):
+        return
+    for column in COMPRESSED_COLUMNS:
+        schema_editor.execute(SET_COMPRESSION_SQL.format(column=column, method=method))
+
+
+def compress(apps, schema_editor):
+    set_column_compression(schema_editor, "lz4")
+
+
+def uncompress(apps, schema_editor):
+    set_column_compression(schema_editor, "pglz")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0009_emailnotification'),
+    ]
+
+    operations = [
+        migrations.RunPython(compress, uncompress),
+    ]
@@ -0,0 +1,151 @@
+# Generated by Django 5.1.2 on 2026-10-17 23:52
+
+import hashlib
+
+import django.db.models.deletion
+import pygments
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+# The search index of SQLite as it was when this migration was written. Rebuilding the
+# snippets table drops its triggers, the Postgres column is left as it is.
+SEARCH_INDEX_SQL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS snippets_snippet_fts USING fts5(
+        name, description, snippet,
+        content='snippets_snippet', content_rowid='id',
+        tokenize="unicode61 tokenchars '_'"
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_insert AFTER INSERT ON snippets_snippet BEGIN
+        INSERT INTO snippets_snippet_fts(rowid, name, description, snippet)
+        VALUES (new.id, new.name, new.description, new.snippet);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_delete AFTER DELETE ON snippets_snippet BEGIN
+        INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, name, description, snippet)
+        VALUES ('delete', old.id, old.name, old.description, old.snippet);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_update
+    AFTER UPDATE OF name, description, snippet ON snippets_snippet BEGIN
+        INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, name, description, snippet)
+        VALUES ('delete', old.id, old.name, old.description, old.snippet);
+        INSERT INTO snippets_snippet_fts(rowid, name, description, snippet)
+        VALUES (new.id, new.name, new.description, new.snippet);
+    END
+    """,
+    "INSERT INTO snippets_snippet_fts(snippets_snippet_fts) VALUES ('rebuild')",
+]
+
+LZ4_AVAILABLE_SQL = "SELECT 'lz4' = ANY(enumvals) FROM pg_settings WHERE name = 'default_toast_compression'"
+
+
+def highlight_digest(code, language_name):
+    """ Digest of the highlight of a code, from the key of the highlight cache of this version """
+    code_digest = hashlib.sha256(code.encode("utf-8")).hexdigest()
+    key = "highlight:%s:%s:linenos=True:%s" % (pygments.__version__, language_name, code_digest)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def move_highlights_to_blobs(apps, schema_editor):
+    """ One blob per distinct code and language, with a reference per snippet that shares it """
+    Snippet = apps.get_model("snippets", "Snippet")
+    HighlightBlob = apps.get_model("snippets", "HighlightBlob")
+    last_id = 0
+    while True:
+        batch = list(
+            Snippet.objects.select_related("language")
+            .exclude(highlighted="")
+            .filter(id__gt=last_id)
+            .order_by("id")
+            .only("id", "snippet", "highlighted", "language__name")[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        digests = {}
+        for snippet in batch:
+            digests[snippet.id] = highlight_digest(snippet.snippet, snippet.language.name)
+        html = {digests[snippet.id]: snippet.highlighted for snippet in batch}
+        HighlightBlob.objects.bulk_create(
+            [HighlightBlob(digest=digest, html=value) for digest, value in html.items()],
+            ignore_conflicts=True,
+        )
+        blobs = dict(HighlightBlob.objects.filter(digest__in=html).values_list("digest", "id"))
+        counts = {}
+        for snippet in batch:
+            snippet.highlight_blob_id = blobs[digests[snippet.id]]
+            counts[snippet.highlight_blob_id] = counts.get(snippet.highlight_blob_id, 0) + 1
+        Snippet.objects.bulk_update(batch, ["highlight_blob"])
+        HighlightBlob.objects.filter(id__in=counts).update(
+            references=models.F("references") + models.Case(
+                *[models.When(id=blob_id, then=models.Value(count)) for blob_id, count in counts.items()]
+            )
+        )
+        last_id = batch[-1].id
+
+
+def move_blobs_to_highlights(apps, schema_editor):
+    Snippet = apps.get_model("snippets", "Snippet")
+    HighlightBlob = apps.get_model("snippets", "HighlightBlob")
+    Snippet.objects.filter(highlight_blob__isnull=False).update(
+        highlighted=models.Subquery(
+            HighlightBlob.objects.filter(id=models.OuterRef("highlight_blob_id")).values("html")[:1]
+        )
+    )
+
+
+def reinstall_search_index(apps, schema_editor):
+    # Removing a column rebuilds the table on SQLite, which drops the search triggers
+    if schema_editor.connection.vendor == "sqlite":
+        for statement in SEARCH_INDEX_SQL:
+            schema_editor.execute(statement)
+
+
+def compress_blobs(apps, schema_editor):
+    # Only Postgres 14+ builds with lz4 compress a column with it
+    connection = schema_editor.connection
+    if connection.vendor != "postgresql" or connection.pg_version < 140000:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(LZ4_AVAILABLE_SQL)
+        row = cursor.fetchone()
+    if row and row[0]:
+        schema_editor.execute("ALTER TABLE snippets_highlightblob ALTER COLUMN html SET COMPRESSION lz4")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0010_snippet_column_compression'),
+    ]
+
+    operations = [
+        # Runs last when the migration is reverted, after the table rebuilds
+        migrations.RunPython(migrations.RunPython.noop, reinstall_search_index),
+        migrations.CreateModel(
+            name='HighlightBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('html', models.TextField()),
+                ('references', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='snippet',
+            name='highlight_blob',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='snippets', to='snippets.highlightblob'),
+        ),
+        migrations.RunPython(move_highlights_to_blobs, move_blobs_to_highlights),
+        migrations.RemoveField(
+            model_name='snippet',
+            name='highlighted',
+        ),
+        migrations.RunPython(reinstall_search_index, migrations.RunPython.noop),
+        migrations.RunPython(compress_blobs, migrations.RunPython.noop),
+    ]
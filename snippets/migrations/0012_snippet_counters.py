@@ -0,0 +1,55 @@
+# Generated by Django 5.1.2 on 2026-10-18 00:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def count_existing_snippets(apps, schema_editor):
+    Snippet = apps.get_model("snippets", "Snippet")
+    for model_name, field in (("LanguageCounter", "language_id"), ("UserCounter", "user_id")):
+        counter = apps.get_model("snippets", model_name)
+        rows = (
+            Snippet.objects.order_by()
+            .values(field)
+            .annotate(total=Count("id"), public_total=Count("id", filter=Q(public=True)))
+        )
+        counter.objects.bulk_create(
+            [counter(pk=row[field], total=row["total"], public=row["public_total"]) for row in rows],
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('snippets', '0011_highlightblob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LanguageCounter',
+            fields=[
+                ('total', models.IntegerField(default=0)),
+                ('public', models.IntegerField(default=0)),
+                ('language', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='counter', serialize=False, to='snippets.language')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='UserCounter',
+            fields=[
+                ('total', models.IntegerField(default=0)),
+                ('public', models.IntegerField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snippet_counter', serialize=False, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.RunPython(count_existing_snippets, migrations.RunPython.noop),
+    ]
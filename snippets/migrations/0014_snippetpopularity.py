@@ -0,0 +1,22 @@
+# Generated by Django 5.1.2 on 2026-10-18 00:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0013_outboxevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SnippetPopularity',
+            fields=[
+                ('snippet', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='popularity', serialize=False, to='snippets.snippet')),
+                ('views', models.PositiveBigIntegerField(default=0)),
+                ('trend', models.FloatField(db_index=True)),
+            ],
+        ),
+    ]
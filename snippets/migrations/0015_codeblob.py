@@ -0,0 +1,289 @@
+# Generated by Django 5.1.2 on 2026-10-18 01:40
+
+import hashlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+# The search index before and after this migration, see snippets/search.py. Before it
+# reads the code column of the snippets, after it the code of their blobs.
+PREVIOUS_INSTALL_SQL = {
+    "postgresql": [
+        """
+        ALTER TABLE snippets_snippet ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(name, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(description, '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(snippet, '')), 'C')
+        ) STORED
+        """,
+        "CREATE INDEX IF NOT EXISTS snippet_search_vector_idx ON snippets_snippet USING GIN (search_vector)",
+    ],
+    "sqlite": [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS snippets_snippet_fts USING fts5(
+            name, description, snippet,
+            content='snippets_snippet', content_rowid='id',
+            tokenize="unicode61 tokenchars '_'"
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_insert AFTER INSERT ON snippets_snippet BEGIN
+            INSERT INTO snippets_snippet_fts(rowid, name, description, snippet)
+            VALUES (new.id, new.name, new.description, new.snippet);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_delete AFTER DELETE ON snippets_snippet BEGIN
+            INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, name, description, snippet)
+            VALUES ('delete', old.id, old.name, old.description, old.snippet);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_update
+        AFTER UPDATE OF name, description, snippet ON snippets_snippet BEGIN
+            INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, name, description, snippet)
+            VALUES ('delete', old.id, old.name, old.description, old.snippet);
+            INSERT INTO snippets_snippet_fts(rowid, name, description, snippet)
+            VALUES (new.id, new.name, new.description, new.snippet);
+        END
+        """,
+        "INSERT INTO snippets_snippet_fts(snippets_snippet_fts) VALUES ('rebuild')",
+    ],
+}
+
+PREVIOUS_UNINSTALL_SQL = {
+    "postgresql": [
+        "DROP INDEX IF EXISTS snippet_search_vector_idx",
+        "ALTER TABLE snippets_snippet DROP COLUMN IF EXISTS search_vector",
+    ],
+    "sqlite": [
+        "DROP TRIGGER IF EXISTS snippets_snippet_fts_insert",
+        "DROP TRIGGER IF EXISTS snippets_snippet_fts_delete",
+        "DROP TRIGGER IF EXISTS snippets_snippet_fts_update",
+        "DROP TABLE IF EXISTS snippets_snippet_fts",
+    ],
+}
+
+INSTALL_SQL = {
+    "postgresql": [
+        "ALTER TABLE snippets_snippet ADD COLUMN IF NOT EXISTS search_vector tsvector",
+        """
+        CREATE OR REPLACE FUNCTION snippets_snippet_search_vector() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector :=
+                setweight(to_tsvector('simple', coalesce(NEW.name, '')), 'A') ||
+                setweight(to_tsvector('simple', coalesce(NEW.description, '')), 'B') ||
+                setweight(to_tsvector('simple', coalesce(
+                    (SELECT code FROM snippets_codeblob WHERE id = NEW.code_blob_id), ''
+                )), 'C');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS snippets_snippet_search_vector ON snippets_snippet",
+        """
+        CREATE TRIGGER snippets_snippet_search_vector
+        BEFORE INSERT OR UPDATE OF name, description, code_blob_id ON snippets_snippet
+        FOR EACH ROW EXECUTE FUNCTION snippets_snippet_search_vector()
+        """,
+        "UPDATE snippets_snippet SET name = name WHERE search_vector IS NULL",
+        "CREATE INDEX IF NOT EXISTS snippet_search_vector_idx ON snippets_snippet USING GIN (search_vector)",
+    ],
+    "sqlite": [
+        """
+        CREATE VIEW IF NOT EXISTS snippets_snippet_search AS
+        SELECT snippet.id, snippet.name, snippet.description, blob.code AS snippet
+        FROM snippets_snippet snippet JOIN snippets_codeblob blob ON blob.id = snippet.code_blob_id
+        """,
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS snippets_snippet_fts USING fts5(
+            name, description, snippet,
+            content='snippets_snippet_search', content_rowid='id',
+            tokenize="unicode61 tokenchars '_'"
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_insert AFTER INSERT ON snippets_snippet BEGIN
+            INSERT INTO snippets_snippet_fts(rowid, name, description, snippet)
+            VALUES (
+                new.id, new.name, new.description,
+                (SELECT code FROM snippets_codeblob WHERE id = new.code_blob_id)
+            );
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_delete AFTER DELETE ON snippets_snippet BEGIN
+            INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, name, description, snippet)
+            VALUES (
+                'delete', old.id, old.name, old.description,
+                (SELECT code FROM snippets_codeblob WHERE id = old.code_blob_id)
+            );
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_update
+        AFTER UPDATE OF name, description, code_blob_id ON snippets_snippet BEGIN
+            INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, name, description, snippet)
+            VALUES (
+                'delete', old.id, old.name, old.description,
+                (SELECT code FROM snippets_codeblob WHERE id = old.code_blob_id)
+            );
+            INSERT INTO snippets_snippet_fts(rowid, name, description, snippet)
+            VALUES (
+                new.id, new.name, new.description,
+                (SELECT code FROM snippets_codeblob WHERE id = new.code_blob_id)
+            );
+        END
+        """,
+        "INSERT INTO snippets_snippet_fts(snippets_snippet_fts) VALUES ('rebuild')",
+    ],
+}
+
+UNINSTALL_SQL = {
+    "postgresql": [
+        "DROP INDEX IF EXISTS snippet_search_vector_idx",
+        "DROP TRIGGER IF EXISTS snippets_snippet_search_vector ON snippets_snippet",
+        "DROP FUNCTION IF EXISTS snippets_snippet_search_vector()",
+        "ALTER TABLE snippets_snippet DROP COLUMN IF EXISTS search_vector",
+    ],
+    "sqlite": [
+        "DROP TRIGGER IF EXISTS snippets_snippet_fts_insert",
+        "DROP TRIGGER IF EXISTS snippets_snippet_fts_delete",
+        "DROP TRIGGER IF EXISTS snippets_snippet_fts_update",
+        "DROP TABLE IF EXISTS snippets_snippet_fts",
+        "DROP VIEW IF EXISTS snippets_snippet_search",
+    ],
+}
+
+LZ4_AVAILABLE_SQL = "SELECT 'lz4' = ANY(enumvals) FROM pg_settings WHERE name = 'default_toast_compression'"
+
+
+def run(schema_editor, statements):
+    for statement in statements.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def install_previous_search_index(apps, schema_editor):
+    run(schema_editor, PREVIOUS_INSTALL_SQL)
+
+
+def uninstall_previous_search_index(apps, schema_editor):
+    run(schema_editor, PREVIOUS_UNINSTALL_SQL)
+
+
+def install_search_index(apps, schema_editor):
+    run(schema_editor, INSTALL_SQL)
+
+
+def uninstall_search_index(apps, schema_editor):
+    run(schema_editor, UNINSTALL_SQL)
+
+
+def code_digest(code, language_name):
+    """ Content address of a code in a language, see CodeBlob.digest_of """
+    return hashlib.sha256(("%s\n%s" % (language_name, code)).encode("utf-8")).hexdigest()
+
+
+def move_code_to_blobs(apps, schema_editor):
+    """ One blob per distinct code and language, with a reference per snippet that shares it """
+    Snippet = apps.get_model("snippets", "Snippet")
+    CodeBlob = apps.get_model("snippets", "CodeBlob")
+    last_id = 0
+    while True:
+        batch = list(
+            Snippet.objects.select_related("language")
+            .filter(id__gt=last_id)
+            .order_by("id")
+            .only("id", "snippet", "language__name")[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        digests = {snippet.id: code_digest(snippet.snippet, snippet.language.name) for snippet in batch}
+        codes = {digests[snippet.id]: snippet.snippet for snippet in batch}
+        CodeBlob.objects.bulk_create(
+            [CodeBlob(digest=digest, code=code, size=len(code)) for digest, code in codes.items()],
+            ignore_conflicts=True,
+        )
+        blobs = dict(CodeBlob.objects.filter(digest__in=codes).values_list("digest", "id"))
+        counts = {}
+        for snippet in batch:
+            snippet.code_blob_id = blobs[digests[snippet.id]]
+            counts[snippet.code_blob_id] = counts.get(snippet.code_blob_id, 0) + 1
+        Snippet.objects.bulk_update(batch, ["code_blob"])
+        CodeBlob.objects.filter(id__in=counts).update(
+            references=models.F("references") + models.Case(
+                *[models.When(id=blob_id, then=models.Value(count)) for blob_id, count in counts.items()]
+            )
+        )
+        last_id = batch[-1].id
+
+
+def move_blobs_to_code(apps, schema_editor):
+    Snippet = apps.get_model("snippets", "Snippet")
+    CodeBlob = apps.get_model("snippets", "CodeBlob")
+    Snippet.objects.update(
+        snippet=models.Subquery(CodeBlob.objects.filter(id=models.OuterRef("code_blob_id")).values("code")[:1])
+    )
+
+
+def compress_blobs(apps, schema_editor):
+    # Like the code column before, see 0010_snippet_column_compression
+    connection = schema_editor.connection
+    if connection.vendor != "postgresql" or connection.pg_version < 140000:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(LZ4_AVAILABLE_SQL)
+        row = cursor.fetchone()
+    if row and row[0]:
+        schema_editor.execute("ALTER TABLE snippets_codeblob ALTER COLUMN code SET COMPRESSION lz4")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0014_snippetpopularity'),
+    ]
+
+    operations = [
+        # Runs last when the migration is reverted, after the table rebuilds
+        migrations.RunPython(migrations.RunPython.noop, install_previous_search_index),
+        migrations.CreateModel(
+            name='CodeBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('references', models.PositiveIntegerField(default=0)),
+                ('code', models.TextField()),
+                ('size', models.PositiveIntegerField()),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='snippet',
+            name='code_blob',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='snippets', to='snippets.codeblob'),
+        ),
+        migrations.RunPython(move_code_to_blobs, move_blobs_to_code),
+        migrations.RunPython(uninstall_previous_search_index, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='snippet',
+            name='code_blob',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='snippets', to='snippets.codeblob'),
+        ),
+        # The column comes back empty when the migration is reverted, then the code is copied
+        migrations.AlterField(
+            model_name='snippet',
+            name='snippet',
+            field=models.TextField(default=''),
+        ),
+        migrations.RemoveField(
+            model_name='snippet',
+            name='snippet',
+        ),
+        migrations.RunPython(install_search_index, uninstall_search_index),
+        migrations.RunPython(compress_blobs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,214 @@
+# Generated by Django 5.1.2 on 2026-10-18 00:55
+
+import zlib
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+SAMPLE_SIZE = 1000
+# zlib only uses the last 32KB of a preset dictionary
+DICTIONARY_SIZE = 32 * 1024
+
+# The compressed code is already as small as it gets, Postgres shouldn't try again
+COMPRESSED_STORAGE_SQL = {
+    "postgresql": "ALTER TABLE snippets_codeblob ALTER COLUMN compressed SET STORAGE EXTERNAL",
+}
+
+# The SQLite search index of snippets/search.py at the time. Its view reads the code
+# blobs table, which SQLite can't rebuild while the view exists.
+SEARCH_INDEX_SQL = [
+    """
+    CREATE VIEW IF NOT EXISTS snippets_snippet_search AS
+    SELECT snippet.id, snippet.name, snippet.description, blob.code AS snippet
+    FROM snippets_snippet snippet JOIN snippets_codeblob blob ON blob.id = snippet.code_blob_id
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS snippets_snippet_fts USING fts5(
+        name, description, snippet,
+        content='snippets_snippet_search', content_rowid='id',
+        tokenize="unicode61 tokenchars '_'"
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_insert AFTER INSERT ON snippets_snippet BEGIN
+        INSERT INTO snippets_snippet_fts(rowid, name, description, snippet)
+        VALUES (
+            new.id, new.name, new.description,
+            (SELECT code FROM snippets_codeblob WHERE id = new.code_blob_id)
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_delete AFTER DELETE ON snippets_snippet BEGIN
+        INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, name, description, snippet)
+        VALUES (
+            'delete', old.id, old.name, old.description,
+            (SELECT code FROM snippets_codeblob WHERE id = old.code_blob_id)
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_update
+    AFTER UPDATE OF name, description, code_blob_id ON snippets_snippet BEGIN
+        INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, name, description, snippet)
+        VALUES (
+            'delete', old.id, old.name, old.description,
+            (SELECT code FROM snippets_codeblob WHERE id = old.code_blob_id)
+        );
+        INSERT INTO snippets_snippet_fts(rowid, name, description, snippet)
+        VALUES (
+            new.id, new.name, new.description,
+            (SELECT code FROM snippets_codeblob WHERE id = new.code_blob_id)
+        );
+    END
+    """,
+    "INSERT INTO snippets_snippet_fts(snippets_snippet_fts) VALUES ('rebuild')",
+]
+
+DROP_SEARCH_INDEX_SQL = [
+    "DROP TRIGGER IF EXISTS snippets_snippet_fts_insert",
+    "DROP TRIGGER IF EXISTS snippets_snippet_fts_delete",
+    "DROP TRIGGER IF EXISTS snippets_snippet_fts_update",
+    "DROP TABLE IF EXISTS snippets_snippet_fts",
+    "DROP VIEW IF EXISTS snippets_snippet_search",
+]
+
+# The search index reads the code column, see snippets/search.py
+REINDEX_SQL = {
+    "postgresql": "UPDATE snippets_snippet SET code_blob_id = code_blob_id WHERE code_blob_id BETWEEN %s AND %s",
+}
+
+REBUILD_SQL = {
+    "sqlite": "INSERT INTO snippets_snippet_fts(snippets_snippet_fts) VALUES ('rebuild')",
+}
+
+
+def train_dictionary(samples):
+    """ The most common lines of the samples, as snippets/codec.py trained it at the time """
+    counts = {}
+    for sample in samples:
+        for line in set(sample.splitlines()):
+            line = line.strip()
+            if len(line) > 3:
+                counts[line] = counts.get(line, 0) + 1
+    dictionary = b""
+    for line in sorted(counts, key=lambda line: (counts[line], len(line)), reverse=True):
+        if counts[line] < 2:
+            break
+        encoded = line.encode("utf-8") + b"\n"
+        if len(dictionary) + len(encoded) > DICTIONARY_SIZE:
+            break
+        dictionary = encoded + dictionary
+    return dictionary
+
+
+def blob_batches(CodeBlob, **filters):
+    last_id = 0
+    while True:
+        blobs = list(CodeBlob.objects.filter(id__gt=last_id, **filters).order_by("id")[:BATCH_SIZE])
+        if not blobs:
+            return
+        yield blobs
+        last_id = blobs[-1].id
+
+
+def reindex(schema_editor, blobs):
+    vendor = schema_editor.connection.vendor
+    if vendor in REINDEX_SQL:
+        schema_editor.execute(REINDEX_SQL[vendor], (blobs[0].id, blobs[-1].id))
+
+
+def install_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        for statement in SEARCH_INDEX_SQL:
+            schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        for statement in DROP_SEARCH_INDEX_SQL:
+            schema_editor.execute(statement)
+
+
+def set_compressed_storage(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor in COMPRESSED_STORAGE_SQL:
+        schema_editor.execute(COMPRESSED_STORAGE_SQL[vendor])
+
+
+def compress_blobs(apps, schema_editor):
+    """ With SNIPPET_CODE_COMPRESSION, compresses the code with a dictionary trained on a sample of it """
+    if not settings.SNIPPET_CODE_COMPRESSION:
+        return
+    CodeBlob = apps.get_model("snippets", "CodeBlob")
+    CodeDictionary = apps.get_model("snippets", "CodeDictionary")
+    samples = CodeBlob.objects.order_by("?").values_list("code", flat=True)[:SAMPLE_SIZE]
+    dictionary = CodeDictionary.objects.create(data=train_dictionary(samples))
+    for blobs in blob_batches(CodeBlob):
+        for blob in blobs:
+            stream = zlib.compressobj(6, zdict=dictionary.data) if dictionary.data else zlib.compressobj(6)
+            compressed = stream.compress(blob.code.encode("utf-8")) + stream.flush()
+            if len(compressed) < len(blob.code.encode("utf-8")):
+                blob.code, blob.compressed, blob.dictionary = "", compressed, dictionary
+        CodeBlob.objects.bulk_update(blobs, ["code", "compressed", "dictionary"])
+        reindex(schema_editor, blobs)
+    vendor = schema_editor.connection.vendor
+    if vendor in REBUILD_SQL:
+        schema_editor.execute(REBUILD_SQL[vendor])
+
+
+def decompress_blobs(apps, schema_editor):
+    CodeBlob = apps.get_model("snippets", "CodeBlob")
+    CodeDictionary = apps.get_model("snippets", "CodeDictionary")
+    dictionaries = {dictionary.id: bytes(dictionary.data) for dictionary in CodeDictionary.objects.all()}
+    for blobs in blob_batches(CodeBlob, compressed__isnull=False):
+        for blob in blobs:
+            dictionary = dictionaries.get(blob.dictionary_id, b"")
+            stream = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+            code = stream.decompress(bytes(blob.compressed)) + stream.flush()
+            blob.code, blob.compressed, blob.dictionary = code.decode("utf-8"), None, None
+        CodeBlob.objects.bulk_update(blobs, ["code", "compressed", "dictionary"])
+        reindex(schema_editor, blobs)
+    vendor = schema_editor.connection.vendor
+    if vendor in REBUILD_SQL:
+        schema_editor.execute(REBUILD_SQL[vendor])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0015_codeblob'),
+    ]
+
+    operations = [
+        # Reverted last, once the code blobs table is back as it was
+        migrations.RunPython(migrations.RunPython.noop, install_search_index),
+        migrations.CreateModel(
+            name='CodeDictionary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.BinaryField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='codeblob',
+            name='compressed',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='codeblob',
+            name='code',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='codeblob',
+            name='dictionary',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='blobs', to='snippets.codedictionary'),
+        ),
+        migrations.RunPython(migrations.RunPython.noop, drop_search_index),
+        migrations.RunPython(set_compressed_storage, migrations.RunPython.noop),
+        migrations.RunPython(compress_blobs, decompress_blobs),
+    ]
@@ -0,0 +1,147 @@
+# Generated by Django 5.1.2 on 2026-10-18 01:22
+
+import re
+import zlib
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+# The search index of snippets/search.py at the time, where `{code}` is the expression
+# that reads the code of a blob: `code` before this migration, and the words of a
+# compressed code after it.
+POSTGRES_FUNCTION_SQL = """
+    CREATE OR REPLACE FUNCTION snippets_snippet_search_vector() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector :=
+            setweight(to_tsvector('simple', coalesce(NEW.name, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(NEW.description, '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(
+                (SELECT {code} FROM snippets_codeblob WHERE id = NEW.code_blob_id), ''
+            )), 'C');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+"""
+
+SQLITE_INDEX_SQL = [
+    """
+    CREATE VIEW snippets_snippet_search AS
+    SELECT snippet.id, snippet.name, snippet.description, {blob_code} AS snippet
+    FROM snippets_snippet snippet JOIN snippets_codeblob blob ON blob.id = snippet.code_blob_id
+    """,
+    """
+    CREATE VIRTUAL TABLE snippets_snippet_fts USING fts5(
+        name, description, snippet,
+        content='snippets_snippet_search', content_rowid='id',
+        tokenize="unicode61 tokenchars '_'"
+    )
+    """,
+    """
+    CREATE TRIGGER snippets_snippet_fts_insert AFTER INSERT ON snippets_snippet BEGIN
+        INSERT INTO snippets_snippet_fts(rowid, name, description, snippet)
+        VALUES (
+            new.id, new.name, new.description,
+            (SELECT {code} FROM snippets_codeblob WHERE id = new.code_blob_id)
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER snippets_snippet_fts_delete AFTER DELETE ON snippets_snippet BEGIN
+        INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, name, description, snippet)
+        VALUES (
+            'delete', old.id, old.name, old.description,
+            (SELECT {code} FROM snippets_codeblob WHERE id = old.code_blob_id)
+        );
+    END
+    """,
+    """
+    CREATE TRIGGER snippets_snippet_fts_update
+    AFTER UPDATE OF name, description, code_blob_id ON snippets_snippet BEGIN
+        INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, name, description, snippet)
+        VALUES (
+            'delete', old.id, old.name, old.description,
+            (SELECT {code} FROM snippets_codeblob WHERE id = old.code_blob_id)
+        );
+        INSERT INTO snippets_snippet_fts(rowid, name, description, snippet)
+        VALUES (
+            new.id, new.name, new.description,
+            (SELECT {code} FROM snippets_codeblob WHERE id = new.code_blob_id)
+        );
+    END
+    """,
+    "INSERT INTO snippets_snippet_fts(snippets_snippet_fts) VALUES ('rebuild')",
+]
+
+DROP_SQLITE_INDEX_SQL = [
+    "DROP TRIGGER IF EXISTS snippets_snippet_fts_insert",
+    "DROP TRIGGER IF EXISTS snippets_snippet_fts_delete",
+    "DROP TRIGGER IF EXISTS snippets_snippet_fts_update",
+    "DROP TABLE IF EXISTS snippets_snippet_fts",
+    "DROP VIEW IF EXISTS snippets_snippet_search",
+]
+
+# Fires the trigger on the snippets of the compressed code
+POSTGRES_REINDEX_SQL = """
+    UPDATE snippets_snippet SET code_blob_id = code_blob_id
+    WHERE code_blob_id IN (SELECT id FROM snippets_codeblob WHERE compressed IS NOT NULL)
+"""
+
+
+def install_search_index(schema_editor, code, blob_code):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.execute(POSTGRES_FUNCTION_SQL.format(code=code))
+        schema_editor.execute(POSTGRES_REINDEX_SQL)
+    elif vendor == "sqlite":
+        for statement in DROP_SQLITE_INDEX_SQL:
+            schema_editor.execute(statement)
+        for statement in SQLITE_INDEX_SQL:
+            schema_editor.execute(statement.format(code=code, blob_code=blob_code))
+
+
+def index_search_words(apps, schema_editor):
+    install_search_index(schema_editor, "coalesce(search_words, code)", "coalesce(blob.search_words, blob.code)")
+
+
+def index_code(apps, schema_editor):
+    install_search_index(schema_editor, "code", "blob.code")
+
+
+def fill_search_words(apps, schema_editor):
+    """ The words of the code compressed by the previous migration or `recompress_snippets` """
+    CodeBlob = apps.get_model("snippets", "CodeBlob")
+    CodeDictionary = apps.get_model("snippets", "CodeDictionary")
+    dictionaries = {dictionary.id: bytes(dictionary.data) for dictionary in CodeDictionary.objects.all()}
+    last_id = 0
+    while True:
+        blobs = list(
+            CodeBlob.objects.filter(id__gt=last_id, compressed__isnull=False).order_by("id")[:BATCH_SIZE]
+        )
+        if not blobs:
+            return
+        for blob in blobs:
+            dictionary = dictionaries.get(blob.dictionary_id, b"")
+            stream = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+            code = (stream.decompress(bytes(blob.compressed)) + stream.flush()).decode("utf-8")
+            blob.search_words = " ".join(dict.fromkeys(re.findall(r"\w+", code)))
+        CodeBlob.objects.bulk_update(blobs, ["search_words"])
+        last_id = blobs[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('snippets', '0016_codeblob_compressed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='codeblob',
+            name='search_words',
+            field=models.TextField(editable=False, null=True),
+        ),
+        migrations.RunPython(fill_search_words, migrations.RunPython.noop),
+        # Reverted before the column is removed, SQLite can't drop it while the index reads it
+        migrations.RunPython(index_search_words, index_code),
+    ]
@@ -1,28 +1,255 @@
 from __future__ import unicode_literals
 
+import hashlib
+import math
+import re
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 
-from pygments import formatters, highlight, lexers
-from pygments.lexers import get_all_lexers
-from pygments.util import ClassNotFound
+from . import codec
+from .caching import SIDEBAR_SCOPE, invalidate
+from .highlighting import (
+    FULL,
+    HIGHLIGHT_OPTIONS,
+    PAGED,
+    highlight_cache,
+    line_page,
+    registry,
+    render_plain,
+    size_tier,
+)
+from .lexers import lexer_choices
+from .metrics import timed, timer
 
 
 class Language(models.Model):
-    LEXERS_NAMES = ((lexer[1][0], lexer[0]) for lexer in get_all_lexers() if lexer[1]) # Use a generator to reduce memory
-
-    name = models.CharField(max_length=50, choices=LEXERS_NAMES)
+    name = models.CharField(max_length=50, choices=lexer_choices)
     slug = models.CharField(max_length=50, unique=True)
 
     def __str__(self):
         return self.name
     
     def get_lexer(self):
-        try:
-            return lexers.get_lexer_by_name(self.name)
-        except ClassNotFound:
-            # Return "text" if not found the lexer
-            return lexers.get_lexer_by_name("text")
+        return registry.lexer(self.name)
+
+class SharedBlob(models.Model):
+    """
+    Content shared by every snippet with the same `digest`.
+
+    `references` counts the snippets that point to the blob. Blobs left without
+    references are deleted by `collect`, not on release, so a snippet that is
+    attaching the same blob at that moment never points to a deleted row.
+    """
+    digest = models.CharField(max_length=64, unique=True)
+    references = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def add_references(cls, counts):
+        """ Adds the {blob_id: references} counts """
+        if counts:
+            cls.objects.filter(id__in=counts).update(
+                references=models.F("references") + models.Case(
+                    *[models.When(id=blob_id, then=models.Value(count)) for blob_id, count in counts.items()]
+                )
+            )
+
+    @classmethod
+    def release(cls, blob_id):
+        cls.objects.filter(id=blob_id, references__gt=0).update(references=models.F("references") - 1)
+
+    @classmethod
+    def collect(cls):
+        """ Deletes the blobs no snippet points to, returns how many """
+        reference = cls._meta.get_field("snippets").field
+        unused = cls.objects.filter(references=0).exclude(
+            models.Exists(reference.model.objects.filter(**{reference.name: models.OuterRef("pk")}))
+        )
+        return unused.delete()[0]
+
+
+class HighlightBlob(SharedBlob):
+    """
+    Highlighted HTML shared by every snippet with the same code and language.
+    `digest` identifies the code, the language and the formatter options.
+    """
+    html = models.TextField()
+
+    @classmethod
+    def attach(cls, snippet_id, updated, digest, html):
+        """
+        Points the snippet to the blob of `digest`, creating it with `html` if it's
+        the first one, and returns whether the snippet was updated. A snippet edited
+        since `updated` is left alone, its edit queued the render of the new code.
+        """
+        with transaction.atomic():
+            blob, created = cls.objects.get_or_create(digest=digest, defaults={"html": html})
+            if not created and blob.html != html:
+                # Rendered again, after a change of the formatter or of pygments
+                cls.objects.filter(id=blob.id).update(html=html)
+            snippet = Snippet.objects.filter(id=snippet_id, updated=updated)
+            current = list(snippet.values_list("highlight_blob_id", flat=True))
+            if not current:
+                return False
+            previous = current[0]
+            if previous != blob.id:
+                snippet.update(highlight_blob=blob)
+                cls.objects.filter(id=blob.id).update(references=models.F("references") + 1)
+                if previous:
+                    cls.release(previous)
+        return True
+
+
+class CodeDictionary(models.Model):
+    """
+    Preset zlib dictionary trained on a sample of the code, see `recompress_snippets`.
+    A dictionary never changes, the blobs compressed with it keep pointing to it.
+    """
+    data = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    # Dictionaries already read by the process, by id
+    loaded = {}
+
+    @classmethod
+    def load(cls, dictionary_id):
+        """ The bytes of a dictionary, empty for the code compressed without one """
+        if dictionary_id is None:
+            return b""
+        if dictionary_id not in cls.loaded:
+            cls.loaded[dictionary_id] = bytes(cls.objects.get(id=dictionary_id).data)
+        return cls.loaded[dictionary_id]
+
+    @classmethod
+    async def aload(cls, dictionary_id):
+        """ `load` for the async code, so the decoding that follows doesn't query """
+        if dictionary_id is not None and dictionary_id not in cls.loaded:
+            dictionary = await cls.objects.aget(id=dictionary_id)
+            cls.loaded[dictionary_id] = bytes(dictionary.data)
+        return cls.load(dictionary_id)
+
+    @classmethod
+    def latest(cls):
+        return cls.objects.order_by("-id").values_list("id", flat=True).first()
+
+
+class CodeBlob(SharedBlob):
+    """
+    Code shared by every snippet with the same code and language, see `Snippet.snippet`.
+    `size` is the length of the code, the size tiers read it instead of the code.
+
+    With SNIPPET_CODE_COMPRESSION the code is stored in `compressed` instead, with zlib
+    and the latest `CodeDictionary`, and `code` is left empty. `text` reads it either way.
+    The full text search indexes the `search_words` of a compressed code instead.
+    """
+    code = models.TextField(blank=True)
+    size = models.PositiveIntegerField()
+    compressed = models.BinaryField(null=True, editable=False)
+    dictionary = models.ForeignKey(
+        CodeDictionary,
+        null=True,
+        editable=False,
+        on_delete=models.PROTECT,
+        related_name="blobs",
+    )
+    # The distinct words of a compressed code, None for a plain one
+    search_words = models.TextField(null=True, editable=False)
+
+    @property
+    def text(self):
+        return self.decode(self.code, self.compressed, self.dictionary_id)
+
+    @classmethod
+    def decode(cls, code, compressed, dictionary_id):
+        """ The code of a blob from its columns """
+        if compressed is None:
+            return code
+        return cls.read(compressed, dictionary_id)
+
+    @staticmethod
+    def read(compressed, dictionary_id, start=0, length=None):
+        """ The compressed code, or `length` characters of it from `start` """
+        dictionary = CodeDictionary.load(dictionary_id)
+        if length is None:
+            return codec.decompress(compressed, dictionary)
+        return codec.decompress_range(compressed, dictionary, start, length)
+
+    @staticmethod
+    def read_chunks(compressed, dictionary_id):
+        """ The compressed code a piece at a time """
+        return codec.decompress_chunks(compressed, CodeDictionary.load(dictionary_id))
+
+    def compress(self, dictionary_id):
+        """
+        Stores the code compressed with a dictionary, or plain if that doesn't make it
+        smaller. Returns whether it's compressed.
+        """
+        code = self.text
+        compressed = codec.compress(code, CodeDictionary.load(dictionary_id))
+        if len(compressed) >= len(code.encode("utf-8")):
+            self.decompress()
+            return False
+        self.code, self.compressed, self.dictionary_id = "", compressed, dictionary_id
+        self.search_words = self.words_of(code)
+        return True
+
+    def decompress(self):
+        self.code, self.compressed, self.dictionary_id = self.text, None, None
+        self.search_words = None
+
+    @staticmethod
+    def words_of(code):
+        """ The distinct words of a code in order, all the full text search needs of it """
+        return " ".join(dict.fromkeys(re.findall(r"\w+", code)))
+
+    @staticmethod
+    def digest_of(code, language_name):
+        """ Content address of a code in a language """
+        return hashlib.sha256(("%s\n%s" % (language_name, code)).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def store(cls, snippets):
+        """
+        Points each snippet to the blob of its code and language, creating the ones that
+        don't exist yet, and counts the new references. The previous blobs of the
+        snippets are left to the caller.
+        """
+        if not snippets:
+            return
+        digests = [cls.digest_of(snippet.snippet, snippet.language.name) for snippet in snippets]
+        blobs = dict(cls.objects.filter(digest__in=set(digests)).values_list("digest", "id"))
+        missing = {digest: snippet.snippet for digest, snippet in zip(digests, snippets) if digest not in blobs}
+        if missing:
+            new_blobs = [cls(digest=digest, code=code, size=len(code)) for digest, code in missing.items()]
+            if settings.SNIPPET_CODE_COMPRESSION:
+                dictionary_id = CodeDictionary.latest()
+                for blob in new_blobs:
+                    blob.compress(dictionary_id)
+            cls.objects.bulk_create(new_blobs, ignore_conflicts=True)
+            blobs.update(cls.objects.filter(digest__in=missing).values_list("digest", "id"))
+        counts = {}
+        for digest, snippet in zip(digests, snippets):
+            snippet.code_blob_id = blobs[digest]
+            snippet._code_digest = digest
+            counts[snippet.code_blob_id] = counts.get(snippet.code_blob_id, 0) + 1
+        cls.add_references(counts)
+
+
+class SnippetQuerySet(models.QuerySet):
+
+    def bulk_create(self, objs, *args, **kwargs):
+        """ Stores the code of the new snippets in their blobs first, like `Snippet.save` """
+        objs = list(objs)
+        with transaction.atomic(using=self.db, savepoint=False):
+            CodeBlob.store([snippet for snippet in objs if snippet.code_blob_id is None])
+            return super().bulk_create(objs, *args, **kwargs)
+
 
 class Snippet(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -30,12 +257,320 @@ class Snippet(models.Model):
     updated = models.DateTimeField(auto_now=True)
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True)
-    snippet = models.TextField()
     language = models.ForeignKey(Language, on_delete=models.CASCADE)
     public = models.BooleanField(default=False)
+    # The code, read and written through `snippet`
+    code_blob = models.ForeignKey(CodeBlob, editable=False, on_delete=models.PROTECT, related_name="snippets")
+    # Rendered by the renderSnippetHighlight task after each create or edit, shared by duplicates
+    highlight_blob = models.ForeignKey(
+        HighlightBlob,
+        null=True,
+        blank=True,
+        editable=False,
+        on_delete=models.SET_NULL,
+        related_name="snippets",
+    )
+
+    objects = SnippetQuerySet.as_manager()
+
+    # Code set on the snippet or already read from its blob, and the digest of its blob when known
+    _code = None
+    _code_digest = None
 
     class Meta:
         ordering = ("-created",)
-    
-    def highlight(self):
-        return highlight(self.snippet, self.language.get_lexer(), formatters.HtmlFormatter(linenos=True))
\ No newline at end of file
+        # One index per listing, all of them ending in the (-created, -id) order of the pagination.
+        # The public ones are partial because `public=True` is compiled as a bare boolean column.
+        indexes = [
+            models.Index(
+                fields=["-created", "-id"],
+                condition=models.Q(public=True),
+                name="snippet_public_created_idx",
+            ),
+            models.Index(fields=["user", "-created", "-id"], name="snippet_user_created_idx"),
+            models.Index(
+                fields=["language", "-created", "-id"],
+                condition=models.Q(public=True),
+                name="snippet_lang_public_idx",
+            ),
+            models.Index(fields=["user", "public"], name="snippet_user_public_idx"),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Keep the loaded values to know which highlight has to be invalidated on save
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    @property
+    def snippet(self):
+        """ The code, kept in the `CodeBlob` the snippet shares with its duplicates """
+        if self._code is None and self.code_blob_id:
+            self._code = self.code_blob.text
+            if "digest" not in self.code_blob.get_deferred_fields():
+                self._code_digest = self.code_blob.digest
+        return self._code or ""
+
+    @snippet.setter
+    def snippet(self, code):
+        self._code = code
+
+    def refresh_from_db(self, *args, **kwargs):
+        self._code = self._code_digest = None
+        super().refresh_from_db(*args, **kwargs)
+
+    def save(self, *args, **kwargs):
+        previous_code_blob_id = self.code_blob_id
+        previous_key = None
+        previous_blob_id = None
+        with transaction.atomic():
+            if kwargs.get("update_fields") is None and self._code_changed():
+                if previous_code_blob_id:
+                    previous_key = self._previous_highlight_key(self.code_blob.text)
+                CodeBlob.store([self])
+                # The stored render belongs to the previous code, it is rendered again by the task
+                previous_blob_id = self.highlight_blob_id
+                self.highlight_blob = None
+            counted = self._previous_counted(kwargs.get("update_fields"), kwargs.get("force_insert"))
+            super().save(*args, **kwargs)
+            if counted is not False and counted != self._counted():
+                if counted is not None:
+                    count_snippets([counted], -1)
+                count_snippets([self._counted()])
+            if previous_code_blob_id and previous_code_blob_id != self.code_blob_id:
+                CodeBlob.release(previous_code_blob_id)
+        if previous_blob_id:
+            HighlightBlob.release(previous_blob_id)
+        if previous_key and previous_key != self._highlight_key():
+            highlight_cache.delete(previous_key)
+        self._loaded_values = {"code_blob_id": self.code_blob_id, "language_id": self.language_id, "public": self.public}
+
+    def _code_changed(self):
+        """ Whether the code or the language no longer match the blob of the snippet """
+        if self.code_blob_id is None:
+            return True
+        language_id = getattr(self, "_loaded_values", {}).get("language_id", models.DEFERRED)
+        if self._code is None and language_id == self.language_id:
+            return False
+        if self._code_digest is None:
+            self._code_digest = CodeBlob.objects.filter(id=self.code_blob_id).values_list("digest", flat=True).first()
+        return CodeBlob.digest_of(self.snippet, self.language.name) != self._code_digest
+
+    def delete(self, *args, **kwargs):
+        key = self._highlight_key()
+        result = super().delete(*args, **kwargs)
+        highlight_cache.delete(key)
+        return result
+
+    def _counted(self):
+        """ What the counters know of the snippet """
+        return (self.user_id, self.language_id, self.public)
+
+    def _previous_counted(self, update_fields, force_insert):
+        """
+        The counted values of the stored row, None for a new snippet and False when the
+        save doesn't touch them. The row is locked so concurrent edits count in turn.
+        """
+        if update_fields is not None and not {"user", "language", "public"} & set(update_fields):
+            return False
+        if self.pk is None or force_insert:
+            return None
+        rows = Snippet.objects.select_for_update().filter(pk=self.pk)
+        return rows.values_list("user_id", "language_id", "public").first()
+
+    @timed("highlight")
+    def highlight(self, refresh=False):
+        """
+        Highlighted HTML of the snippet, only of its first page of lines for the PAGED tier.
+        With `refresh` it's rendered again instead of read from the highlight cache.
+        """
+        tier = size_tier(len(self.snippet))
+        if tier == FULL:
+            return highlight_cache.get_or_render(self.snippet, self.language, HIGHLIGHT_OPTIONS, refresh)
+        if tier == PAGED:
+            return self.highlight_page(line_page(self.snippet)[0], 1, refresh)
+        return ""
+
+    @timed("highlight")
+    def highlight_page(self, code, line, refresh=False):
+        """
+        Highlighted HTML of a page of lines of the snippet, see `line_page`, numbered from `line`.
+        Each page is lexed on its own, so a string or comment that crosses from the
+        previous page may be highlighted as code.
+        """
+        options = dict(HIGHLIGHT_OPTIONS, linenostart=line)
+        return highlight_cache.get_or_render(code, self.language, options, refresh)
+
+    async def ahighlight_page(self, code, line):
+        """ `highlight_page` for the async views """
+        options = dict(HIGHLIGHT_OPTIONS, linenostart=line)
+        with timer("highlight"):
+            return await highlight_cache.aget_or_render(code, self.language, options)
+
+    @property
+    def highlighted(self):
+        """ The stored highlighted HTML, empty while it is pending """
+        return self.highlight_blob.html if self.highlight_blob_id else ""
+
+    def rendered_highlight(self):
+        """
+        Returns the highlighted HTML without rendering it in the request.
+        While the render is pending it falls back to the escaped plain code.
+        """
+        if self.highlighted:
+            return self.highlighted
+        return highlight_cache.get(self._highlight_key()) or render_plain(self.snippet)
+
+    @property
+    def is_highlight_pending(self):
+        return self.highlight_blob_id is None
+
+    def highlight_digest(self):
+        """ Content address of the highlight: the code, the language and the formatter options """
+        return hashlib.sha256(self._highlight_key().encode("utf-8")).hexdigest()
+
+    def _highlight_key(self):
+        return highlight_cache.key(self.snippet, self.language.name, HIGHLIGHT_OPTIONS)
+
+    def _previous_highlight_key(self, code):
+        """ Key of the highlight of the stored code, in the language the snippet was loaded with """
+        language_id = getattr(self, "_loaded_values", {}).get("language_id", models.DEFERRED)
+        if language_id is models.DEFERRED:
+            return None
+        if language_id == self.language_id:
+            language_name = self.language.name
+        else:
+            language_name = Language.objects.filter(pk=language_id).values_list("name", flat=True).first()
+        return highlight_cache.key(code, language_name, HIGHLIGHT_OPTIONS)
+
+
+class SnippetCounter(models.Model):
+    """
+    Snippets, total and public, of a language or a user. They are updated in the
+    transaction of every write of a snippet, see `count_snippets`, so reading a count
+    is reading a row. `manage.py reconcile_counters` checks them against the table.
+    """
+    total = models.IntegerField(default=0)
+    public = models.IntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def add(cls, deltas):
+        """ Adds the {pk: (total, public)} deltas. Rows are only created to add to them """
+        for pk, (total, public) in deltas.items():
+            if not total and not public:
+                continue
+            rows = cls.objects.filter(pk=pk)
+            changes = {"total": models.F("total") + total, "public": models.F("public") + public}
+            if not rows.update(**changes) and total > 0:
+                cls.objects.bulk_create([cls(pk=pk)], ignore_conflicts=True)
+                rows.update(**changes)
+
+
+class LanguageCounter(SnippetCounter):
+    language = models.OneToOneField(Language, primary_key=True, on_delete=models.CASCADE, related_name="counter")
+
+
+class UserCounter(SnippetCounter):
+    user = models.OneToOneField(User, primary_key=True, on_delete=models.CASCADE, related_name="snippet_counter")
+
+
+def count_snippets(rows, sign=1):
+    """ Adds to the counters, or removes with sign=-1, the (user_id, language_id, public) of some snippets """
+    languages = {}
+    users = {}
+    for user_id, language_id, public in rows:
+        for deltas, pk in ((languages, language_id), (users, user_id)):
+            total, public_total = deltas.get(pk, (0, 0))
+            deltas[pk] = (total + sign, public_total + sign * int(public))
+    LanguageCounter.add(languages)
+    UserCounter.add(users)
+    if any(public_total for total, public_total in languages.values()):
+        # The language sidebar shows the public counts on every listing that has it
+        invalidate(SIDEBAR_SCOPE)
+
+
+# Trends are logarithms of views weighted forward from this moment, see `add_trend`
+TREND_EPOCH = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def trend_offset(now):
+    """ Half-lives elapsed from TREND_EPOCH to `now` """
+    return (now - TREND_EPOCH).total_seconds() / settings.TRENDING_HALF_LIFE
+
+
+def add_trend(trend, views, now):
+    """
+    log2 of 2**trend + views * 2**trend_offset(now). Weighting each view forward
+    instead of decaying the old ones keeps the trends of every snippet comparable
+    without rewriting them, and the logarithm keeps the weights in a float.
+    """
+    value = math.log2(views) + trend_offset(now)
+    if trend is None:
+        return value
+    high, low = max(trend, value), min(trend, value)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+class SnippetPopularity(models.Model):
+    """
+    Views of a snippet, written in batches from the buffered hits, see `snippets/popularity.py`.
+    `trend` orders the trending listing: the views of the last TRENDING_HALF_LIFE
+    weigh twice as much as the ones of the half-life before.
+    """
+    snippet = models.OneToOneField(Snippet, primary_key=True, on_delete=models.CASCADE, related_name="popularity")
+    views = models.PositiveBigIntegerField(default=0)
+    trend = models.FloatField(db_index=True)
+
+    def add(self, views, now):
+        self.views += views
+        self.trend = add_trend(self.trend, views, now)
+
+    def score(self, now=None):
+        """ The views, each one halved for every TRENDING_HALF_LIFE elapsed since """
+        return 2 ** (self.trend - trend_offset(now or timezone.now()))
+
+
+class SnippetToken(models.Model):
+    """ Inverted index of the tokens the lexer of the language finds in a snippet """
+    NAME = "name"
+    KEYWORD = "keyword"
+    STRING = "string"
+    KINDS = (
+        (NAME, "Name"),
+        (KEYWORD, "Keyword"),
+        (STRING, "String"),
+    )
+
+    snippet = models.ForeignKey(Snippet, on_delete=models.CASCADE, related_name="tokens")
+    token = models.CharField(max_length=100)
+    kind = models.CharField(max_length=10, choices=KINDS)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["token", "kind", "snippet"], name="snippet_token_unique"),
+        ]
+
+
+class EmailNotification(models.Model):
+    """ Email waiting to be delivered in a batch by the sendPendingEmails task """
+    recipient = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    error = models.TextField(blank=True)
+
+
+class OutboxEvent(models.Model):
+    """ Task call saved with the change that caused it, relayed to the broker by the relayOutbox task """
+    task = models.CharField(max_length=255)
+    args = models.JSONField(default=list)
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now, db_index=True)
+    error = models.TextField(blank=True)
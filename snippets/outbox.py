@@ -0,0 +1,120 @@
+import logging
+import time
+from contextlib import nullcontext
+from datetime import timedelta
+from functools import partial
+
+from celery import current_app, signature
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+# Time a batch is reserved for the relay that took it, so another one doesn't send it again
+CLAIM_TIMEOUT = timedelta(minutes=5)
+
+
+def publish(*calls):
+    """
+    Saves task calls, such as `renderSnippetHighlight.s(snippet.id)`, to be sent to the
+    broker by the relay. Called inside the transaction of the change, a rollback
+    discards them too and a commit keeps them even if the broker is down.
+    With OUTBOX_RELAY_ON_COMMIT these events, and only these, are sent after the commit.
+    """
+    events = OutboxEvent.objects.bulk_create([OutboxEvent(task=call.task, args=list(call.args)) for call in calls])
+    if settings.OUTBOX_RELAY_ON_COMMIT:
+        transaction.on_commit(partial(relay_outbox, ids=[event.id for event in events]))
+
+
+def pending_events():
+    return OutboxEvent.objects.filter(
+        next_attempt__lte=timezone.now(),
+        attempts__lt=settings.OUTBOX_MAX_ATTEMPTS,
+    )
+
+
+def claim_batch(batch_size, ids=None):
+    """ Takes the next batch of pending events, skipping the ones another relay has locked """
+    with transaction.atomic():
+        events = pending_events().order_by("next_attempt", "id")
+        if ids is not None:
+            events = events.filter(id__in=ids)
+        if connection.features.has_select_for_update_skip_locked:
+            events = events.select_for_update(skip_locked=True)
+        batch = list(events[:batch_size])
+        OutboxEvent.objects.filter(id__in=[event.id for event in batch]).update(
+            next_attempt=timezone.now() + CLAIM_TIMEOUT
+        )
+    return batch
+
+
+def retry_later(events, error):
+    """ Exponential backoff: OUTBOX_RETRY_BACKOFF seconds, then twice that, and so on """
+    for event in events:
+        event.attempts += 1
+        event.error = str(error)
+        event.next_attempt = timezone.now() + timedelta(
+            seconds=settings.OUTBOX_RETRY_BACKOFF * 2 ** (event.attempts - 1)
+        )
+        event.save(update_fields=["attempts", "error", "next_attempt"])
+        if event.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+            logger.error("Giving up on outbox event %s (%s): %s", event.id, event.task, error)
+
+
+def producer():
+    # Eager tasks run in this process, there is no broker to connect to
+    if current_app.conf.task_always_eager:
+        return nullcontext()
+    return current_app.producer_or_acquire()
+
+
+def relay_batch(batch):
+    """
+    Sends a batch of events over a single broker connection and deletes the ones sent.
+    An event that fails is retried on its own, if the connection itself fails the
+    whole batch is. Returns the number sent.
+    """
+    sent = []
+    try:
+        with producer() as publisher:
+            for event in batch:
+                try:
+                    signature(event.task, args=event.args).apply_async(producer=publisher)
+                except Exception as error:
+                    logger.exception("Could not relay outbox event %s (%s)", event.id, event.task)
+                    retry_later([event], error)
+                else:
+                    sent.append(event.id)
+    except Exception as error:
+        logger.exception("Could not connect to the broker to relay the outbox")
+        retry_later([event for event in batch if event.id not in sent], error)
+    OutboxEvent.objects.filter(id__in=sent).delete()
+    return len(sent)
+
+
+def relay_outbox(batch_size=None, ids=None):
+    """
+    Sends every pending event to the broker, or only the ones of `ids`, batch by batch,
+    in the order they were saved. Delivery is at least once: an event whose send succeeded is sent again if
+    the relay stops before deleting it. Returns the number of events relayed and
+    failed and the throughput.
+    """
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    relayed = failed = 0
+    started = time.perf_counter()
+    while True:
+        batch = claim_batch(batch_size, ids)
+        if not batch:
+            break
+        sent = relay_batch(batch)
+        relayed += sent
+        failed += len(batch) - sent
+
+    seconds = time.perf_counter() - started
+    rate = relayed / seconds if seconds else 0
+    if relayed or failed:
+        logger.info("Relayed %s outbox events (%s failed) in %.2fs, %.1f events/s", relayed, failed, seconds, rate)
+    return {"relayed": relayed, "failed": failed, "seconds": seconds, "events_per_second": rate}
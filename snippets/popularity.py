@@ -0,0 +1,218 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from functools import lru_cache, wraps
+
+import redis
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.utils import timezone
+
+from .caching import TRENDING_SCOPE, invalidate
+from .models import Snippet, SnippetPopularity
+
+logger = logging.getLogger(__name__)
+
+# Hash of {snippet id: hits} every process pushes to, and the one a flush is writing
+PENDING_KEY = "snippet-views:pending"
+FLUSHING_KEY = "snippet-views:flushing"
+# Held by the flush writing FLUSHING_KEY, for FLUSH_LOCK_TIMEOUT seconds at most
+FLUSH_LOCK_KEY = "snippet-views:flush-lock"
+FLUSH_LOCK_TIMEOUT = 600
+
+
+class ViewBuffer:
+    """
+    Hits counted by this process since the last push. A hit is only a dict increment
+    under a lock: the thread of `start_pusher` pushes them every VIEW_BUFFER_INTERVAL
+    seconds, or as soon as the buffer holds VIEW_BUFFER_SIZE snippets, so no request
+    waits for Redis or the database. Hits still in the buffer when the process is
+    killed are lost.
+    """
+
+    def __init__(self):
+        self._hits = {}
+        self._lock = threading.Lock()
+        self._full = threading.Event()
+        # Process the pusher thread runs in, a forked process starts its own
+        self._pusher_pid = None
+
+    def add(self, snippet_id):
+        with self._lock:
+            self._hits[snippet_id] = self._hits.get(snippet_id, 0) + 1
+            full = len(self._hits) >= settings.VIEW_BUFFER_SIZE
+        if full:
+            self._full.set()
+        if self._pusher_pid is not None and self._pusher_pid != os.getpid():
+            self.start_pusher()
+
+    def take(self):
+        with self._lock:
+            hits, self._hits = self._hits, {}
+        return hits
+
+    def send(self):
+        """ Pushes the hits in the buffer """
+        push(self.take())
+
+    def start_pusher(self):
+        """
+        Starts the thread that pushes the buffer, once per process. The web server
+        starts it, see `django_snippets/wsgi.py`, the processes that don't serve
+        pages, like the celery worker and the tests, write their hits with `flush_views`.
+        """
+        with self._lock:
+            if self._pusher_pid == os.getpid():
+                return
+            self._pusher_pid = os.getpid()
+        threading.Thread(target=self._push_periodically, name="view-buffer", daemon=True).start()
+        atexit.register(self.send)
+
+    def _push_periodically(self):
+        while True:
+            self._full.wait(settings.VIEW_BUFFER_INTERVAL)
+            self._full.clear()
+            self.send()
+            # The thread keeps its own database connection
+            close_old_connections()
+
+
+buffer = ViewBuffer()
+
+
+@lru_cache
+def _redis(url):
+    return redis.Redis.from_url(url)
+
+
+def redis_client():
+    """ Client of VIEW_COUNTS_REDIS_URL, None when the hits go straight to the database """
+    url = settings.VIEW_COUNTS_REDIS_URL
+    return _redis(url) if url else None
+
+
+def push(hits):
+    """
+    Adds {snippet id: hits} to the hash in Redis, in one round trip, or to the database
+    when there is no Redis. If it fails the hits are dropped, the pusher goes on.
+    """
+    if not hits:
+        return
+    client = redis_client()
+    try:
+        if client is None:
+            write_views(hits)
+            return
+        pipeline = client.pipeline(transaction=False)
+        for snippet_id, count in hits.items():
+            pipeline.hincrby(PENDING_KEY, snippet_id, count)
+        pipeline.execute()
+    except (redis.RedisError, DatabaseError):
+        logger.exception("Dropped the views of %s snippets", len(hits))
+
+
+def record_view(snippet_id):
+    buffer.add(snippet_id)
+
+
+def count_views(view_func):
+    """
+    Counts a hit of the snippet of the `id` URL kwarg for every page served to a GET,
+    also the ones that come from the page cache, so it goes outside `cache_anonymous_page`.
+    Redirects and errors are not counted, a 304 is.
+    """
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def _wrapped_async_view(request, *args, **kwargs):
+            response = await view_func(request, *args, **kwargs)
+            if request.method == "GET" and response.status_code in (200, 304):
+                record_view(kwargs["id"])
+            return response
+        return _wrapped_async_view
+
+    @wraps(view_func)
+    def _wrapped_view(request, *args, **kwargs):
+        response = view_func(request, *args, **kwargs)
+        if request.method == "GET" and response.status_code in (200, 304):
+            record_view(kwargs["id"])
+        return response
+    return _wrapped_view
+
+
+def write_views(hits, now=None):
+    """
+    Adds {snippet id: hits} to the views and trends of the snippets, in a transaction
+    per VIEW_FLUSH_BATCH_SIZE snippets. Rows are locked in id order, so concurrent
+    writes wait for each other instead of losing views. Hits of deleted snippets are
+    dropped. Returns the number of snippets written.
+    """
+    now = now or timezone.now()
+    ids = sorted(hits)
+    batch_size = settings.VIEW_FLUSH_BATCH_SIZE
+    written = 0
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        with transaction.atomic():
+            rows = {
+                row.snippet_id: row
+                for row in SnippetPopularity.objects.select_for_update().filter(snippet_id__in=batch)
+            }
+            missing = [snippet_id for snippet_id in batch if snippet_id not in rows]
+            existing = set(Snippet.objects.filter(id__in=missing).values_list("id", flat=True)) if missing else set()
+            created = [SnippetPopularity(snippet_id=snippet_id) for snippet_id in missing if snippet_id in existing]
+            for row in list(rows.values()) + created:
+                row.add(hits[row.snippet_id], now)
+            SnippetPopularity.objects.bulk_update(list(rows.values()), ["views", "trend"])
+            SnippetPopularity.objects.bulk_create(created, ignore_conflicts=True)
+        written += len(rows) + len(created)
+    if written:
+        invalidate(TRENDING_SCOPE)
+    return written
+
+
+def release(lock):
+    try:
+        lock.release()
+    except redis.exceptions.LockNotOwnedError:
+        logger.warning("The flush outlived its lock of %ss, another one may have counted its views", FLUSH_LOCK_TIMEOUT)
+
+
+def flush_views():
+    """
+    Writes the hits buffered in this process and the ones every process pushed to
+    Redis. Without Redis the web processes write their hits themselves and the task
+    only writes the ones of its own process. The hash is renamed before it's read, the hits pushed meanwhile start a new
+    one. A flush that fails leaves it renamed and the next one writes it first, so a
+    failure after the commit can count those hits twice but never loses them.
+    Only one flush reads the hash at a time, another one that overlaps it only pushes
+    the hits of its process.
+    Returns the number of snippets and views written and the throughput.
+    """
+    started = time.perf_counter()
+    hits = buffer.take()
+    client = redis_client()
+    if client is None:
+        written = write_views(hits)
+    else:
+        push(hits)
+        lock = client.lock(FLUSH_LOCK_KEY, timeout=FLUSH_LOCK_TIMEOUT, blocking=False)
+        if not lock.acquire():
+            logger.info("Another flush is writing the views, skipped")
+            return {"snippets": 0, "views": 0, "seconds": time.perf_counter() - started}
+        try:
+            if client.exists(PENDING_KEY):
+                client.renamenx(PENDING_KEY, FLUSHING_KEY)
+            hits = {int(snippet_id): int(count) for snippet_id, count in client.hgetall(FLUSHING_KEY).items()}
+            written = write_views(hits)
+            client.delete(FLUSHING_KEY)
+        finally:
+            release(lock)
+
+    seconds = time.perf_counter() - started
+    views = sum(hits.values())
+    if written:
+        logger.info("Wrote %s views of %s snippets in %.2fs", views, written, seconds)
+    return {"snippets": written, "views": views, "seconds": seconds}
@@ -0,0 +1,284 @@
+from datetime import datetime
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Case, F, Q, When
+from django.db.models.functions import Substr
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
+
+from .highlighting import line_page, page_size
+from .models import CodeBlob, CodeDictionary, LanguageCounter, Snippet, UserCounter
+
+def listing(queryset):
+    """
+    Prepares a snippets queryset to be rendered as a list of cards. The code, which
+    the cards don't show, is in the code blobs and never joined.
+    """
+    return queryset.select_related("user", "language")
+
+
+def with_code_size(queryset):
+    """
+    Adds the size of the code as `code_size` and its first HIGHLIGHT_MAX_SIZE
+    characters as `code_head`, so a huge snippet is never loaded whole. A compressed
+    code comes as `code_compressed` and `code_dictionary` instead, see `code_head`,
+    but not for the snippets too big to be highlighted.
+    """
+    highlighted = Q(code_blob__size__lte=settings.SNIPPET_RAW_SIZE)
+    return queryset.annotate(
+        code_size=F("code_blob__size"),
+        code_head=Substr("code_blob__code", 1, settings.HIGHLIGHT_MAX_SIZE),
+        code_compressed=Case(When(highlighted, then=F("code_blob__compressed"))),
+        code_dictionary=F("code_blob__dictionary"),
+    )
+
+
+def code_head(snippet):
+    """ Decompresses the `code_head` of a snippet of `with_code_size` if its code is compressed """
+    if snippet.code_compressed is not None:
+        snippet.code_head = CodeBlob.read(
+            snippet.code_compressed, snippet.code_dictionary, 0, settings.HIGHLIGHT_MAX_SIZE
+        )
+    return snippet
+
+
+def code_range(start, length):
+    """
+    The columns to read `length` characters of the code from the character `start`:
+    only those of a plain code, and the whole code if it's compressed, see `CodeBlob.read`
+    """
+    return Substr("code_blob__code", start + 1, length), "code_blob__compressed", "code_blob__dictionary"
+
+
+def raw_chunks(snippet):
+    """
+    The code of a snippet in pieces of SNIPPET_RAW_CHUNK_SIZE characters, a query each.
+    Stops early if the snippet is edited or deleted while it's being read. A compressed
+    code is read in one query and decompressed as it's sent.
+    """
+    chunk_size = settings.SNIPPET_RAW_CHUNK_SIZE
+    rows = Snippet.objects.filter(id=snippet.id, updated=snippet.updated)
+    for start in range(0, snippet.code_size, chunk_size):
+        row = rows.values_list(*code_range(start, chunk_size)).first()
+        if row is None:
+            return
+        chunk, compressed, dictionary_id = row
+        if compressed is not None:
+            yield from CodeBlob.read_chunks(compressed, dictionary_id)
+            return
+        yield chunk
+
+
+async def araw_chunks(snippet):
+    """ `raw_chunks` for ASGI """
+    chunk_size = settings.SNIPPET_RAW_CHUNK_SIZE
+    rows = Snippet.objects.filter(id=snippet.id, updated=snippet.updated)
+    for start in range(0, snippet.code_size, chunk_size):
+        row = await rows.values_list(*code_range(start, chunk_size)).afirst()
+        if row is None:
+            return
+        chunk, compressed, dictionary_id = row
+        if compressed is not None:
+            await CodeDictionary.aload(dictionary_id)
+            for text in CodeBlob.read_chunks(compressed, dictionary_id):
+                yield text
+            return
+        yield chunk
+
+
+async def aiterate(queryset, chunk_size):
+    """
+    The rows of a queryset read `chunk_size` at a time, each chunk in the thread of the
+    sync ORM. `QuerySet.aiterator` runs the query of a `values_list` on the event loop.
+    """
+    rows = queryset.iterator(chunk_size=chunk_size)
+    next_chunk = sync_to_async(lambda: list(islice(rows, chunk_size)))
+    while True:
+        chunk = await next_chunk()
+        for row in chunk:
+            yield row
+        if len(chunk) < chunk_size:
+            return
+
+
+async def acode_page(snippet, offset):
+    """
+    The page of lines of the code that starts at the character `offset`, see `line_page`,
+    and the number of line ends in it. Only the characters of a page are read, or
+    decompressed up to them.
+    """
+    row = await Snippet.objects.filter(id=snippet.id).values_list(*code_range(offset, page_size())).afirst()
+    chunk, compressed, dictionary_id = row or ("", None, None)
+    if compressed is not None:
+        chunk = await sync_to_async(CodeBlob.read)(compressed, dictionary_id, offset, page_size())
+    return line_page(chunk or "", complete=offset + page_size() >= snippet.code_size)
+
+
+def index_snippets(user):
+    """
+    Public snippets plus the private ones of the authenticated user.
+
+    For an authenticated user the listing is returned as two disjoint querysets,
+    each one served in order by its own index, that `paginate` merges. A single
+    `public OR user` query can't use an index for the ordering.
+    """
+    public = Snippet.objects.filter(public=True)
+    if user.is_authenticated:
+        return [listing(public.exclude(user=user)), listing(Snippet.objects.filter(user=user))]
+    return listing(public)
+
+
+def user_snippets(owner, include_private=False):
+    """ Snippets of a user, the private ones only when the owner is asking """
+    snippets = Snippet.objects.filter(user=owner)
+    if not include_private:
+        snippets = snippets.filter(public=True)
+    return listing(snippets)
+
+
+def language_snippets(language):
+    """ Public snippets of a language """
+    return listing(Snippet.objects.filter(public=True, language=language))
+
+
+def trending_snippets():
+    """ Public snippets with views, the highest trend first """
+    snippets = Snippet.objects.filter(public=True, popularity__isnull=False).order_by("-popularity__trend", "-id")
+    return listing(snippets).select_related("popularity")
+
+
+def language_counters():
+    """ Languages with public snippets and how many, for the sidebar, from the counters """
+    return LanguageCounter.objects.filter(public__gt=0).select_related("language").order_by("language__name")
+
+
+def user_counter(owner):
+    """ Totals of a user, from the counters """
+    return UserCounter.objects.filter(user=owner)
+
+
+def encode_cursor(snippet):
+    """ Opaque token with the position of a snippet in the (-created, -id) ordering """
+    raw = "%s|%s" % (snippet.created.isoformat(), snippet.pk)
+    return urlsafe_base64_encode(raw.encode("utf-8"))
+
+
+def decode_cursor(token):
+    """ Returns the (created, id) of a cursor or None if the token is not valid """
+    try:
+        created, pk = urlsafe_base64_decode(token).decode("utf-8").split("|")
+        return datetime.fromisoformat(created), int(pk)
+    except (TypeError, ValueError):
+        return None
+
+
+class KeysetPage:
+    """ A page of snippets with the cursors to get the next and the previous ones """
+
+    def __init__(self, items, next_cursor=None, previous_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def has_other_pages(self):
+        return bool(self.next_cursor or self.previous_cursor)
+
+
+def paginate(queryset, after=None, before=None, page_size=None):
+    """
+    Keyset pagination over (created, id) in descending order.
+
+    Instead of an OFFSET each page starts from the position of the last row of the
+    previous one, so the cost of a page doesn't depend on how deep it is.
+    `after` returns the page that follows a cursor and `before` the one preceding it.
+    """
+    page_size, querysets, condition, ordering, after, before = _page_query(queryset, after, before, page_size)
+    rows = _fetch(querysets, condition, ordering, page_size + 1)
+    return _page(rows, page_size, after, before)
+
+
+async def apaginate(queryset, after=None, before=None, page_size=None):
+    """ `paginate` for the async views """
+    page_size, querysets, condition, ordering, after, before = _page_query(queryset, after, before, page_size)
+    rows = await _afetch(querysets, condition, ordering, page_size + 1)
+    return _page(rows, page_size, after, before)
+
+
+def _page_query(queryset, after, before, page_size):
+    """ The querysets, the keyset condition and the ordering of the page the cursors ask for """
+    page_size = page_size or settings.SNIPPETS_PAGE_SIZE
+    querysets = queryset if isinstance(queryset, (list, tuple)) else [queryset]
+    after = decode_cursor(after) if after else None
+    before = decode_cursor(before) if before else None
+    if before:
+        created, pk = before
+        return page_size, querysets, keyset_condition(created, pk, forward=False), ("created", "id"), after, before
+    condition = None
+    if after:
+        created, pk = after
+        condition = keyset_condition(created, pk)
+    return page_size, querysets, condition, ("-created", "-id"), after, before
+
+
+def _page(rows, page_size, after, before):
+    has_more = len(rows) > page_size
+    if before:
+        items = rows[:page_size][::-1]
+        return KeysetPage(
+            items,
+            next_cursor=encode_cursor(items[-1]) if items else None,
+            previous_cursor=encode_cursor(items[0]) if has_more else None,
+        )
+    items = rows[:page_size]
+    return KeysetPage(
+        items,
+        next_cursor=encode_cursor(items[-1]) if has_more else None,
+        previous_cursor=encode_cursor(items[0]) if after and items else None,
+    )
+
+
+def keyset_condition(created, pk, forward=True):
+    """
+    Rows after (or before) a cursor. The redundant bound on `created` lets the
+    database turn the condition into an index range instead of filtering a scan.
+    """
+    if forward:
+        return Q(created__lte=created) & (Q(created__lt=created) | Q(id__lt=pk))
+    return Q(created__gte=created) & (Q(created__gt=created) | Q(id__gt=pk))
+
+
+def keyset_querysets(querysets, condition, ordering, limit):
+    """ The sliced querysets `paginate` runs for a page """
+    if not isinstance(querysets, (list, tuple)):
+        querysets = [querysets]
+    if condition is not None:
+        querysets = [queryset.filter(condition) for queryset in querysets]
+    return [queryset.order_by(*ordering)[:limit] for queryset in querysets]
+
+
+def _fetch(querysets, condition, ordering, limit):
+    rows = []
+    for queryset in keyset_querysets(querysets, condition, ordering, limit):
+        rows.extend(queryset)
+    return _merge(rows, len(querysets), ordering, limit)
+
+
+async def _afetch(querysets, condition, ordering, limit):
+    rows = []
+    for queryset in keyset_querysets(querysets, condition, ordering, limit):
+        rows.extend([snippet async for snippet in queryset])
+    return _merge(rows, len(querysets), ordering, limit)
+
+
+def _merge(rows, count, ordering, limit):
+    if count > 1:
+        rows.sort(key=lambda snippet: (snippet.created, snippet.pk), reverse=ordering[0].startswith("-"))
+    return rows[:limit]
@@ -0,0 +1,202 @@
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import Snippet
+from .queries import listing
+
+SEARCH_LIMIT = 50
+
+# Postgres keeps a tsvector column with a GIN index, SQLite an external content FTS5
+# table, both filled by triggers on every save and delete. The code is read from the
+# blob the snippet points to: blobs never change and outlive the snippets that point
+# to them until they are collected, so the triggers always find the code. A compressed
+# code is indexed by its `search_words`.
+INSTALL_SQL = {
+    "postgresql": [
+        "ALTER TABLE snippets_snippet ADD COLUMN IF NOT EXISTS search_vector tsvector",
+        """
+        CREATE OR REPLACE FUNCTION snippets_snippet_search_vector() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector :=
+                setweight(to_tsvector('simple', coalesce(NEW.name, '')), 'A') ||
+                setweight(to_tsvector('simple', coalesce(NEW.description, '')), 'B') ||
+                setweight(to_tsvector('simple', coalesce(
+                    (SELECT coalesce(search_words, code) FROM snippets_codeblob WHERE id = NEW.code_blob_id), ''
+                )), 'C');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS snippets_snippet_search_vector ON snippets_snippet",
+        """
+        CREATE TRIGGER snippets_snippet_search_vector
+        BEFORE INSERT OR UPDATE OF name, description, code_blob_id ON snippets_snippet
+        FOR EACH ROW EXECUTE FUNCTION snippets_snippet_search_vector()
+        """,
+        # Fires the trigger on the existing rows
+        "UPDATE snippets_snippet SET name = name WHERE search_vector IS NULL",
+        "CREATE INDEX IF NOT EXISTS snippet_search_vector_idx ON snippets_snippet USING GIN (search_vector)",
+    ],
+    "sqlite": [
+        """
+        CREATE VIEW IF NOT EXISTS snippets_snippet_search AS
+        SELECT snippet.id, snippet.name, snippet.description, coalesce(blob.search_words, blob.code) AS snippet
+        FROM snippets_snippet snippet JOIN snippets_codeblob blob ON blob.id = snippet.code_blob_id
+        """,
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS snippets_snippet_fts USING fts5(
+            name, description, snippet,
+            content='snippets_snippet_search', content_rowid='id',
+            tokenize="unicode61 tokenchars '_'"
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_insert AFTER INSERT ON snippets_snippet BEGIN
+            INSERT INTO snippets_snippet_fts(rowid, name, description, snippet)
+            VALUES (
+                new.id, new.name, new.description,
+                (SELECT coalesce(search_words, code) FROM snippets_codeblob WHERE id = new.code_blob_id)
+            );
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_delete AFTER DELETE ON snippets_snippet BEGIN
+            INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, name, description, snippet)
+            VALUES (
+                'delete', old.id, old.name, old.description,
+                (SELECT coalesce(search_words, code) FROM snippets_codeblob WHERE id = old.code_blob_id)
+            );
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS snippets_snippet_fts_update
+        AFTER UPDATE OF name, description, code_blob_id ON snippets_snippet BEGIN
+            INSERT INTO snippets_snippet_fts(snippets_snippet_fts, rowid, name, description, snippet)
+            VALUES (
+                'delete', old.id, old.name, old.description,
+                (SELECT coalesce(search_words, code) FROM snippets_codeblob WHERE id = old.code_blob_id)
+            );
+            INSERT INTO snippets_snippet_fts(rowid, name, description, snippet)
+            VALUES (
+                new.id, new.name, new.description,
+                (SELECT coalesce(search_words, code) FROM snippets_codeblob WHERE id = new.code_blob_id)
+            );
+        END
+        """,
+        "INSERT INTO snippets_snippet_fts(snippets_snippet_fts) VALUES ('rebuild')",
+    ],
+}
+
+UNINSTALL_SQL = {
+    "postgresql": [
+        "DROP INDEX IF EXISTS snippet_search_vector_idx",
+        "DROP TRIGGER IF EXISTS snippets_snippet_search_vector ON snippets_snippet",
+        "DROP FUNCTION IF EXISTS snippets_snippet_search_vector()",
+        "ALTER TABLE snippets_snippet DROP COLUMN IF EXISTS search_vector",
+    ],
+    "sqlite": [
+        "DROP TRIGGER IF EXISTS snippets_snippet_fts_insert",
+        "DROP TRIGGER IF EXISTS snippets_snippet_fts_delete",
+        "DROP TRIGGER IF EXISTS snippets_snippet_fts_update",
+        "DROP TABLE IF EXISTS snippets_snippet_fts",
+        "DROP VIEW IF EXISTS snippets_snippet_search",
+    ],
+}
+
+# Indexes the code of the snippets of a range of blobs again, once it's compressed or
+# decompressed in place. The FTS5 index of SQLite is rebuilt whole, after every range.
+REINDEX_CODE_SQL = {
+    "postgresql": """
+        UPDATE snippets_snippet SET code_blob_id = code_blob_id
+        WHERE code_blob_id BETWEEN %(first_id)s AND %(last_id)s
+    """,
+}
+
+REBUILD_SQL = {
+    "sqlite": "INSERT INTO snippets_snippet_fts(snippets_snippet_fts) VALUES ('rebuild')",
+}
+
+SEARCH_SQL = {
+    "postgresql": """
+        SELECT id FROM snippets_snippet, websearch_to_tsquery('simple', %(query)s) query
+        WHERE search_vector @@ query AND (public OR user_id = %(user_id)s)
+        ORDER BY ts_rank(search_vector, query) DESC
+        LIMIT %(limit)s
+    """,
+    "sqlite": """
+        SELECT snippet.id FROM snippets_snippet_fts
+        JOIN snippets_snippet snippet ON snippet.id = snippets_snippet_fts.rowid
+        WHERE snippets_snippet_fts MATCH %(query)s AND (snippet.public OR snippet.user_id = %(user_id)s)
+        ORDER BY bm25(snippets_snippet_fts, 10.0, 5.0, 1.0)
+        LIMIT %(limit)s
+    """,
+}
+
+
+def install_search_index(schema_editor):
+    """
+    Creates the search index of the current database, it is safe to run it again.
+    SQLite drops the triggers when a migration rebuilds the snippets table, so those
+    migrations have to install it again. It can't rebuild the code blobs table while
+    the view of the index reads it, those migrations drop the index first.
+    """
+    for statement in INSTALL_SQL.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def uninstall_search_index(schema_editor):
+    for statement in UNINSTALL_SQL.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def reindex_code(first_id, last_id):
+    if connection.vendor in REINDEX_CODE_SQL:
+        with connection.cursor() as cursor:
+            cursor.execute(REINDEX_CODE_SQL[connection.vendor], {"first_id": first_id, "last_id": last_id})
+
+
+def rebuild_search_index():
+    if connection.vendor in REBUILD_SQL:
+        with connection.cursor() as cursor:
+            cursor.execute(REBUILD_SQL[connection.vendor])
+
+
+def search_terms(query):
+    """ Words of a search, anything that isn't part of an identifier is ignored """
+    return re.findall(r"\w+", query)
+
+
+def search_snippets(query, user, limit=SEARCH_LIMIT):
+    """
+    Returns the snippets that match a search ordered by relevance, matches in the
+    name weigh more than in the description and those more than in the code.
+    Only public snippets and the ones of the user are searched.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+    user_id = user.pk if user.is_authenticated else None
+
+    if connection.vendor not in SEARCH_SQL:
+        # Without a full text index the search falls back to a scan
+        snippets = Snippet.objects.filter(Q(public=True) | Q(user_id=user_id))
+        for term in terms:
+            snippets = snippets.filter(
+                Q(name__icontains=term)
+                | Q(description__icontains=term)
+                | Q(code_blob__code__icontains=term)
+                | Q(code_blob__search_words__icontains=term)
+            )
+        return list(listing(snippets)[:limit])
+
+    if connection.vendor == "sqlite":
+        # Every word quoted, so FTS5 doesn't read operators from the user input
+        query = " ".join('"%s"' % term for term in terms)
+    with connection.cursor() as cursor:
+        cursor.execute(SEARCH_SQL[connection.vendor], {"query": query, "user_id": user_id, "limit": limit})
+        ids = [row[0] for row in cursor.fetchall()]
+
+    snippets = listing(Snippet.objects.filter(id__in=ids)).in_bulk()
+    return [snippets[pk] for pk in ids if pk in snippets]
@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.db import models
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .caching import LANGUAGES_SCOPE, TRENDING_SCOPE, invalidate
+from .metrics import install_query_counter
+from .models import CodeBlob, HighlightBlob, Language, Snippet, count_snippets
+
+
+def snippet_scopes(snippet, created=False):
+    """ Cached pages that show a snippet, before and after the change """
+    loaded = getattr(snippet, "_loaded_values", {})
+    # When the previous state is unknown the snippet could have been public
+    was_public = not created and loaded.get("public", True)
+    scopes = ["snippet:%s" % snippet.pk, "user:%s" % snippet.user.username]
+    if snippet.public or was_public:
+        scopes += ["index", TRENDING_SCOPE, "language:%s" % snippet.language.slug]
+        previous_language = loaded.get("language_id", models.DEFERRED)
+        if previous_language not in (models.DEFERRED, snippet.language_id):
+            previous_slug = Language.objects.filter(pk=previous_language).values_list("slug", flat=True).first()
+            scopes.append("language:%s" % previous_slug)
+    return scopes
+
+
+@receiver(post_save, sender=Snippet)
+@receiver(post_delete, sender=Snippet)
+def invalidate_snippet_pages(sender, instance, created=False, **kwargs):
+    invalidate(*snippet_scopes(instance, created))
+
+
+@receiver(post_save, sender=Language)
+@receiver(post_delete, sender=Language)
+def invalidate_language_pages(sender, instance, **kwargs):
+    invalidate(LANGUAGES_SCOPE)
+
+
+@receiver(post_delete, sender=Snippet)
+def release_blobs(sender, instance, **kwargs):
+    if instance.highlight_blob_id:
+        HighlightBlob.release(instance.highlight_blob_id)
+    CodeBlob.release(instance.code_blob_id)
+
+
+@receiver(post_delete, sender=Snippet)
+def uncount_snippet(sender, instance, **kwargs):
+    # Also sent for cascades, inside the transaction of the delete
+    count_snippets([instance._counted()], -1)
+
+
+@receiver(connection_created)
+def count_queries(sender, connection, **kwargs):
+    """
+    The connections are per thread and the async views query from the thread of
+    sync_to_async, so each one counts the queries of the sampled requests on its own
+    """
+    if settings.METRICS_ENABLED:
+        install_query_counter(connection)
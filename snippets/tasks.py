@@ -1,14 +1,26 @@
 from celery import shared_task
-from django.core.mail import send_mail
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import F
 
-from django_snippets.settings import EMAIL_HOST_USER as sender
+from .highlighting import RAW, size_tier
+from .imports import import_snippets
+from .mail import pending_emails, queue_email, send_pending_emails
+from .models import CodeBlob, HighlightBlob, Snippet
+from .outbox import relay_outbox
+from .popularity import flush_views
+from .tokens import index_snippet_tokens
+
+HIGHLIGHT_PENDING_KEY = "highlight-pending:%s"
+HIGHLIGHT_PENDING_TIMEOUT = 60
 
 @shared_task(bind=True)
 def sendEmailInSnippetCreation(self, snippet_name, snippet_description, user_mail):
     """
         Celery task to send an email notification when a snippet is created.
 
-        This task sends an email to the user who created a snippet, confirming its successful creation.
+        This task queues an email to the user who created a snippet, confirming its successful creation.
 
         Parameters:
         - snippet_name (str): The name of the snippet created.
@@ -17,8 +29,11 @@ def sendEmailInSnippetCreation(self, snippet_name, snippet_description, user_mai
 
         Behavior:
         - If a user email is provided, the function constructs an email with the snippet details.
-        - Sends an email with the subject `"Snippet <snippet_name> created successfully"` from the configured sender email.
-        - The email body contains the snippet name and its description.
+        - The email has the subject `"Snippet <snippet_name> created successfully"` and its body
+          contains the snippet name and its description.
+        - The email is queued and delivered with the next batch by `sendPendingEmails`,
+          which is queued right away once a full batch is waiting, or every time with
+          EMAIL_SEND_ON_QUEUE.
 
         Returns:
         - None (the task executes asynchronously via Celery).
@@ -29,10 +44,138 @@ def sendEmailInSnippetCreation(self, snippet_name, snippet_description, user_mai
             'The snippet "' + snippet_name + '" was created with the following description: \n'
             + snippet_description
         )
-        send_mail(
-            subject=subject,
-            message=body,
-            from_email=sender,
-            recipient_list=[user_mail],
-            fail_silently=False,
-        )
+        queue_email(subject, body, user_mail)
+        # Whether the batch is full, without counting the whole queue
+        if settings.EMAIL_SEND_ON_QUEUE or pending_emails()[settings.EMAIL_BATCH_SIZE - 1:].exists():
+            sendPendingEmails.delay()
+
+@shared_task(bind=True)
+def sendPendingEmails(self):
+    """
+        Celery task to deliver the queued emails in batches over a reused SMTP connection.
+        It runs periodically from celery beat, every `EMAIL_FLUSH_INTERVAL` seconds.
+
+        Returns:
+        - dict: sent and failed messages, elapsed seconds and messages per second.
+    """
+    return send_pending_emails()
+
+@shared_task(bind=True)
+def relayOutbox(self):
+    """
+        Celery task to send the task calls saved in the outbox by the views to the broker,
+        in batches over a single connection.
+        It runs periodically from celery beat, every `OUTBOX_RELAY_INTERVAL` seconds.
+
+        Returns:
+        - dict: relayed and failed events, elapsed seconds and events per second.
+    """
+    return relay_outbox()
+
+@shared_task(bind=True)
+def renderSnippetHighlight(self, snippet_id):
+    """
+        Celery task to render the highlighted HTML of a snippet after it is created or edited.
+
+        Parameters:
+        - snippet_id (int): The id of the snippet to render.
+
+        Behavior:
+        - Points the snippet to the `HighlightBlob` of its code and language. A snippet with
+          the same code already rendered it, otherwise it is rendered through the highlight cache.
+        - The row is only updated if the snippet was not edited again while rendering,
+          in that case the newer edit queues its own render.
+        - Snippets past SNIPPET_RAW_SIZE are not highlighted, nor loaded.
+
+        Returns:
+        - None (the task executes asynchronously via Celery).
+    """
+    snippet = sized_snippet(snippet_id)
+    if snippet is None or size_tier(snippet.code_size) == RAW:
+        cache.delete(HIGHLIGHT_PENDING_KEY % snippet_id)
+        return
+    digest = snippet.highlight_digest()
+    html = HighlightBlob.objects.filter(digest=digest).values_list("html", flat=True).first()
+    if html is None:
+        html = snippet.highlight()
+    HighlightBlob.attach(snippet.id, snippet.updated, digest, html)
+    cache.delete(HIGHLIGHT_PENDING_KEY % snippet.id)
+
+
+@shared_task(bind=True)
+def collectHighlightBlobs(self):
+    """
+        Celery task to delete the highlight and code blobs no snippet points to anymore.
+        It runs periodically from celery beat, every `HIGHLIGHT_BLOB_COLLECT_INTERVAL` seconds.
+
+        Returns:
+        - int: The number of blobs deleted.
+    """
+    return HighlightBlob.collect() + CodeBlob.collect()
+
+
+@shared_task(bind=True)
+def flushSnippetViews(self):
+    """
+        Celery task to write the buffered views of the snippets into their view counts and trends.
+        It runs periodically from celery beat, every `VIEW_FLUSH_INTERVAL` seconds.
+
+        Returns:
+        - dict: snippets and views written and elapsed seconds.
+    """
+    return flush_views()
+
+
+@shared_task(bind=True)
+def indexSnippetTokens(self, snippet_id):
+    """
+        Celery task to update the token index of a snippet after it is created or edited.
+
+        Parameters:
+        - snippet_id (int): The id of the snippet to index.
+
+        Behavior:
+        - Snippets past SNIPPET_RAW_SIZE are not indexed.
+
+        Returns:
+        - None (the task executes asynchronously via Celery).
+    """
+    snippet = sized_snippet(snippet_id)
+    if snippet is not None and size_tier(snippet.code_size) != RAW:
+        index_snippet_tokens(snippet)
+
+
+def sized_snippet(snippet_id):
+    """ The snippet with the size of its code, the code itself is only loaded when it's used """
+    snippets = Snippet.objects.select_related("language").annotate(code_size=F("code_blob__size"))
+    return snippets.filter(id=snippet_id).first()
+
+
+@shared_task(bind=True)
+def importSnippets(self, path, username=None, public=False):
+    """
+        Celery task to import snippets in bulk from a NDJSON file or a directory of source files.
+
+        Parameters:
+        - path (str): The file or directory to import, it has to be readable by the worker.
+        - username (str): Owner of the rows that don't name their own user.
+        - public (bool): Default visibility of the rows that don't set it.
+
+        Behavior:
+        - Inserts the snippets in batches with their highlight and token index already rendered.
+        - Queues one summary email per user instead of one per snippet.
+        - Renders in the worker process itself, celery pool processes can't start their own.
+
+        Returns:
+        - dict: created and failed rows, elapsed seconds and snippets per second.
+    """
+    user = User.objects.get(username=username) if username else None
+    result = import_snippets(path, user, public=public)
+    result["errors"] = result["errors"][:100]
+    return result
+
+
+def queue_highlight(snippet_id):
+    """ Queues the render of a snippet unless there is one already pending """
+    if cache.add(HIGHLIGHT_PENDING_KEY % snippet_id, True, HIGHLIGHT_PENDING_TIMEOUT):
+        renderSnippetHighlight.delay(snippet_id)
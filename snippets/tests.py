@@ -1,11 +1,69 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import json
+import os
+import smtplib
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIHandler
+from django.core.mail import get_connection
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.shortcuts import render
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth.models import User
-from .models import Snippet, Language
+from .benchmarks import compare, generate_dataset, run_benchmarks
+from .backfill import Checkpoint, backfill_highlights, render_range, write_highlights
+from .codec import train_dictionary
+from .compression import benchmark
+from .counters import reconcile_counters
+from .highlighting import highlight_cache, registry
+from .imports import import_snippets
+from .lexers import lexer_choices, write_catalogue
+from .mail import queue_email, send_pending_emails
+from .metrics import registry as metrics_registry
+from .outbox import publish, relay_outbox
+from .popularity import ViewBuffer, buffer, flush_views, record_view, write_views
+from .search import search_snippets
+from .models import (
+    CodeBlob,
+    CodeDictionary,
+    EmailNotification,
+    HighlightBlob,
+    Language,
+    LanguageCounter,
+    OutboxEvent,
+    Snippet,
+    SnippetPopularity,
+    SnippetToken,
+    UserCounter,
+)
+from .tasks import (
+    indexSnippetTokens,
+    renderSnippetHighlight,
+    sendEmailInSnippetCreation,
+    sendPendingEmails,
+)
 
 class SnippetViewsTestCase(TestCase):
 
     def setUp(self):
+        cache.clear()
+        highlight_cache.clear()
         self.user = User.objects.create_user(username='testuser', password='testpassword')
         self.other_user = User.objects.create_user(username='testuser2', password='testpassword')
         self.language = Language.objects.create(name="Python", slug="python")
@@ -91,6 +149,22 @@ class SnippetViewsTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertContains(response, "Test Snippet")
 
+    def test_snippet_details_single_query(self):
+        renderSnippetHighlight(self.snippet.id)
+        with self.assertNumQueries(1):
+            self.client.get(reverse('snippet', args=[self.snippet.id]))
+
+    def test_snippet_edit_loads_snippet_once(self):
+        self.client.login(username='testuser', password='testpassword')
+        # Session, user, snippet and the languages of the form
+        with self.assertNumQueries(4):
+            self.client.get(reverse('snippet_edit', args=[self.snippet.id]))
+
+    def test_snippet_edit_missing(self):
+        self.client.login(username='testuser', password='testpassword')
+        response = self.client.get(reverse('snippet_edit', args=[self.snippet.id + 100]))
+        self.assertEqual(response.status_code, 404)
+
     # USER SNIPPETS 
     def test_user_snippets_owner(self):
         self.client.login(username='testuser', password='testpassword')
@@ -115,4 +189,1498 @@ class SnippetViewsTestCase(TestCase):
     def test_logout_view(self):
         self.client.login(username='testuser', password='testpassword')
         response = self.client.get(reverse('logout'))
-        self.assertRedirects(response, reverse('index'))
\ No newline at end of file
+        self.assertRedirects(response, reverse('index'))
+
+
+class HighlightCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        highlight_cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+        self.snippet = Snippet.objects.create(
+            user=self.user,
+            name="Test Snippet",
+            snippet="print('Hello, World!')",
+            language=self.language,
+            public=True
+        )
+
+    def test_filled_by_render_task(self):
+        renderSnippetHighlight(self.snippet.id)
+        highlight_cache.clear()
+        self.snippet.highlight()
+        self.assertEqual(highlight_cache.stats()["misses"], 0)
+        self.snippet.refresh_from_db()
+        self.assertIn('class="highlight"', self.snippet.highlighted)
+
+    def test_shared_tier_is_used_when_local_is_empty(self):
+        renderSnippetHighlight(self.snippet.id)
+        highlight_cache.clear()
+        Snippet.objects.get(id=self.snippet.id).highlight()
+        self.assertEqual(highlight_cache.stats()["shared_hits"], 1)
+
+    def test_pending_render_falls_back_to_plain_code(self):
+        cache.clear()
+        highlight_cache.clear()
+        snippet = Snippet.objects.get(id=self.snippet.id)
+        self.assertTrue(snippet.is_highlight_pending)
+        self.assertEqual(
+            snippet.rendered_highlight(),
+            '<div class="highlight"><pre>print(&#x27;Hello, World!&#x27;)</pre></div>'
+        )
+
+    def test_edit_clears_stored_render(self):
+        renderSnippetHighlight(self.snippet.id)
+        snippet = Snippet.objects.get(id=self.snippet.id)
+        snippet.snippet = "print('Updated!')"
+        snippet.save()
+        snippet.refresh_from_db()
+        self.assertEqual(snippet.highlighted, "")
+
+    def test_edit_invalidates_previous_render(self):
+        snippet = Snippet.objects.get(id=self.snippet.id)
+        previous_key = snippet._highlight_key()
+        snippet.snippet = "print('Updated!')"
+        snippet.save()
+        self.assertIsNone(cache.get(previous_key))
+        self.assertIn("Updated", snippet.highlight())
+
+
+class ListingQueriesTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.other_user = User.objects.create_user(username='testuser2', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+        for i in range(10):
+            Snippet.objects.create(
+                user=self.user if i % 2 else self.other_user,
+                name="Snippet %s" % i,
+                snippet="print(%s)" % i,
+                language=self.language,
+                public=bool(i % 3)
+            )
+
+    def test_index_anonymous_queries(self):
+        # Public snippets and the language counters
+        with self.assertNumQueries(2):
+            self.client.get(reverse('index'))
+
+    def test_index_authenticated_queries(self):
+        self.client.login(username='testuser', password='testpassword')
+        # Session, user, public snippets, the user's own snippets and the language counters
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('index'))
+        self.assertEqual(len(response.context["snippets"]), 8)
+
+    def test_user_snippets_queries(self):
+        # Owner, snippets and the user counter
+        with self.assertNumQueries(3):
+            self.client.get(reverse('user_snippets', args=[self.user.username]))
+
+    def test_language_snippets_queries(self):
+        # Language, snippets and the language counters
+        with self.assertNumQueries(3):
+            self.client.get(reverse('language', args=[self.language.slug]))
+
+    @override_settings(SNIPPETS_PAGE_SIZE=3)
+    def test_keyset_pagination(self):
+        expected = list(Snippet.objects.filter(public=True).order_by("-created", "-id"))
+        seen = []
+        response = self.client.get(reverse('index'))
+        while True:
+            seen.extend(response.context["snippets"])
+            next_cursor = response.context["page"].next_cursor
+            if not next_cursor:
+                break
+            response = self.client.get(reverse('index'), {"after": next_cursor})
+        self.assertEqual(seen, expected)
+
+        previous = self.client.get(reverse('index'), {"before": response.context["page"].previous_cursor})
+        self.assertEqual(list(previous.context["snippets"]), expected[-6:-3])
+
+    def test_invalid_cursor_returns_first_page(self):
+        response = self.client.get(reverse('index'), {"after": "not-a-cursor"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.context["page"].previous_cursor)
+
+    def test_listings_use_indexes(self):
+        call_command("explain_listings", stdout=StringIO())
+
+    def test_listing_leaves_the_code_out(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('index'))
+        self.assertFalse([query for query in queries if "codeblob" in query["sql"]])
+
+
+class SearchTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.other_user = User.objects.create_user(username='testuser2', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+        self.in_code = Snippet.objects.create(
+            user=self.user, name="Detail view", language=self.language, public=True,
+            snippet="snippet = get_object_or_404(Snippet, id=id)",
+        )
+        self.in_name = Snippet.objects.create(
+            user=self.user, name="get_object_or_404 example", language=self.language, public=True,
+            snippet="pass",
+        )
+        self.private = Snippet.objects.create(
+            user=self.other_user, name="Private", language=self.language, public=False,
+            snippet="get_object_or_404(User)",
+        )
+
+    def test_ranks_name_matches_first(self):
+        response = self.client.get(reverse('search'), {"q": "get_object_or_404"})
+        self.assertEqual(list(response.context["snippets"]), [self.in_name, self.in_code])
+
+    def test_includes_private_snippets_of_the_user(self):
+        self.client.login(username='testuser2', password='testpassword')
+        response = self.client.get(reverse('search'), {"q": "get_object_or_404"})
+        self.assertIn(self.private, response.context["snippets"])
+
+    def test_index_follows_edits_and_deletes(self):
+        self.in_code.snippet = "redirect('index')"
+        self.in_code.save()
+        self.in_name.delete()
+        response = self.client.get(reverse('search'), {"q": "get_object_or_404"})
+        self.assertEqual(list(response.context["snippets"]), [])
+
+    def test_operators_in_the_query_are_ignored(self):
+        response = self.client.get(reverse('search'), {"q": 'NEAR( "detail* -'})
+        self.assertEqual(response.status_code, 200)
+
+
+class TokenSearchTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+        self.snippet = Snippet.objects.create(
+            user=self.user, name="Detail view", language=self.language, public=True,
+            snippet="def detail(id):\n    return get_object_or_404(Snippet, id=id, name='render')",
+        )
+        indexSnippetTokens(self.snippet.id)
+
+    def test_search_by_token_kind(self):
+        response = self.client.get(reverse('search'), {"token": "get_object_or_404", "kind": "name"})
+        self.assertEqual(list(response.context["snippets"]), [self.snippet])
+        response = self.client.get(reverse('search'), {"token": "render", "kind": "name"})
+        self.assertEqual(list(response.context["snippets"]), [])
+        response = self.client.get(reverse('search'), {"token": "render", "kind": "string"})
+        self.assertEqual(list(response.context["snippets"]), [self.snippet])
+
+    def test_index_is_updated_on_edit(self):
+        self.snippet.snippet = "print(redirect)"
+        self.snippet.save()
+        indexSnippetTokens(self.snippet.id)
+        tokens = set(self.snippet.tokens.values_list("token", flat=True))
+        self.assertIn("redirect", tokens)
+        self.assertNotIn("get_object_or_404", tokens)
+
+    def test_rebuild_command(self):
+        SnippetToken.objects.all().delete()
+        call_command("rebuild_token_index", batch_size=1, stdout=StringIO())
+        self.assertTrue(self.snippet.tokens.filter(token="get_object_or_404", kind="name").exists())
+
+
+class LexerCatalogueTestCase(TestCase):
+
+    def test_choices_are_not_consumed(self):
+        field = Language._meta.get_field("name")
+        first = list(field.choices)
+        self.assertIn(("python", "Python"), first)
+        self.assertEqual(list(field.choices), first)
+
+    def test_precomputed_catalogue_is_used(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "lexer_catalogue.json")
+            write_catalogue(path)
+            with open(path) as catalogue:
+                data = json.load(catalogue)
+            data["lexers"] = [["python", "Python"]]
+            with open(path, "w") as catalogue:
+                json.dump(data, catalogue)
+            with mock.patch("snippets.lexers.CATALOGUE_PATH", path):
+                lexer_choices.cache_clear()
+                try:
+                    self.assertEqual(lexer_choices(), (("python", "Python"),))
+                finally:
+                    lexer_choices.cache_clear()
+
+
+class PygmentsRegistryTestCase(TestCase):
+
+    def setUp(self):
+        registry.invalidate()
+        self.language = Language.objects.create(name="python", slug="python")
+
+    def test_lexer_is_resolved_once(self):
+        self.assertIs(self.language.get_lexer(), Language.objects.get(id=self.language.id).get_lexer())
+
+    def test_unknown_language_falls_back_to_text(self):
+        language = Language(name="not-a-lexer", slug="unknown")
+        self.assertEqual(language.get_lexer().name, "Text only")
+        self.assertIs(language.get_lexer(), registry.lexer("not-a-lexer"))
+
+    def test_formatter_is_shared_per_options(self):
+        self.assertIs(registry.formatter({"linenos": True}), registry.formatter({"linenos": True}))
+        self.assertIsNot(registry.formatter({"linenos": True}), registry.formatter({}))
+
+    def test_language_admin_invalidates_the_lexer(self):
+        admin_user = User.objects.create_superuser(username='admin', password='admin123')
+        self.client.force_login(admin_user)
+        lexer = self.language.get_lexer()
+        self.client.post(
+            reverse('admin:snippets_language_change', args=[self.language.id]),
+            {"name": "ruby", "slug": "python"},
+        )
+        self.assertNotIn("python", registry._lexers)
+        self.assertIsNot(registry.lexer("python"), lexer)
+
+
+@override_settings(EMAIL_SEND_ON_QUEUE=False)
+class EmailDeliveryTestCase(TestCase):
+
+    def test_creation_email_is_queued_and_sent_in_batch(self):
+        for i in range(3):
+            sendEmailInSnippetCreation("Snippet %s" % i, "Description", "user%s@example.com" % i)
+        self.assertEqual(len(mail.outbox), 0)
+        with mock.patch("snippets.mail.get_connection", wraps=get_connection) as connection:
+            result = sendPendingEmails()
+        connection.assert_called_once()
+        self.assertEqual(result["sent"], 3)
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(mail.outbox[0].subject, 'Snippet "Snippet 0" created successfully')
+        self.assertFalse(EmailNotification.objects.exists())
+
+    @override_settings(EMAIL_BATCH_SIZE=2)
+    def test_full_batch_is_sent_right_away(self):
+        sendEmailInSnippetCreation("First", "", "user@example.com")
+        self.assertEqual(len(mail.outbox), 0)
+        sendEmailInSnippetCreation("Second", "", "user@example.com")
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_failed_message_is_retried_with_backoff(self):
+        queue_email("Fails", "", "fails@example.com")
+        queue_email("Works", "", "works@example.com")
+        backend = get_connection()
+        original = backend.send_messages
+
+        def send_messages(messages):
+            if messages[0].to == ["fails@example.com"]:
+                raise smtplib.SMTPRecipientsRefused({})
+            return original(messages)
+
+        backend.send_messages = send_messages
+        with mock.patch("snippets.mail.get_connection", return_value=backend):
+            result = send_pending_emails()
+        self.assertEqual((result["sent"], result["failed"]), (1, 1))
+        pending = EmailNotification.objects.get()
+        self.assertEqual(pending.attempts, 1)
+        self.assertGreater(pending.next_attempt, timezone.now())
+        self.assertEqual(send_pending_emails()["sent"], 0)
+
+    @override_settings(
+        EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+        EMAIL_HOST="smtp.example.com",
+        EMAIL_PORT=25,
+        EMAIL_USE_TLS=False,
+        EMAIL_BATCH_SIZE=2,
+    )
+    def test_one_smtp_connection_per_run(self):
+        for i in range(3):
+            queue_email("Snippet %s" % i, "", "user%s@example.com" % i)
+        with mock.patch("smtplib.SMTP") as smtp:
+            smtp.return_value.sendmail.return_value = {}
+            result = send_pending_emails()
+        self.assertEqual(result["sent"], 3)
+        # Two batches over the connection opened for the first one
+        smtp.assert_called_once_with("smtp.example.com", 25, local_hostname=mock.ANY)
+        self.assertEqual(smtp.return_value.sendmail.call_count, 3)
+        smtp.return_value.quit.assert_called_once()
+
+    @override_settings(
+        EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+        EMAIL_HOST="smtp.example.com",
+        EMAIL_PORT=25,
+        EMAIL_USE_TLS=False,
+        EMAIL_MAX_ATTEMPTS=2,
+        EMAIL_RETRY_BACKOFF=0,
+    )
+    def test_connection_failures_count_as_attempts(self):
+        queue_email("Unreachable", "", "user@example.com")
+        with mock.patch("smtplib.SMTP", side_effect=OSError("connection refused")):
+            with self.assertLogs("snippets.mail", level="WARNING"):
+                self.assertEqual(send_pending_emails()["failed"], 1)
+                self.assertEqual(send_pending_emails()["failed"], 1)
+            self.assertEqual(send_pending_emails()["failed"], 0)
+        self.assertEqual(EmailNotification.objects.get().attempts, 2)
+
+
+class PageCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+        self.snippet = Snippet.objects.create(
+            user=self.user, name="Test Snippet", snippet="print('Hello, World!')",
+            language=self.language, public=True,
+        )
+        renderSnippetHighlight(self.snippet.id)
+
+    def test_anonymous_page_is_cached(self):
+        first = self.client.get(reverse('index'))
+        with self.assertNumQueries(0):
+            second = self.client.get(reverse('index'))
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first["ETag"], second["ETag"])
+        self.assertIn("stale-while-revalidate", second["Cache-Control"])
+
+    def test_if_none_match(self):
+        etag = self.client.get(reverse('snippet', args=[self.snippet.id]))["ETag"]
+        response = self.client.get(reverse('snippet', args=[self.snippet.id]), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_snippet_edit_invalidates_pages(self):
+        self.client.get(reverse('index'))
+        self.client.get(reverse('language', args=[self.language.slug]))
+        self.client.get(reverse('snippet', args=[self.snippet.id]))
+        self.snippet.name = "Renamed Snippet"
+        self.snippet.save()
+        self.assertContains(self.client.get(reverse('index')), "Renamed Snippet")
+        self.assertContains(self.client.get(reverse('language', args=[self.language.slug])), "Renamed Snippet")
+        self.assertContains(self.client.get(reverse('snippet', args=[self.snippet.id])), "Renamed Snippet")
+
+    def test_snippet_made_private_leaves_the_index(self):
+        self.client.get(reverse('index'))
+        self.snippet.public = False
+        self.snippet.save()
+        self.assertNotContains(self.client.get(reverse('index')), "Test Snippet")
+
+    def test_language_edit_invalidates_pages(self):
+        self.client.get(reverse('index'))
+        self.language.slug = "py"
+        self.language.save()
+        self.assertContains(self.client.get(reverse('index')), reverse('language', args=["py"]))
+
+    def test_authenticated_pages_are_not_cached(self):
+        self.client.login(username='testuser', password='testpassword')
+        self.client.get(reverse('index'))
+        response = self.client.get(reverse('index'))
+        self.assertIsNotNone(response.context)
+
+    @override_settings(PAGE_CACHE_TIMEOUT=0)
+    def test_stale_page_is_served_while_revalidating(self):
+        self.client.get(reverse('index'))
+        with mock.patch("snippets.caching.cache.add", return_value=False):
+            with self.assertNumQueries(0):
+                response = self.client.get(reverse('index'))
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(2):
+            self.client.get(reverse('index'))
+
+
+class ConditionalRequestTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+        self.snippet = Snippet.objects.create(
+            user=self.user, name="Test Snippet", snippet="print('Hello, World!')",
+            language=self.language, public=True,
+        )
+        renderSnippetHighlight(self.snippet.id)
+        self.client.login(username='testuser', password='testpassword')
+
+    def test_details_not_modified(self):
+        url = reverse('snippet', args=[self.snippet.id])
+        response = self.client.get(url)
+        self.assertIn("Last-Modified", response)
+        with mock.patch("snippets.models.Snippet.rendered_highlight") as rendered_highlight:
+            not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+            self.assertEqual(not_modified.status_code, 304)
+            not_modified = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"])
+            self.assertEqual(not_modified.status_code, 304)
+        rendered_highlight.assert_not_called()
+        self.assertTemplateNotUsed(not_modified, "snippets/snippet.html")
+
+    def test_edit_changes_the_etag(self):
+        url = reverse('snippet', args=[self.snippet.id])
+        etag = self.client.get(url)["ETag"]
+        self.snippet.name = "Renamed Snippet"
+        self.snippet.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_pending_highlight_has_no_last_modified(self):
+        Snippet.objects.filter(id=self.snippet.id).update(highlight_blob=None)
+        response = self.client.get(reverse('snippet', args=[self.snippet.id]))
+        self.assertNotIn("Last-Modified", response)
+
+    def test_listing_not_modified(self):
+        for url in (reverse('index'), reverse('language', args=["python"]), reverse('user_snippets', args=["testuser"])):
+            etag = self.client.get(url)["ETag"]
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertTemplateNotUsed(response, "snippets/card.html")
+
+    def test_listing_has_no_last_modified(self):
+        other = Snippet.objects.create(
+            user=self.user, name="Other Snippet", snippet="pass", language=self.language, public=True,
+        )
+        response = self.client.get(reverse('index'))
+        self.assertNotIn("Last-Modified", response)
+        # Deleting the newest snippet leaves the page with older ones only
+        other.delete()
+        response = self.client.get(reverse('index'), HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, "Other Snippet")
+
+    def test_listing_etag_changes_with_a_new_snippet(self):
+        etag = self.client.get(reverse('index'))["ETag"]
+        Snippet.objects.create(
+            user=self.user, name="Other Snippet", snippet="pass", language=self.language, public=True,
+        )
+        response = self.client.get(reverse('index'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_cached_anonymous_page_keeps_the_validators(self):
+        self.client.logout()
+        url = reverse('snippet', args=[self.snippet.id])
+        response = self.client.get(url)
+        cached = self.client.get(url)
+        self.assertEqual(response["ETag"], cached["ETag"])
+        self.assertEqual(response["Last-Modified"], cached["Last-Modified"])
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=cached["Last-Modified"])
+        self.assertEqual(response.status_code, 304)
+
+
+class SnippetApiTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.other = User.objects.create_user(username='other', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+        for number in range(5):
+            Snippet.objects.create(
+                user=self.user, name="Snippet %s" % number, snippet="print(%s)" % number,
+                language=self.language, public=True,
+            )
+        self.private = Snippet.objects.create(
+            user=self.other, name="Private", snippet="secret", language=self.language, public=False,
+        )
+
+    def test_list_is_paginated_by_cursor(self):
+        response = self.client.get(reverse('api_snippets'), {"limit": 2}).json()
+        self.assertEqual([item["name"] for item in response["results"]], ["Snippet 4", "Snippet 3"])
+        self.assertIsNone(response["previous"])
+        following = self.client.get(response["next"]).json()
+        self.assertEqual([item["name"] for item in following["results"]], ["Snippet 2", "Snippet 1"])
+        self.assertIn("limit=2", following["previous"])
+
+    def test_field_selection_skips_the_code(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api_snippets'), {"fields": "id,name,language"})
+        self.assertEqual(set(response.json()["results"][0]), {"id", "name", "language"})
+        self.assertEqual(response.json()["results"][0]["language"], "python")
+        self.assertNotIn("codeblob", queries.captured_queries[-1]["sql"])
+
+    def test_unknown_field(self):
+        response = self.client.get(reverse('api_snippets'), {"fields": "name,password"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_private_snippets(self):
+        self.assertEqual(self.client.get(reverse('api_snippet', args=[self.private.id])).status_code, 404)
+        names = [item["name"] for item in self.client.get(reverse('api_snippets'), {"user": "other"}).json()["results"]]
+        self.assertEqual(names, [])
+        self.client.login(username='other', password='testpassword')
+        response = self.client.get(reverse('api_snippet', args=[self.private.id]), {"fields": "snippet"})
+        self.assertEqual(response.json(), {"snippet": "secret"})
+
+    def test_export_streams_ndjson(self):
+        response = self.client.get(reverse('api_snippets_export'), {"fields": "id,name"})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode("utf-8").splitlines()
+        self.assertEqual([json.loads(line)["name"] for line in lines], ["Snippet %s" % n for n in range(5)])
+
+    @mock.patch("snippets.api.EXPORT_CHUNK_SIZE", 2)
+    async def test_export_streams_an_async_iterator_under_asgi(self):
+        response = await self.async_client.get(reverse('api_snippets_export'), {"fields": "id,name"})
+        self.assertTrue(response.is_async)
+        lines = [json.loads(line) async for line in response.streaming_content]
+        self.assertEqual([line["name"] for line in lines], ["Snippet %s" % n for n in range(5)])
+
+
+class SnippetImportTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword', email='test@example.com')
+        self.other = User.objects.create_user(username='other', password='testpassword', email='other@example.com')
+        self.language = Language.objects.create(name="python", slug="python")
+        self.directory = tempfile.mkdtemp()
+
+    def write_ndjson(self, rows):
+        path = os.path.join(self.directory, "snippets.ndjson")
+        with open(path, "w") as ndjson:
+            for row in rows:
+                ndjson.write(json.dumps(row) + "\n")
+        return path
+
+    def test_import_ndjson(self):
+        path = self.write_ndjson([
+            {"name": "First", "snippet": "def first(): pass", "language": "python", "public": True},
+            {"name": "Second", "snippet": "second = 2", "language": "python", "user": "other"},
+            {"name": "", "snippet": "print(1)", "language": "python"},
+            {"name": "Unknown", "snippet": "x", "language": "cobol"},
+        ])
+        result = import_snippets(path, self.user, batch_size=1)
+        self.assertEqual(result["created"], 2)
+        self.assertEqual([number for number, errors in result["errors"]], [3, 4])
+        first = Snippet.objects.get(name="First")
+        self.assertEqual(first.user, self.user)
+        self.assertTrue(first.public)
+        self.assertFalse(first.is_highlight_pending)
+        self.assertIn(("first", SnippetToken.NAME), set(first.tokens.values_list("token", "kind")))
+        self.assertEqual(Snippet.objects.get(name="Second").user, self.other)
+
+    def test_one_summary_email_per_user(self):
+        path = self.write_ndjson([
+            {"name": "Snippet %s" % number, "snippet": "pass", "language": "python"} for number in range(30)
+        ])
+        import_snippets(path, self.user, render=False)
+        emails = EmailNotification.objects.all()
+        self.assertEqual(len(emails), 1)
+        self.assertEqual(emails[0].subject, "30 snippets imported successfully")
+        self.assertIn("... and 10 more", emails[0].body)
+        self.assertTrue(Snippet.objects.get(name="Snippet 0").is_highlight_pending)
+
+    def test_import_directory(self):
+        os.makedirs(os.path.join(self.directory, "src"))
+        with open(os.path.join(self.directory, "src", "hello.py"), "w") as source:
+            source.write("print('hello')")
+        with open(os.path.join(self.directory, "notes.unknown"), "w") as source:
+            source.write("notes")
+        call_command("import_snippets", self.directory, user="testuser", public=True, workers=1, stdout=StringIO(), stderr=StringIO())
+        snippet = Snippet.objects.get()
+        self.assertEqual(snippet.name, os.path.join("src", "hello.py"))
+        self.assertEqual(snippet.language, self.language)
+
+    def test_import_renders_in_spawned_workers(self):
+        path = self.write_ndjson([
+            {"name": "Snippet %s" % number, "snippet": "x = %s" % number, "language": "python"}
+            for number in range(4)
+        ])
+        with mock.patch("snippets.imports.ProcessPoolExecutor", wraps=ProcessPoolExecutor) as executor:
+            result = import_snippets(path, self.user, workers=2)
+        self.assertEqual(executor.call_args.kwargs["mp_context"].get_start_method(), "spawn")
+        self.assertEqual(result["created"], 4)
+        self.assertFalse(Snippet.objects.filter(highlight_blob__isnull=True).exists())
+
+    def test_import_invalidates_the_cached_pages(self):
+        self.client.get(reverse('index'))
+        path = self.write_ndjson([{"name": "Imported", "snippet": "pass", "language": "python", "public": True}])
+        import_snippets(path, self.user)
+        self.assertContains(self.client.get(reverse('index')), "Imported")
+
+
+class HighlightBackfillTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+        Snippet.objects.bulk_create([
+            Snippet(user=self.user, name="Snippet %s" % number, snippet="x = %s" % number, language=self.language)
+            for number in range(7)
+        ])
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), "backfill.json")
+
+    def test_backfill_renders_every_snippet(self):
+        progress = []
+        result = backfill_highlights(batch_size=3, progress=lambda *args: progress.append(args))
+        self.assertEqual(result["rendered"], 7)
+        self.assertEqual([rendered for rendered, total, rate in progress], [3, 6, 7])
+        self.assertFalse(Snippet.objects.filter(highlight_blob__isnull=True).exists())
+
+    def test_backfill_resumes_from_the_checkpoint(self):
+        original = write_highlights
+        calls = []
+
+        def interrupted(results):
+            calls.append(results)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            return original(results)
+
+        with mock.patch("snippets.backfill.write_highlights", side_effect=interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                backfill_highlights(batch_size=3, checkpoint_path=self.checkpoint)
+        with open(self.checkpoint) as checkpoint:
+            self.assertEqual(json.load(checkpoint)["rendered"], 3)
+
+        with mock.patch("snippets.backfill.render_range", wraps=render_range) as rendered_ranges:
+            result = backfill_highlights(batch_size=3, checkpoint_path=self.checkpoint)
+        self.assertEqual(rendered_ranges.call_count, 2)
+        self.assertEqual(result["rendered"], 4)
+        self.assertFalse(Snippet.objects.filter(highlight_blob__isnull=True).exists())
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_edited_snippet_is_not_overwritten(self):
+        snippet = Snippet.objects.first()
+        results = render_range(snippet.id, snippet.id)
+        snippet.snippet = "y = 1"
+        snippet.save()
+        self.assertEqual(write_highlights(results), 0)
+        self.assertTrue(Snippet.objects.get(id=snippet.id).is_highlight_pending)
+
+    def test_cached_render_is_replaced(self):
+        snippet = Snippet.objects.select_related("language").first()
+        highlight_cache.set(snippet._highlight_key(), "<div>old style</div>")
+        results = render_range(snippet.id, snippet.id)
+        self.assertNotIn("old style", results[0][3])
+        self.assertEqual(highlight_cache.get(snippet._highlight_key()), results[0][3])
+
+    def test_checkpoint_waits_for_earlier_ranges(self):
+        checkpoint = Checkpoint(None)
+        checkpoint.started(1, 3)
+        checkpoint.started(4, 6)
+        checkpoint.finished(4, 6, 3)
+        self.assertEqual(checkpoint.last_id, 0)
+        checkpoint.finished(1, 3, 3)
+        self.assertEqual((checkpoint.last_id, checkpoint.rendered), (6, 6))
+
+
+class ParallelBackfillTestCase(TransactionTestCase):
+    """
+    The worker processes only see committed rows. They can't open the test database
+    of SQLite, in memory, so they read a copy of it on disk.
+    """
+
+    def on_disk_database(self):
+        if connection.vendor != "sqlite" or not connection.is_in_memory_db():
+            return contextlib.nullcontext()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "test_db.sqlite3")
+        copy = sqlite3.connect(path)
+        connection.connection.backup(copy)
+        copy.close()
+        return mock.patch.dict(connection.settings_dict, NAME=path)
+
+    def test_backfill_in_worker_processes(self):
+        user = User.objects.create_user(username='testuser', password='testpassword')
+        language = Language.objects.create(name="python", slug="python")
+        Snippet.objects.bulk_create([
+            Snippet(user=user, name="Snippet %s" % number, snippet="x = %s" % (number % 3), language=language)
+            for number in range(7)
+        ])
+        with self.on_disk_database():
+            result = backfill_highlights(batch_size=2, workers=2)
+        self.assertEqual(result["rendered"], 7)
+        self.assertFalse(Snippet.objects.filter(highlight_blob__isnull=True).exists())
+        self.assertEqual(HighlightBlob.objects.count(), 3)
+
+
+@override_settings(HIGHLIGHT_MAX_SIZE=100, HIGHLIGHT_PAGE_LINES=3, SNIPPET_RAW_SIZE=1000, SNIPPET_RAW_CHUNK_SIZE=64)
+class SnippetSizeTiersTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+
+    def create(self, lines):
+        return Snippet.objects.create(
+            user=self.user, name="Big Snippet", language=self.language, public=True,
+            snippet="".join("value_%s = %s\n" % (number, number) for number in range(1, lines + 1)),
+        )
+
+    def test_small_snippet_is_fully_highlighted(self):
+        snippet = self.create(2)
+        response = self.client.get(reverse('snippet', args=[snippet.id]))
+        self.assertContains(response, "value_2")
+        self.assertNotContains(response, "load-more")
+
+    def test_paged_snippet_shows_the_first_lines(self):
+        snippet = self.create(10)
+        response = self.client.get(reverse('snippet', args=[snippet.id]))
+        self.assertContains(response, "value_3")
+        self.assertNotContains(response, "value_4")
+        self.assertContains(response, reverse('snippet_lines', args=[snippet.id]) + "?offset=36&amp;line=4")
+        self.assertFalse(Snippet.objects.get(id=snippet.id).is_highlight_pending)
+
+    def test_load_more_lines(self):
+        snippet = self.create(10)
+        response = self.client.get(reverse('snippet_lines', args=[snippet.id]), {"offset": 36, "line": 4})
+        self.assertContains(response, "value_6")
+        self.assertNotContains(response, "value_7")
+        self.assertContains(response, "?offset=72&amp;line=7")
+        last = self.client.get(reverse('snippet_lines', args=[snippet.id]), {"offset": 108, "line": 10})
+        self.assertContains(last, "value_10")
+        self.assertNotContains(last, "load-more")
+
+    @override_settings(HIGHLIGHT_PAGE_SIZE=40)
+    def test_long_line_is_cut_in_pages(self):
+        snippet = Snippet.objects.create(
+            user=self.user, name="Long line", language=self.language, public=True,
+            snippet="values = [%s]\n" % ", ".join(str(number) for number in range(100)),
+        )
+        url = reverse('snippet_lines', args=[snippet.id])
+        response = self.client.get(reverse('snippet', args=[snippet.id]))
+        self.assertContains(response, url + "?offset=40&amp;line=1")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {"offset": 40, "line": 1})
+        self.assertContains(response, "?offset=80&amp;line=1")
+        code_query = [query["sql"] for query in queries if "SUBSTR" in query["sql"].upper()]
+        self.assertEqual(len(code_query), 1)
+        self.assertIn(", 40)", code_query[0])
+
+    def test_huge_snippet_is_only_served_raw(self):
+        snippet = self.create(100)
+        response = self.client.get(reverse('snippet', args=[snippet.id]))
+        self.assertNotContains(response, "value_1 ")
+        self.assertContains(response, reverse('snippet_raw', args=[snippet.id]))
+        self.assertEqual(self.client.get(reverse('snippet_lines', args=[snippet.id])).status_code, 404)
+        self.assertTrue(Snippet.objects.get(id=snippet.id).is_highlight_pending)
+
+    def test_raw_is_streamed_in_chunks(self):
+        snippet = self.create(100)
+        response = self.client.get(reverse('snippet_raw', args=[snippet.id]))
+        chunks = list(response.streaming_content)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks).decode("utf-8"), snippet.snippet)
+
+    async def test_raw_is_streamed_by_an_async_iterator_under_asgi(self):
+        snippet = await sync_to_async(self.create)(100)
+        response = await self.async_client.get(reverse('snippet_raw', args=[snippet.id]))
+        self.assertTrue(response.is_async)
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b"".join(chunks).decode("utf-8"), snippet.snippet)
+
+    def test_private_snippet_lines(self):
+        snippet = self.create(10)
+        snippet.public = False
+        snippet.save()
+        self.assertEqual(self.client.get(reverse('snippet_raw', args=[snippet.id])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('snippet_lines', args=[snippet.id])).status_code, 404)
+
+
+class CompressionTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+        Snippet.objects.bulk_create([
+            Snippet(
+                user=self.user, name="Snippet %s" % number, language=self.language,
+                snippet="import os\nimport sys\n\ndef main_%s():\n    return os.getcwd()\n" % number,
+            )
+            for number in range(20)
+        ])
+
+    def test_dictionary_keeps_the_common_lines(self):
+        dictionary = train_dictionary(CodeBlob.objects.values_list("code", flat=True))
+        self.assertIn(b"import os\n", dictionary)
+        self.assertNotIn(b"main_1()", dictionary)
+
+    def test_benchmark(self):
+        results = benchmark(sample_size=10)
+        self.assertEqual(results["snippets"], 10)
+        # Short snippets barely compress on their own, the dictionary is what makes them smaller
+        self.assertLess(results["zlib_dictionary"]["bytes"], results["raw_bytes"])
+        self.assertLess(results["zlib_dictionary"]["bytes"], results["zlib"]["bytes"])
+
+    def test_commands(self):
+        output = StringIO()
+        call_command("benchmark_compression", sample=5, stdout=output)
+        self.assertIn("zlib_dictionary", output.getvalue())
+        output = StringIO()
+        call_command("recompress_snippets", stdout=output)
+        self.assertIn("nothing to do", output.getvalue())
+
+    def test_recompress_with_a_trained_dictionary(self):
+        CodeDictionary.loaded.clear()
+        output = StringIO()
+        with override_settings(SNIPPET_CODE_COMPRESSION=True):
+            call_command("recompress_snippets", sample=10, batch_size=7, stdout=output)
+        dictionary = CodeDictionary.objects.get()
+        self.assertIn(b"import os\n", bytes(dictionary.data))
+        self.assertEqual(CodeBlob.objects.filter(dictionary=dictionary, code="").count(), 20)
+        self.assertEqual(Snippet.objects.get(name="Snippet 3").snippet.count("main_3"), 1)
+        self.assertEqual(benchmark(sample_size=5)["stored"]["snippets"], 5)
+        self.assertEqual(len(search_snippets("main_3", self.user)), 1)
+
+        call_command("recompress_snippets", decompress=True, stdout=output)
+        self.assertFalse(CodeBlob.objects.filter(compressed__isnull=False).exists())
+        self.assertEqual(len(search_snippets("main_3", self.user)), 1)
+
+
+@override_settings(
+    SNIPPET_CODE_COMPRESSION=True,
+    HIGHLIGHT_MAX_SIZE=100,
+    HIGHLIGHT_PAGE_LINES=3,
+    SNIPPET_RAW_SIZE=1000,
+    SNIPPET_RAW_CHUNK_SIZE=64,
+)
+class CompressedCodeTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        highlight_cache.clear()
+        CodeDictionary.loaded.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+        CodeDictionary.objects.create(data=b"value = value\n")
+
+    def create(self, lines):
+        return Snippet.objects.create(
+            user=self.user, name="Big Snippet", language=self.language, public=True,
+            snippet="".join("value_%s = %s\n" % (number, number) for number in range(1, lines + 1)),
+        )
+
+    def test_new_code_is_stored_compressed(self):
+        snippet = self.create(10)
+        blob = CodeBlob.objects.get()
+        self.assertEqual((blob.code, blob.size), ("", len(snippet.snippet)))
+        self.assertEqual(blob.dictionary, CodeDictionary.objects.get())
+        self.assertLess(len(blob.compressed), blob.size)
+        self.assertEqual(Snippet.objects.get(id=snippet.id).snippet, snippet.snippet)
+
+    def test_code_that_doesnt_shrink_is_stored_plain(self):
+        Snippet.objects.create(user=self.user, name="Tiny", language=self.language, snippet="x")
+        self.assertEqual(CodeBlob.objects.get().code, "x")
+
+    def test_form_and_highlight_read_the_code(self):
+        snippet = self.create(2)
+        renderSnippetHighlight(snippet.id)
+        self.assertContains(self.client.get(reverse('snippet', args=[snippet.id])), "value_2")
+        self.client.login(username='testuser', password='testpassword')
+        self.assertContains(self.client.get(reverse('snippet_edit', args=[snippet.id])), "value_1 = 1")
+        self.client.post(reverse('snippet_edit', args=[snippet.id]), {
+            "name": "Edited",
+            "snippet": "value = 3\n" * 9 + "value = 3",
+            "language": self.language.id,
+            "public": True,
+        })
+        self.assertEqual(Snippet.objects.get(id=snippet.id).snippet, "value = 3\n" * 9 + "value = 3")
+
+    def test_pages_and_raw_are_decompressed(self):
+        snippet = self.create(10)
+        response = self.client.get(reverse('snippet', args=[snippet.id]))
+        self.assertContains(response, "value_3")
+        self.assertNotContains(response, "value_4")
+        response = self.client.get(reverse('snippet_lines', args=[snippet.id]), {"offset": 36, "line": 4})
+        self.assertContains(response, "value_6")
+        self.assertNotContains(response, "value_7")
+
+        snippet = self.create(100)
+        response = self.client.get(reverse('snippet_raw', args=[snippet.id]))
+        self.assertEqual(b"".join(response.streaming_content).decode("utf-8"), snippet.snippet)
+
+    def test_api_returns_the_code(self):
+        snippet = self.create(2)
+        response = self.client.get(reverse('api_snippet', args=[snippet.id]), {"fields": "name,snippet"})
+        self.assertEqual(response.json()["snippet"], snippet.snippet)
+        response = self.client.get(reverse('api_snippets_export'), {"fields": "id,snippet,public"})
+        row = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(row, {"id": snippet.id, "snippet": snippet.snippet, "public": True})
+
+    def test_compressed_code_is_searched(self):
+        snippet = self.create(10)
+        blob = CodeBlob.objects.get()
+        self.assertEqual(blob.code, "")
+        self.assertEqual(blob.search_words.split()[:3], ["value_1", "1", "value_2"])
+        self.assertEqual(search_snippets("value_7", self.user), [snippet])
+        response = self.client.get(reverse('search'), {"q": "value_7"})
+        self.assertContains(response, "Big Snippet")
+        self.assertEqual(search_snippets("value_11", self.user), [])
+
+    async def test_async_streams_read_the_dictionary(self):
+        snippet = await sync_to_async(self.create)(100)
+        CodeDictionary.loaded.clear()
+        response = await self.async_client.get(reverse('snippet_raw', args=[snippet.id]))
+        self.assertEqual(b"".join([chunk async for chunk in response.streaming_content]).decode("utf-8"), snippet.snippet)
+        CodeDictionary.loaded.clear()
+        response = await self.async_client.get(reverse('api_snippets_export'), {"fields": "snippet"})
+        row = json.loads(b"".join([chunk async for chunk in response.streaming_content]))
+        self.assertEqual(row, {"snippet": snippet.snippet})
+
+
+class HighlightBlobTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+
+    def create(self, code="print('Hello, World!')"):
+        snippet = Snippet.objects.create(user=self.user, name="Snippet", snippet=code, language=self.language)
+        renderSnippetHighlight(snippet.id)
+        return Snippet.objects.get(id=snippet.id)
+
+    def test_identical_snippets_share_the_blob(self):
+        first = self.create()
+        with mock.patch("snippets.models.highlight_cache.get_or_render") as get_or_render:
+            second = self.create()
+        get_or_render.assert_not_called()
+        self.assertEqual(first.highlight_blob_id, second.highlight_blob_id)
+        self.assertEqual(HighlightBlob.objects.get().references, 2)
+        self.assertIn('class="highlight"', second.highlighted)
+
+    def test_references_are_released(self):
+        first = self.create()
+        second = self.create()
+        first.delete()
+        self.assertEqual(HighlightBlob.objects.get().references, 1)
+        second.snippet = "print('Goodbye')"
+        second.save()
+        self.assertIsNone(second.highlight_blob_id)
+        self.assertEqual(HighlightBlob.objects.get().references, 0)
+        renderSnippetHighlight(second.id)
+        self.assertEqual(HighlightBlob.objects.count(), 2)
+
+    def test_collect_deletes_unused_blobs(self):
+        used = self.create()
+        unused = self.create("print('unused')")
+        unused.delete()
+        self.assertEqual(HighlightBlob.collect(), 1)
+        self.assertEqual(HighlightBlob.objects.get().id, used.highlight_blob_id)
+
+    def test_import_shares_blobs(self):
+        path = os.path.join(tempfile.mkdtemp(), "snippets.ndjson")
+        with open(path, "w") as ndjson:
+            for number in range(3):
+                ndjson.write(json.dumps({"name": "Copy %s" % number, "snippet": "x = 1", "language": "python"}) + "\n")
+        import_snippets(path, self.user, notify=False)
+        self.assertEqual(HighlightBlob.objects.get().references, 3)
+        self.assertEqual(Snippet.objects.filter(highlight_blob__isnull=False).count(), 3)
+
+
+class CodeBlobTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+
+    def create(self, code="print('Hello, World!')", language=None):
+        return Snippet.objects.create(
+            user=self.user, name="Snippet", snippet=code, language=language or self.language, public=True
+        )
+
+    def test_identical_code_is_stored_once(self):
+        first = self.create()
+        second = self.create()
+        ruby = self.create(language=Language.objects.create(name="ruby", slug="ruby"))
+        self.assertEqual(first.code_blob_id, second.code_blob_id)
+        self.assertNotEqual(first.code_blob_id, ruby.code_blob_id)
+        blob = CodeBlob.objects.get(id=first.code_blob_id)
+        self.assertEqual((blob.references, blob.size), (2, len("print('Hello, World!')")))
+        self.assertEqual(Snippet.objects.get(id=second.id).snippet, "print('Hello, World!')")
+
+    def test_edit_moves_to_another_blob(self):
+        first = self.create()
+        second = self.create()
+        second.snippet = "print('Goodbye')"
+        second.save()
+        self.assertEqual(CodeBlob.objects.get(id=first.code_blob_id).references, 1)
+        self.assertEqual(Snippet.objects.get(id=second.id).snippet, "print('Goodbye')")
+        first.delete()
+        self.assertEqual(CodeBlob.collect(), 1)
+        self.assertEqual(CodeBlob.objects.get().code, "print('Goodbye')")
+
+    def test_save_without_changes_keeps_the_blob(self):
+        snippet = Snippet.objects.get(id=self.create().id)
+        snippet.snippet = snippet.snippet
+        snippet.public = False
+        snippet.save()
+        self.assertEqual(CodeBlob.objects.get().references, 1)
+
+    def test_bulk_create_stores_the_code(self):
+        Snippet.objects.bulk_create([
+            Snippet(user=self.user, name="Snippet %s" % number, snippet="x = %s" % (number % 2), language=self.language)
+            for number in range(4)
+        ])
+        self.assertEqual(sorted(CodeBlob.objects.values_list("references", flat=True)), [2, 2])
+
+    def test_search_reads_the_code_of_the_blob(self):
+        snippet = self.create("def shared_helper(): pass")
+        self.create("def shared_helper(): pass")
+        self.assertEqual(len(search_snippets("shared_helper", self.user)), 2)
+        snippet.snippet = "def renamed_helper(): pass"
+        snippet.save()
+        self.assertEqual(search_snippets("renamed_helper", self.user), [snippet])
+        snippet.delete()
+        self.assertEqual(search_snippets("renamed_helper", self.user), [])
+
+    def test_edit_form_shows_the_code(self):
+        snippet = self.create()
+        self.client.login(username='testuser', password='testpassword')
+        response = self.client.get(reverse('snippet_edit', args=[snippet.id]))
+        self.assertContains(response, "print(&#x27;Hello, World!&#x27;)")
+
+
+@override_settings(METRICS_SAMPLE_RATE=1.0)
+class RequestMetricsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        highlight_cache.clear()
+        metrics_registry.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+        self.snippet = Snippet.objects.create(
+            user=self.user, name="Snippet", snippet="print('Hello, World!')", language=self.language, public=True
+        )
+
+    def test_sampled_response_has_server_timing(self):
+        response = self.client.get(reverse("snippet", args=[self.snippet.id]))
+        timing = response["Server-Timing"]
+        for phase in ("db;dur=", "highlight;dur=", "template;dur=", "total;dur="):
+            self.assertIn(phase, timing)
+        self.assertIn("cache-page-miss", timing)
+        self.assertRegex(timing, r'db;dur=[0-9.]+;desc="[1-9][0-9]* queries"')
+
+    async def test_queries_of_the_async_views_are_counted(self):
+        # The async views query from the thread of sync_to_async, not the one of the event loop
+        response = await self.async_client.get(reverse("index"))
+        self.assertRegex(response["Server-Timing"], r'db;dur=[0-9.]+;desc="[1-9][0-9]* queries"')
+
+    @override_settings(METRICS_SAMPLE_RATE=0.0)
+    def test_unsampled_requests_are_only_counted(self):
+        response = self.client.get(reverse("index"))
+        self.assertFalse(response.has_header("Server-Timing"))
+        metrics = self.client.get(reverse("metrics")).content.decode()
+        self.assertIn('snippets_request_duration_seconds_count{view="index"} 1', metrics)
+        self.assertIn('snippets_sampled_requests_total{view="index"} 0', metrics)
+
+    def test_metrics_endpoint(self):
+        renderSnippetHighlight(self.snippet.id)
+        self.client.get(reverse("snippet", args=[self.snippet.id]))
+        self.client.get(reverse("snippet", args=[self.snippet.id]))
+        response = self.client.get(reverse("metrics"))
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        metrics = response.content.decode()
+        self.assertIn('snippets_request_duration_seconds_count{view="snippet"} 2', metrics)
+        self.assertIn('snippets_cache_lookups_total{view="snippet",cache="page",result="hit"} 1', metrics)
+        self.assertIn('snippets_cache_lookups_total{view="snippet",cache="page",result="miss"} 1', metrics)
+        self.assertRegex(metrics, r'snippets_db_queries_total\{view="snippet"\} [1-9]')
+
+    def test_metrics_endpoint_is_local(self):
+        response = self.client.get(reverse("metrics"), REMOTE_ADDR="203.0.113.7")
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(METRICS_TOKEN="scrape-secret")
+    def test_metrics_endpoint_with_a_token(self):
+        url = reverse("metrics")
+        # Behind the proxy the address is no proof, only the token is
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION="Bearer wrong").status_code, 404)
+        response = self.client.get(url, REMOTE_ADDR="203.0.113.7", HTTP_AUTHORIZATION="Bearer scrape-secret")
+        self.assertEqual(response.status_code, 200)
+
+
+class BenchmarkTestCase(TestCase):
+
+    def test_run_benchmarks(self):
+        dataset = generate_dataset(snippets=40, languages=3, users=3, seed=1)
+        self.assertEqual(Snippet.objects.count(), 40)
+        self.assertEqual(Language.objects.count(), 3)
+        results = run_benchmarks(repeats=2, seed=1, dataset=dataset)
+        benchmarks = results["benchmarks"]
+        for name in ("view:index", "view:snippet:small", "highlight:size:small", "form:small", "task:indexSnippetTokens",
+                     "view:trending", "view_counts:record"):
+            self.assertIn(name, benchmarks)
+        self.assertGreater(benchmarks["view:index"]["queries"], 0)
+        self.assertGreaterEqual(benchmarks["view:index"]["p99_ms"], benchmarks["view:index"]["p50_ms"])
+        self.assertEqual(results["metadata"]["dataset"], dataset)
+
+    def test_compare_flags_regressions(self):
+        baseline = {"benchmarks": {
+            "view:index": {"p50_ms": 10.0, "queries": 4, "samples": 20},
+            "highlight:size:small": {"characters_per_second": 1000.0},
+        }}
+        current = {"benchmarks": {
+            "view:index": {"p50_ms": 11.0, "queries": 5, "samples": 40},
+            "highlight:size:small": {"characters_per_second": 500.0},
+            "view:search": {"p50_ms": 50.0},
+        }}
+        self.assertEqual(compare(baseline, current, tolerance=0.2), [
+            ("highlight:size:small", "characters_per_second", 1000.0, 500.0),
+            ("view:index", "queries", 4, 5),
+        ])
+
+
+class AsyncViewsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+        self.public = Snippet.objects.create(
+            user=self.user, name="Public Snippet", snippet="print('public')", language=self.language, public=True
+        )
+        self.private = Snippet.objects.create(
+            user=self.user, name="Private Snippet", snippet="print('private')", language=self.language
+        )
+
+    @override_settings(DEBUG=True)
+    def test_middleware_chain_is_async(self):
+        # In debug Django logs every sync middleware it has to adapt to the async chain
+        with self.assertNoLogs("django.request", level="DEBUG"):
+            ASGIHandler().load_middleware(is_async=True)
+
+    async def test_listings(self):
+        response = await self.async_client.get(reverse('index'))
+        self.assertContains(response, "Public Snippet")
+        self.assertNotContains(response, "Private Snippet")
+        response = await self.async_client.get(reverse('language', args=["python"]))
+        self.assertContains(response, "Public Snippet")
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('user_snippets', args=["testuser"]))
+        self.assertContains(response, "Private Snippet")
+
+    async def test_listings_are_rendered_off_the_event_loop(self):
+        # The snippet cards look up their cached fragment with the sync cache
+        def render_in_a_thread(*args, **kwargs):
+            with self.assertRaises(RuntimeError):
+                asyncio.get_running_loop()
+            return render(*args, **kwargs)
+
+        await SnippetPopularity.objects.acreate(snippet=self.public, views=1, trend=1)
+        urls = [
+            reverse('index'),
+            reverse('language', args=["python"]),
+            reverse('user_snippets', args=["testuser"]),
+            reverse('trending'),
+        ]
+        with mock.patch("snippets.utils.render", side_effect=render_in_a_thread) as rendered:
+            for url in urls:
+                self.assertContains(await self.async_client.get(url), "Public Snippet")
+        self.assertEqual(rendered.call_count, len(urls))
+
+    async def test_details(self):
+        response = await self.async_client.get(reverse('snippet', args=[self.private.id]))
+        self.assertEqual(response.status_code, 302)
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('snippet', args=[self.private.id]))
+        self.assertContains(response, "private")
+        self.assertFalse((await Snippet.objects.aget(id=self.private.id)).is_highlight_pending)
+
+    async def test_anonymous_page_is_cached(self):
+        url = reverse('snippet', args=[self.public.id])
+        await self.async_client.get(url)
+        first = await self.async_client.get(url)
+        with mock.patch("snippets.views.aget_snippet_details_or_404") as load:
+            second = await self.async_client.get(url)
+        load.assert_not_called()
+        self.assertEqual(first.content, second.content)
+
+    @override_settings(HIGHLIGHT_MAX_SIZE=10, HIGHLIGHT_PAGE_LINES=2)
+    async def test_lines_are_highlighted_in_the_pool(self):
+        snippet = await Snippet.objects.acreate(
+            user=self.user, name="Lines", language=self.language, public=True,
+            snippet="first = 1\nsecond = 2\nthird = 3\n",
+        )
+        with mock.patch("snippets.highlighting.render", side_effect=AssertionError("rendered in the loop")):
+            response = await self.async_client.get(reverse('snippet_lines', args=[snippet.id]), {"offset": 21, "line": 3})
+        self.assertContains(response, "third")
+
+
+class SnippetCounterTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.python = Language.objects.create(name="python", slug="python")
+        self.ruby = Language.objects.create(name="ruby", slug="ruby")
+
+    def create(self, **fields):
+        values = {"user": self.user, "name": "Snippet", "snippet": "pass", "language": self.python, "public": True}
+        values.update(fields)
+        return Snippet.objects.create(**values)
+
+    def counts(self, counter, pk):
+        return counter.objects.filter(pk=pk).values_list("total", "public").first()
+
+    def test_create_counts_the_snippet(self):
+        self.create()
+        self.create(public=False)
+        self.assertEqual(self.counts(LanguageCounter, self.python.id), (2, 1))
+        self.assertEqual(self.counts(UserCounter, self.user.id), (2, 1))
+        self.assertIsNone(self.counts(LanguageCounter, self.ruby.id))
+
+    def test_edit_moves_the_counts(self):
+        snippet = self.create()
+        snippet.language = self.ruby
+        snippet.public = False
+        snippet.save()
+        self.assertEqual(self.counts(LanguageCounter, self.python.id), (0, 0))
+        self.assertEqual(self.counts(LanguageCounter, self.ruby.id), (1, 0))
+        self.assertEqual(self.counts(UserCounter, self.user.id), (1, 0))
+
+    def test_edit_of_other_fields_leaves_the_counters(self):
+        snippet = self.create()
+        snippet.name = "Renamed"
+        with CaptureQueriesContext(connection) as queries:
+            snippet.save(update_fields=["name"])
+        self.assertEqual([query["sql"] for query in queries if "counter" in query["sql"]], [])
+        self.assertEqual(self.counts(LanguageCounter, self.python.id), (1, 1))
+
+    def test_delete_uncounts_the_snippet(self):
+        self.create()
+        self.create().delete()
+        self.assertEqual(self.counts(LanguageCounter, self.python.id), (1, 1))
+        self.user.delete()
+        self.assertEqual(self.counts(LanguageCounter, self.python.id), (0, 0))
+        self.assertFalse(UserCounter.objects.exists())
+
+    def test_import_counts_the_snippets(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "snippets.ndjson")
+        with open(path, "w") as rows:
+            for name, public in (("First", True), ("Second", False)):
+                rows.write(json.dumps({"name": name, "snippet": "pass", "language": "ruby", "public": public}) + "\n")
+        import_snippets(path, self.user, render=False, notify=False)
+        self.assertEqual(self.counts(LanguageCounter, self.ruby.id), (2, 1))
+        self.assertEqual(self.counts(UserCounter, self.user.id), (2, 1))
+
+    def test_listings_show_the_counts(self):
+        self.create()
+        self.create(public=False)
+        response = self.client.get(reverse('index'))
+        self.assertContains(response, reverse('language', args=["python"]))
+        self.assertNotContains(response, reverse('language', args=["ruby"]))
+        response = self.client.get(reverse('user_snippets', args=["testuser"]))
+        self.assertContains(response, "1 snippets públicos")
+        self.client.login(username='testuser', password='testpassword')
+        response = self.client.get(reverse('user_snippets', args=["testuser"]))
+        self.assertContains(response, "2 snippets, 1 públicos")
+
+    def test_cached_sidebars_show_the_new_counts(self):
+        self.create(language=self.ruby)
+        url = reverse('language', args=["ruby"])
+        self.assertNotContains(self.client.get(url), reverse('language', args=["python"]))
+        # Only the scopes of the python snippet change, the ruby page is fresh because of its sidebar
+        self.create()
+        self.assertContains(self.client.get(url), reverse('language', args=["python"]))
+
+    def test_reconcile_repairs_the_drift(self):
+        self.create()
+        Snippet.objects.update(public=False)
+        self.assertEqual(
+            reconcile_counters(),
+            [("LanguageCounter", self.python.id, (1, 1), (1, 0)), ("UserCounter", self.user.id, (1, 1), (1, 0))],
+        )
+        with self.assertRaises(CommandError):
+            call_command("reconcile_counters", stdout=StringIO())
+        call_command("reconcile_counters", repair=True, stdout=StringIO())
+        self.assertEqual(self.counts(LanguageCounter, self.python.id), (1, 0))
+        self.assertEqual(reconcile_counters(), [])
+
+
+class OutboxTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpassword', email="test@example.com")
+        self.language = Language.objects.create(name="python", slug="python")
+        self.client.login(username='testuser', password='testpassword')
+
+    def add_snippet(self):
+        return self.client.post(reverse('snippet_add'), {
+            "name": "Outbox", "description": "Relayed", "snippet": "print('Hi!')",
+            "language": self.language.id, "public": True,
+        })
+
+    def test_add_leaves_the_tasks_in_the_outbox(self):
+        with mock.patch("celery.app.task.Task.apply_async") as apply_async:
+            self.add_snippet()
+        apply_async.assert_not_called()
+        snippet = Snippet.objects.get(name="Outbox")
+        self.assertEqual(
+            list(OutboxEvent.objects.order_by("id").values_list("task", "args")),
+            [
+                ("snippets.tasks.renderSnippetHighlight", [snippet.id]),
+                ("snippets.tasks.indexSnippetTokens", [snippet.id]),
+                ("snippets.tasks.sendEmailInSnippetCreation", ["Outbox", "Relayed", "test@example.com"]),
+            ],
+        )
+
+    @override_settings(OUTBOX_RELAY_ON_COMMIT=True)
+    def test_events_are_relayed_after_the_commit(self):
+        publish(sendPendingEmails.s())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_snippet()
+        # The request only relays its own events, the older ones are left to the relay
+        self.assertEqual(list(OutboxEvent.objects.values_list("task", flat=True)), ["snippets.tasks.sendPendingEmails"])
+        snippet = Snippet.objects.get(name="Outbox")
+        self.assertFalse(snippet.is_highlight_pending)
+        self.assertTrue(SnippetToken.objects.filter(snippet=snippet).exists())
+        self.assertEqual([message.to for message in mail.outbox], [["test@example.com"]])
+
+    def test_eager_default_delivers_the_email(self):
+        # CELERY_EAGER has no beat to run the relay nor the batches of emails
+        self.assertTrue(settings.CELERY_TASK_ALWAYS_EAGER)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_snippet()
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual([message.subject for message in mail.outbox], ['Snippet "Outbox" created successfully'])
+
+    @override_settings(OUTBOX_RELAY_ON_COMMIT=False)
+    def test_relay_command_sends_the_events(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.add_snippet()
+        self.assertEqual(OutboxEvent.objects.count(), 3)
+        output = StringIO()
+        call_command("relay_outbox", stdout=output)
+        self.assertIn("Relayed 3 outbox events", output.getvalue())
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_rollback_discards_the_events(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                publish(sendPendingEmails.s())
+                raise ValueError
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    @override_settings(OUTBOX_RETRY_BACKOFF=60)
+    def test_failed_event_is_retried_later(self):
+        publish(sendPendingEmails.s(), sendPendingEmails.s())
+        with mock.patch("celery.canvas.Signature.apply_async", side_effect=[OSError("broker down"), None]):
+            with self.assertLogs("snippets.outbox", level="ERROR"):
+                result = relay_outbox()
+        self.assertEqual((result["relayed"], result["failed"]), (1, 1))
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.attempts, 1)
+        self.assertEqual(event.error, "broker down")
+        self.assertGreater(event.next_attempt, timezone.now())
+        self.assertEqual(relay_outbox()["relayed"], 0)
+
+    def test_broker_connection_failure_keeps_the_batch(self):
+        publish(sendPendingEmails.s(), sendPendingEmails.s())
+        with mock.patch("snippets.outbox.producer", side_effect=OSError("connection refused")):
+            with self.assertLogs("snippets.outbox", level="ERROR"):
+                result = relay_outbox()
+        self.assertEqual((result["relayed"], result["failed"]), (0, 2))
+        self.assertEqual(list(OutboxEvent.objects.values_list("attempts", flat=True)), [1, 1])
+
+
+class PopularityTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        buffer.take()
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        self.language = Language.objects.create(name="python", slug="python")
+        self.first = Snippet.objects.create(
+            user=self.user, name="First Snippet", snippet="first = 1", language=self.language, public=True,
+        )
+        self.second = Snippet.objects.create(
+            user=self.user, name="Second Snippet", snippet="second = 2", language=self.language, public=True,
+        )
+        renderSnippetHighlight(self.first.id)
+        renderSnippetHighlight(self.second.id)
+
+    def views(self, snippet):
+        return SnippetPopularity.objects.filter(snippet=snippet).values_list("views", flat=True).first()
+
+    def test_cached_pages_are_counted(self):
+        url = reverse('snippet', args=[self.first.id])
+        for _ in range(3):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertIsNone(self.views(self.first))
+        self.assertEqual(flush_views()["views"], 3)
+        self.assertEqual(self.views(self.first), 3)
+
+    def test_redirects_are_not_counted(self):
+        self.first.public = False
+        self.first.save()
+        self.client.get(reverse('snippet', args=[self.first.id]))
+        flush_views()
+        self.assertIsNone(self.views(self.first))
+
+    @override_settings(VIEW_BUFFER_INTERVAL=0, VIEW_BUFFER_SIZE=1)
+    def test_requests_only_buffer_the_hits(self):
+        url = reverse('snippet', args=[self.first.id])
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            record_view(self.first.id)
+        self.assertIsNone(self.views(self.first))
+        # What the pusher thread does, without Redis straight to the database
+        buffer.send()
+        self.assertEqual(self.views(self.first), 2)
+
+    @override_settings(VIEW_BUFFER_SIZE=1)
+    def test_pusher_is_started_once_per_process(self):
+        pusher = ViewBuffer()
+        with mock.patch("snippets.popularity.threading.Thread") as thread, mock.patch("snippets.popularity.atexit"):
+            pusher.start_pusher()
+            pusher.start_pusher()
+            pusher.add(self.first.id)
+            self.assertEqual(thread.call_count, 1)
+            with mock.patch("snippets.popularity.os.getpid", return_value=-1):
+                # A process forked after the pusher started
+                pusher.add(self.first.id)
+            self.assertEqual(thread.call_count, 2)
+        self.assertEqual(pusher.take(), {self.first.id: 2})
+
+    def test_overlapping_flushes_write_the_hash_once(self):
+        client = mock.MagicMock()
+        client.hgetall.return_value = {str(self.first.id).encode(): b"3"}
+        lock = client.lock.return_value
+        lock.acquire.return_value = False
+        with mock.patch("snippets.popularity.redis_client", return_value=client):
+            # Another flush holds the lock and is writing the hash
+            self.assertEqual(flush_views()["views"], 0)
+            client.hgetall.assert_not_called()
+            lock.acquire.return_value = True
+            self.assertEqual(flush_views()["views"], 3)
+        client.delete.assert_called_once_with("snippet-views:flushing")
+        lock.release.assert_called_once()
+        self.assertEqual(self.views(self.first), 3)
+
+    def test_hits_of_deleted_snippets_are_dropped(self):
+        snippet_id = self.second.id
+        self.second.delete()
+        self.assertEqual(write_views({self.first.id: 2, snippet_id: 5}), 1)
+        self.assertEqual(self.views(self.first), 2)
+
+    @override_settings(TRENDING_HALF_LIFE=60 * 60)
+    def test_recent_views_weigh_more(self):
+        now = timezone.now()
+        write_views({self.first.id: 10}, now=now - timedelta(hours=1))
+        write_views({self.second.id: 6}, now=now)
+        first = SnippetPopularity.objects.get(snippet=self.first)
+        self.assertAlmostEqual(first.score(now), 5)
+        response = self.client.get(reverse('trending'))
+        self.assertEqual([snippet.id for snippet in response.context["snippets"]], [self.second.id, self.first.id])
+        write_views({self.first.id: 2}, now=now)
+        self.assertEqual(self.views(self.first), 12)
+        self.assertAlmostEqual(SnippetPopularity.objects.get(snippet=self.first).score(now), 7)
+
+    def test_trending_page_follows_the_flushes(self):
+        self.second.public = False
+        self.second.save()
+        write_views({self.first.id: 1, self.second.id: 1})
+        response = self.client.get(reverse('trending'))
+        self.assertContains(response, "First Snippet")
+        self.assertNotContains(response, "Second Snippet")
+        self.assertContains(response, "1 visitas")
+        write_views({self.first.id: 4})
+        self.assertContains(self.client.get(reverse('trending')), "5 visitas")
+
+    def test_counting_a_view_is_cheap(self):
+        started = time.perf_counter()
+        for _ in range(1000):
+            record_view(self.first.id)
+        self.assertLess((time.perf_counter() - started) / 1000, 0.001)
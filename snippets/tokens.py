@@ -0,0 +1,60 @@
+from django.db.models import Q
+
+from pygments.token import Keyword, Name, String
+
+from .models import Snippet, SnippetToken
+from .queries import listing
+
+TOKEN_MAX_LENGTH = SnippetToken._meta.get_field("token").max_length
+TOKEN_KINDS = (
+    (Name, SnippetToken.NAME),
+    (Keyword, SnippetToken.KEYWORD),
+    (String, SnippetToken.STRING),
+)
+
+
+def extract_tokens(snippet):
+    """ Set of (token, kind) of the names, keywords and strings the lexer finds in a snippet """
+    return tokens_from_stream(snippet.language.get_lexer().get_tokens(snippet.snippet))
+
+
+def tokens_from_stream(stream):
+    """ Set of (token, kind) in a stream of pygments tokens already lexed """
+    tokens = set()
+    for token_type, value in stream:
+        for parent, kind in TOKEN_KINDS:
+            if token_type in parent:
+                value = value.strip().strip("\"'`")
+                if value and len(value) <= TOKEN_MAX_LENGTH:
+                    tokens.add((value, kind))
+                break
+    return tokens
+
+
+def index_snippet_tokens(snippet):
+    """ Updates the token index of a snippet, only the tokens that changed are written """
+    tokens = extract_tokens(snippet)
+    indexed = set(SnippetToken.objects.filter(snippet=snippet).values_list("token", "kind"))
+    removed = indexed - tokens
+    for kind, _ in SnippetToken.KINDS:
+        removed_tokens = [token for token, token_kind in removed if token_kind == kind]
+        if removed_tokens:
+            SnippetToken.objects.filter(snippet=snippet, kind=kind, token__in=removed_tokens).delete()
+    SnippetToken.objects.bulk_create(
+        [SnippetToken(snippet=snippet, token=token, kind=kind) for token, kind in tokens - indexed],
+        ignore_conflicts=True,
+    )
+
+
+def search_tokens(token, user, kinds=None):
+    """
+    Snippets that contain a token, optionally only as one of the given kinds.
+    Only public snippets and the ones of the user are searched.
+    """
+    tokens = SnippetToken.objects.filter(token=token)
+    if kinds:
+        tokens = tokens.filter(kind__in=kinds)
+    visible = Q(public=True)
+    if user.is_authenticated:
+        visible |= Q(user=user)
+    return listing(Snippet.objects.filter(visible, id__in=tokens.values("snippet_id")))
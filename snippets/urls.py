@@ -1,6 +1,6 @@
 from django.urls import path
 
-from . import views
+from . import api, metrics, views
 
 urlpatterns = [
     path("", views.Index.as_view(), name="index"),
@@ -16,7 +16,11 @@ urlpatterns = [
         views.UserSnippets.as_view(),
         name="user_snippets",
     ),
+    path("snippets/search/", views.Search.as_view(), name="search"),
+    path("snippets/trending/", views.Trending.as_view(), name="trending"),
     path("snippets/snippet/<int:id>/", views.SnippetDetails.as_view(), name="snippet"),
+    path("snippets/snippet/<int:id>/lines/", views.SnippetLines.as_view(), name="snippet_lines"),
+    path("snippets/snippet/<int:id>/raw/", views.SnippetRaw.as_view(), name="snippet_raw"),
     path("snippets/add/", views.SnippetAdd.as_view(), name="snippet_add"),
     path("snippets/edit/<int:id>/", views.SnippetEdit.as_view(), name="snippet_edit"),
     path(
@@ -24,4 +28,8 @@ urlpatterns = [
         views.SnippetDelete.as_view(),
         name="snippet_delete",
     ),
+    path("metrics/", metrics.Metrics.as_view(), name="metrics"),
+    path("api/v1/snippets/", api.SnippetListApi.as_view(), name="api_snippets"),
+    path("api/v1/snippets/export/", api.SnippetExportApi.as_view(), name="api_snippets_export"),
+    path("api/v1/snippets/<int:id>/", api.SnippetDetailApi.as_view(), name="api_snippet"),
 ]
@@ -1,3 +1,59 @@
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.shortcuts import aget_object_or_404, get_object_or_404, render
+
+from .models import Snippet
+from .queries import code_head, with_code_size
+
 def is_the_owner(request, owner):
     """ Verifies if the current user is the owner of the snippet """
-    return request.user.username == owner
\ No newline at end of file
+    return request.user.username == owner
+
+
+def is_snippet_owner(request, snippet):
+    """ Verifies if the current user is the owner of an already loaded snippet, without loading its user """
+    return request.user.is_authenticated and snippet.user_id == request.user.pk
+
+
+async def aload_user(request):
+    """
+    Loads the user of an async view. The templates and the helpers read `request.user`,
+    which can't query the database from the event loop while it's still lazy.
+    """
+    request.user = await request.auser()
+    return request.user
+
+
+async def arender(request, template_name, context):
+    """
+    `render` for the async views, in the thread of sync_to_async: the templates look up
+    their cached fragments, like the snippet cards, with the sync cache
+    """
+    return await sync_to_async(render)(request, template_name, context)
+
+
+def streaming_content(request, chunks, achunks, *args):
+    """
+    The content of a StreamingHttpResponse: `achunks(*args)` under ASGI and `chunks(*args)`
+    under WSGI. Django reads an iterator of the other kind whole before sending it.
+    """
+    if isinstance(request, ASGIRequest):
+        return achunks(*args)
+    return chunks(*args)
+
+
+def get_snippet_or_404(snippet_id):
+    """ Loads a snippet with its user, language and code in a single query """
+    return get_object_or_404(Snippet.objects.select_related("user", "language", "code_blob"), id=snippet_id)
+
+
+async def aget_snippet_details_or_404(snippet_id):
+    """
+    Like get_snippet_or_404 but with the stored highlight and the code cut at
+    HIGHLIGHT_MAX_SIZE, see `queries.with_code_size`
+    """
+    snippets = Snippet.objects.select_related("user", "language", "highlight_blob")
+    snippet = await aget_object_or_404(with_code_size(snippets), id=snippet_id)
+    if snippet.code_compressed is not None:
+        await sync_to_async(code_head)(snippet)
+    return snippet
@@ -1,15 +1,59 @@
-from django.shortcuts import get_object_or_404, redirect, render
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.http import Http404, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404, get_object_or_404, redirect, render
+from django.urls import reverse
 from django.utils.decorators import method_decorator
 from django.contrib.auth import login, logout
-from django.db.models import Q
 from django.views import View
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.forms import AuthenticationForm
 
+from .caching import (
+    SIDEBAR_SCOPE,
+    TRENDING_SCOPE,
+    aconditional_page,
+    cache_anonymous_page,
+    listing_etag,
+    snippet_validators,
+)
 from .forms import SnippetForm
-from .tasks import sendEmailInSnippetCreation
-from .utils import is_the_owner
-from .decorators import owner_required
+from .highlighting import FULL, PAGED, RAW, line_page, render_plain, size_tier
+from .outbox import publish
+from .popularity import count_views
+from .queries import (
+    acode_page,
+    apaginate,
+    index_snippets,
+    language_counters,
+    language_snippets,
+    araw_chunks,
+    paginate,
+    raw_chunks,
+    trending_snippets,
+    user_counter,
+    user_snippets,
+)
+from .search import search_snippets
+from .tokens import search_tokens
+from .tasks import (
+    indexSnippetTokens,
+    queue_highlight,
+    renderSnippetHighlight,
+    sendEmailInSnippetCreation,
+)
+from .utils import (
+    aget_snippet_details_or_404,
+    aload_user,
+    arender,
+    get_snippet_or_404,
+    is_snippet_owner,
+    is_the_owner,
+    streaming_content,
+)
+from .decorators import async_method_decorator, owner_required
 
 from .models import (
     Snippet,
@@ -24,6 +68,7 @@ class SnippetAdd(LoginRequiredMixin, View):
     GET: Renders a form for creating a new snippet.
     POST: Processes the form data, creates a snippet associated with the current user, 
           and redirects to the snippet detail view if successful.
+          The highlight, the token index and the email are left in the outbox with the snippet.
     """
 
     def get(self, request, *args, **kwargs):
@@ -42,8 +87,13 @@ class SnippetAdd(LoginRequiredMixin, View):
         if form.is_valid():
             snippet = form.save(commit=False)
             snippet.user = request.user
-            snippet.save()
-            sendEmailInSnippetCreation.delay(snippet.name, snippet.description, snippet.user.email)
+            with transaction.atomic():
+                snippet.save()
+                publish(
+                    renderSnippetHighlight.s(snippet.id),
+                    indexSnippetTokens.s(snippet.id),
+                    sendEmailInSnippetCreation.s(snippet.name, snippet.description, snippet.user.email),
+                )
             return redirect("snippet", id=snippet.id)
         return render(
             request, 
@@ -63,17 +113,20 @@ class SnippetEdit(LoginRequiredMixin, View):
     
     GET: Renders a form pre-populated with the snippet's current data.
     POST: Processes the form data and updates the snippet if the data is valid.
+          The highlight and the token index are left in the outbox with the edit.
     """
     def get(self, request, *args, **kwargs):
-        snippet = get_object_or_404(Snippet, id=self.kwargs["id"])
+        snippet = kwargs["snippet"]
         form = SnippetForm(instance=snippet)
         return render(request, "snippets/snippet_add.html", {"form": form, "action": "Edit"})
 
     def post(self, request, *args, **kwargs):
-        snippet = get_object_or_404(Snippet, id=self.kwargs["id"])
+        snippet = kwargs["snippet"]
         form = SnippetForm(request.POST, instance=snippet)
         if form.is_valid():
-            form.save()
+            with transaction.atomic():
+                form.save()
+                publish(renderSnippetHighlight.s(snippet.id), indexSnippetTokens.s(snippet.id))
             return redirect("snippet", id=snippet.id)
         return render(request, "snippets/snippet_add.html", {"form": form, "action": "Edit"})
 
@@ -87,64 +140,260 @@ class SnippetDelete(LoginRequiredMixin, View):
     GET: Deletes the snippet immediately and redirects to the user's snippets list.
     """
     def get(self, request, *args, **kwargs):
-        snippet = get_object_or_404(Snippet, id=kwargs["id"])
+        snippet = kwargs["snippet"]
         snippet.delete()
         return redirect("user_snippets", username=request.user.username)
 
+@async_method_decorator(count_views, name="get")
+@async_method_decorator(cache_anonymous_page(lambda id: ["snippet:%s" % id]), name="get")
 class SnippetDetails(View):
     """
     View to display the details of a snippet.
     
     GET: Renders the snippet detail page. If the snippet is private, only the owner can view it.
+         The highlight is rendered by a celery task, while it is pending the plain code is shown.
+         Conditional requests get a 304 before the highlight is looked up or the page rendered.
+         The page never loads more than HIGHLIGHT_MAX_SIZE characters of code: bigger
+         snippets show their first page of lines, with a button that loads
+         the following ones from `SnippetLines`, and past SNIPPET_RAW_SIZE only a link
+         to `SnippetRaw`.
+         Async: the queries go through the async ORM and the cache and the task queue
+         are reached from a thread, the event loop only renders the template.
+         Every page served, cached or not, counts as a view, see `popularity.count_views`.
     """
-    def get(self, request, *args, **kwargs):
-        snippet_id = self.kwargs["id"]
-        snippet = get_object_or_404(Snippet, id=snippet_id)
-        is_owner = is_the_owner(request, snippet.user.username)
-        if not snippet.public and not is_owner:
+    async def get(self, request, *args, **kwargs):
+        await aload_user(request)
+        snippet = await aget_snippet_details_or_404(self.kwargs["id"])
+        if not snippet.public and not is_snippet_owner(request, snippet):
             return redirect("index")
 
+        tier = size_tier(snippet.code_size)
+        pending = tier != RAW and snippet.is_highlight_pending
+        etag, last_modified = snippet_validators(request, snippet, pending)
+        if pending:
+            # The page changes when the highlight is stored, which doesn't touch `updated`
+            await sync_to_async(queue_highlight)(snippet.id)
+            last_modified = None
+
+        async def render_page():
+            context = await self.get_context(snippet, tier)
+            return render(request, "snippets/snippet.html", context)
+
+        response = await aconditional_page(request, etag, last_modified, render_page)
+        # The page with the plain code fallback is not cached
+        response.cacheable = not pending
+        return response
+
+    async def get_context(self, snippet, tier):
+        context = {"snippet": snippet, "raw_url": reverse("snippet_raw", args=[snippet.id])}
+        if tier == FULL:
+            # The head is the whole code
+            snippet.snippet = snippet.code_head
+            context["highlighted_snippet"] = snippet.highlighted or await sync_to_async(snippet.rendered_highlight)()
+        elif tier == PAGED:
+            page, lines = line_page(snippet.code_head, complete=False)
+            context["highlighted_snippet"] = snippet.highlighted or render_plain(page)
+            context["more_url"] = lines_url(snippet, len(page), 1 + lines)
+        return context
+
+
+def get_visible_snippet(request, snippet_id):
+    """ A snippet with the size of its code but without the code, 404 if the user can't see it """
+    snippets = Snippet.objects.select_related("language").annotate(code_size=F("code_blob__size"))
+    snippet = get_object_or_404(snippets, id=snippet_id)
+    if not snippet.public and not is_snippet_owner(request, snippet):
+        raise Http404("No Snippet matches the given query.")
+    return snippet
+
+
+async def aget_visible_snippet(request, snippet_id):
+    """ `get_visible_snippet` for the async views, only of the snippets that are highlighted """
+    await aload_user(request)
+    snippets = Snippet.objects.select_related("language").annotate(code_size=F("code_blob__size"))
+    snippet = await aget_object_or_404(snippets.filter(code_size__lte=settings.SNIPPET_RAW_SIZE), id=snippet_id)
+    if not snippet.public and not is_snippet_owner(request, snippet):
+        raise Http404("No Snippet matches the given query.")
+    return snippet
+
+
+def lines_url(snippet, offset, line):
+    """ URL of the page of lines that starts at the character `offset`, which is the line `line` """
+    return "%s?offset=%s&line=%s" % (reverse("snippet_lines", args=[snippet.id]), offset, line)
+
+
+class SnippetLines(View):
+    """
+    View that highlights a page of lines of a big snippet, for the "load more" button of the details.
+
+    GET: Renders the page of lines that starts at the character `offset`, numbered from
+         `line`, with the button to the next page if there is one. A page has up to
+         HIGHLIGHT_PAGE_LINES lines and HIGHLIGHT_PAGE_SIZE characters, and only those
+         are read from the database, so a request never holds more than a page of code.
+         Snippets past SNIPPET_RAW_SIZE are not highlighted.
+         Async: the lines are highlighted in the highlight pool, off the event loop.
+    """
+    async def get(self, request, *args, **kwargs):
+        snippet = await aget_visible_snippet(request, self.kwargs["id"])
+        try:
+            offset = min(max(int(request.GET.get("offset", 0)), 0), snippet.code_size)
+            line = max(int(request.GET.get("line", 1)), 1)
+        except ValueError:
+            offset, line = 0, 1
+        page, lines = await acode_page(snippet, offset)
+        highlighted = await snippet.ahighlight_page(page, line) if page else ""
+        next_url = None
+        if offset + len(page) < snippet.code_size:
+            next_url = lines_url(snippet, offset + len(page), line + lines)
         return render(
-            request, 
-            "snippets/snippet.html", 
-            {
-                "snippet": snippet, 
-                "highlighted_snippet": snippet.highlight
-            }
+            request,
+            "snippets/snippet_lines.html",
+            {"highlighted_snippet": highlighted, "next_url": next_url},
         )
 
+
+class SnippetRaw(View):
+    """
+    View that serves the code of a snippet as plain text.
+
+    GET: Streams the code in chunks of SNIPPET_RAW_CHUNK_SIZE characters, each read with
+         its own query, so the memory used doesn't depend on the size of the snippet.
+         Under ASGI the chunks are read by an async iterator, see `streaming_content`.
+    """
+    def get(self, request, *args, **kwargs):
+        snippet = get_visible_snippet(request, self.kwargs["id"])
+        chunks = streaming_content(request, raw_chunks, araw_chunks, snippet)
+        return StreamingHttpResponse(chunks, content_type="text/plain; charset=utf-8")
+
+@async_method_decorator(cache_anonymous_page(lambda username: ["user:%s" % username]), name="get")
 class UserSnippets(View):
     """
     View to list all snippets for a given user.
     
     GET: Displays all snippets for the owner if the current user is the owner; 
-         otherwise, only displays public snippets.
+         otherwise, only displays public snippets. The list is paginated by cursor.
+         The totals of the user come from its counter.
     """
-    def get(self, request, *args, **kwargs):
+    async def get(self, request, *args, **kwargs):
+        await aload_user(request)
         username = self.kwargs["username"]
-        owner = get_object_or_404(User, username=username)
+        owner = await aget_object_or_404(User, username=username)
         is_owner = is_the_owner(request, owner.username)
-        if is_owner:
-            snippets = Snippet.objects.filter(user=owner)
-        else:
-            snippets = Snippet.objects.filter(user=owner, public=True)
-        return render(
+        snippets = user_snippets(owner, include_private=is_owner)
+        page = await apaginate(snippets, request.GET.get("after"), request.GET.get("before"))
+        counter = await user_counter(owner).afirst()
+        totals = (counter.total, counter.public) if counter else (0, 0)
+        etag = listing_etag(
+            request, page.items, page.next_cursor, page.previous_cursor, totals
+        )
+        return await aconditional_page(
             request,
-            "snippets/user_snippets.html",
-            {"snippetUsername": owner, "snippets": snippets},
+            etag,
+            None,
+            lambda: arender(
+                request,
+                "snippets/user_snippets.html",
+                {
+                    "snippetUsername": owner,
+                    "snippets": page.items,
+                    "page": page,
+                    "is_owner": is_owner,
+                    "total": totals[0],
+                    "public_total": totals[1],
+                },
+            ),
         )
 
+@async_method_decorator(cache_anonymous_page(lambda language: ["language:%s" % language, SIDEBAR_SCOPE]), name="get")
 class SnippetsByLanguage(View):
     """
     View to list all public snippets for a specific programming language.
     
     GET: Filters snippets by the language slug provided in the URL and renders them in the index template.
+         The list is paginated by cursor. The page is validated by the snippets it shows
+         and the counts of the language sidebar.
     """
-    def get(self, request, *args, **kwargs):
+    async def get(self, request, *args, **kwargs):
+        await aload_user(request)
         language = self.kwargs["language"]
-        language_obj = get_object_or_404(Language, slug=language)
-        snippets = Snippet.objects.filter(public=True, language=language_obj)
-        return render(request, "index.html", {"snippets": snippets})
+        language_obj = await aget_object_or_404(Language, slug=language)
+        snippets = language_snippets(language_obj)
+        page = await apaginate(snippets, request.GET.get("after"), request.GET.get("before"))
+        counters = [counter async for counter in language_counters()]
+        etag = listing_etag(
+            request, page.items, page.next_cursor, page.previous_cursor, sidebar_counts(counters)
+        )
+        return await aconditional_page(
+            request,
+            etag,
+            None,
+            lambda: arender(
+                request, "index.html", {"snippets": page.items, "page": page, "language_counters": counters}
+            ),
+        )
+
+
+@async_method_decorator(cache_anonymous_page(lambda: [TRENDING_SCOPE]), name="get")
+class Trending(View):
+    """
+    View to list the most viewed public snippets of late.
+
+    GET: The TRENDING_SIZE public snippets with the highest trend, where the views of
+         the last TRENDING_HALF_LIFE weigh twice as much as the ones of the half-life
+         before. The views are written every VIEW_FLUSH_INTERVAL seconds, so is the page.
+    """
+    async def get(self, request, *args, **kwargs):
+        await aload_user(request)
+        snippets = [snippet async for snippet in trending_snippets()[:settings.TRENDING_SIZE]]
+        etag = listing_etag(request, snippets, [snippet.popularity.views for snippet in snippets])
+        return await aconditional_page(
+            request,
+            etag,
+            None,
+            lambda: arender(request, "snippets/trending.html", {"snippets": snippets}),
+        )
+
+
+def sidebar_counts(counters):
+    """ What the language sidebar shows, for the ETag of the page """
+    return [(counter.language_id, counter.public) for counter in counters]
+
+
+class Search(View):
+    """
+    View to search snippets.
+
+    GET: Ranks the public snippets, and the ones of the authenticated user, by the words
+         of the `q` parameter found in their name, description and code,
+         and renders them in the index template.
+         With a `token` parameter it looks for the snippets whose code contains that
+         identifier instead, `kind` limits it to names, keywords or strings.
+    """
+    def get(self, request, *args, **kwargs):
+        token = request.GET.get("token")
+        if token:
+            snippets = search_tokens(token, request.user, request.GET.getlist("kind"))
+            page = paginate(snippets, request.GET.get("after"), request.GET.get("before"))
+            params = request.GET.copy()
+            params.pop("after", None)
+            params.pop("before", None)
+            return render(
+                request,
+                "index.html",
+                {
+                    "snippets": page.items,
+                    "page": page,
+                    "query": token,
+                    "page_params": params.urlencode() + "&",
+                    "language_counters": language_counters(),
+                },
+            )
+        query = request.GET.get("q", "")
+        snippets = search_snippets(query, request.user)
+        return render(
+            request,
+            "index.html",
+            {"snippets": snippets, "query": query, "language_counters": language_counters()},
+        )
 
 
 class Login(AuthenticationForm, View):
@@ -179,6 +428,7 @@ class Logout(View):
         logout(request)
         return redirect('index')
 
+@async_method_decorator(cache_anonymous_page(lambda: ["index", SIDEBAR_SCOPE]), name="get")
 class Index(View):
     """
     View to display the index page with all public snippets.
@@ -187,12 +437,23 @@ class Index(View):
         Retrieves all Snippet objects that are marked as public and renders them
         in the 'index.html' template. 
         If there is an authenticated user, I also look for his snippets to show.
+        The list is paginated by cursor, see `queries.paginate`.
+        Conditional requests are answered from the ETag of the snippets in the page.
+        The language sidebar reads the counts from the language counters.
     """
-    def get(self, request, *args, **kwargs):
-        if request.user.is_authenticated:
-            snippets = Snippet.objects.filter(
-                Q(public=True) | Q(user=request.user)
-            ).distinct()
-        else:
-            snippets = Snippet.objects.filter(public=True)
-        return render(request, "index.html", {"snippets": snippets})
\ No newline at end of file
+    async def get(self, request, *args, **kwargs):
+        user = await aload_user(request)
+        snippets = index_snippets(user)
+        page = await apaginate(snippets, request.GET.get("after"), request.GET.get("before"))
+        counters = [counter async for counter in language_counters()]
+        etag = listing_etag(
+            request, page.items, page.next_cursor, page.previous_cursor, sidebar_counts(counters)
+        )
+        return await aconditional_page(
+            request,
+            etag,
+            None,
+            lambda: arender(
+                request, "index.html", {"snippets": page.items, "page": page, "language_counters": counters}
+            ),
+        )
\ No newline at end of file